@@ -453,13 +453,7 @@ def run_gui(action, provider, **kwargs):
 
     def queue_downloads(loop, user_data):
         logger.debug("queue_downloads")
-        with db_session:
-            for download in model.MediaDownload.select():
-                listing = download.media_listing
-                logger.debug(f"queuing {listing}")
-                provider = listing.provider
-                for task in provider.create_download_tasks(listing, index=download.source_index):
-                    state.task_manager.download(task)
+        state.task_manager.download_queue.resume()
 
 
 
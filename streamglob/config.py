@@ -2,6 +2,8 @@ import logging
 logger = logging.getLogger(__name__)
 import os
 import errno
+import shutil
+import tempfile
 import pytz
 try:
     from collections.abc import Mapping, MutableMapping
@@ -297,15 +299,29 @@ class Config(ConfigTree):
     def save(self):
 
         dumper = yaml_dumper()
-        with open(self._config_file, 'w') as outfile:
-            yaml.dump(
-                self.tree, outfile,
-                Dumper=dumper,
-                allow_unicode=True,
-                sort_keys=False,
-                default_flow_style=False,
-                indent=4
-            )
+        # replace the file a symlinked config points to, not the link
+        config_file = os.path.realpath(self._config_file)
+        # write to a temporary file first so a crash can't leave a
+        # truncated config behind
+        fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(config_file), prefix=".tmp."
+        )
+        try:
+            with os.fdopen(fd, 'w') as outfile:
+                yaml.dump(
+                    self.tree, outfile,
+                    Dumper=dumper,
+                    allow_unicode=True,
+                    sort_keys=False,
+                    default_flow_style=False,
+                    indent=4
+                )
+            if os.path.exists(config_file):
+                shutil.copymode(config_file, tmp)
+            os.replace(tmp, config_file)
+        except:
+            os.remove(tmp)
+            raise
 
 
 def load(config_file=None, merge_default=False):
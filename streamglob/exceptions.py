@@ -13,6 +13,9 @@ class SGStreamSessionException(SGException):
 class SGInvalidFilterValue(SGException):
     pass
 
+class SGInvalidFilterExpression(SGException):
+    pass
+
 class SGIncompleteIdentifier(SGException):
     pass
 
@@ -30,3 +33,6 @@ class SGInvalidFilenameTemplate(SGException):
 
 class SGClientThrottled(SGException):
     pass
+
+class SGChecksumMismatch(SGException):
+    pass
@@ -0,0 +1,281 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import re
+import glob
+import fnmatch
+import time
+import collections
+
+from unidecode import unidecode
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+
+GLOB_ESCAPE_RE = re.compile(r"\[([*?[])\]")
+
+
+def name_stems(name):
+    """
+    Every prefix of `name` that is followed by a dot, i.e. every `stem` for
+    which the glob pattern `stem.*` would match `name`.
+    """
+    i = name.find(".")
+    while i > 0:
+        yield name[:i]
+        i = name.find(".", i+1)
+
+
+def unescape_glob(pattern):
+    """
+    Undo `glob.escape`, returning None if the pattern has any wildcards
+    left.
+    """
+    literal = GLOB_ESCAPE_RE.sub(r"\1", pattern)
+    if glob.has_magic(GLOB_ESCAPE_RE.sub("", pattern)):
+        return None
+    return literal
+
+
+class DirectoryIndex(object):
+    """
+    In-memory listing of a single directory, with the results of previous
+    glob lookups memoized until an entry they depend on changes.
+    """
+
+    MAX_MATCHES = 10000
+
+    def __init__(self, path):
+        self.path = path
+        self.scan()
+
+    def stat_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def scan(self):
+        self.mtime = self.stat_mtime()
+        self.names = dict()
+        self.stems = dict()
+        self.folded = dict()
+        self.dirs = dict()
+        self.matches = dict()
+        self.checked = time.monotonic()
+        try:
+            with os.scandir(self.path) as it:
+                for entry in it:
+                    self.add(entry.name)
+        except OSError:
+            pass
+
+    def revalidate(self):
+        self.checked = time.monotonic()
+        if self.stat_mtime() != self.mtime:
+            logger.debug(f"rescanning {self.path}")
+            self.scan()
+
+    def add(self, name):
+        # glob doesn't match hidden files with a leading wildcard
+        if name.startswith(".") or name in self.names:
+            return
+        self.names[name] = None
+        for stem in name_stems(name):
+            self.stems.setdefault(stem, []).append(name)
+        self.folded.setdefault(unidecode(name), name)
+        # only patterns that didn't match anything can be affected
+        for pattern in [p for p, m in self.matches.items() if m is None]:
+            del self.matches[pattern]
+
+    def remove(self, name):
+        if self.names.pop(name, False) is False:
+            return
+        self.dirs.pop(name, None)
+        for stem in name_stems(name):
+            names = self.stems[stem]
+            names.remove(name)
+            if not names:
+                del self.stems[stem]
+        folded = unidecode(name)
+        if self.folded.get(folded) == name:
+            del self.folded[folded]
+            other = next(
+                (n for n in self.names if unidecode(n) == folded), None
+            )
+            if other:
+                self.folded[folded] = other
+        for pattern in [p for p, m in self.matches.items() if m == name]:
+            del self.matches[pattern]
+
+    def find(self, name):
+        """
+        Return the entry named `name`, or one that's the same after
+        transliterating to ASCII.
+        """
+        if name in self.names:
+            return name
+        return self.folded.get(unidecode(name))
+
+    def is_dir(self, name):
+        if name not in self.dirs:
+            self.dirs[name] = os.path.isdir(os.path.join(self.path, name))
+        return self.dirs[name]
+
+    def match(self, pattern):
+
+        try:
+            return self.matches[pattern]
+        except KeyError:
+            pass
+
+        literal = unescape_glob(pattern)
+        if literal is not None:
+            name = literal if literal in self.names else None
+        elif pattern.endswith(".*") and unescape_glob(pattern[:-2]) is not None:
+            # the usual "exact" pattern: a known filename with the extension
+            # left open
+            stem = unescape_glob(pattern[:-2])
+            name = next(iter(self.stems.get(stem, [])), None)
+        else:
+            regex = re.compile(fnmatch.translate(pattern))
+            name = next(
+                (n for n in self.names if regex.match(n)),
+                None
+            )
+
+        if len(self.matches) >= self.MAX_MATCHES:
+            self.matches.clear()
+        self.matches[pattern] = name
+        return name
+
+
+class LocalFileEventHandler(FileSystemEventHandler):
+
+    def __init__(self, index):
+        self.index = index
+        super().__init__()
+
+    # these run in the observer thread, so just queue the changes up for
+    # the next lookup to apply
+
+    def on_created(self, event):
+        self.index.events.append(("add", event.src_path))
+
+    def on_deleted(self, event):
+        self.index.events.append(("discard", event.src_path))
+
+    def on_moved(self, event):
+        self.index.events.append(("discard", event.src_path))
+        self.index.events.append(("add", event.dest_path))
+
+
+class LocalFileIndex(object):
+    """
+    Index of the files in download output directories, used to find out
+    whether a source has already been downloaded without globbing the
+    filesystem for every table row.
+
+    Each directory is listed once, then kept current by filesystem watches
+    and by download tasks reporting the files they create.  As a fallback
+    for missed events, a directory is rescanned if its mtime has changed
+    since it was last checked.
+    """
+
+    MAX_DIRECTORIES = 256
+    REVALIDATE_INTERVAL = 60
+
+    def __init__(self):
+        self.directories = collections.OrderedDict()
+        self.events = collections.deque()
+        self._observer = None
+        self._watches = dict()
+
+    @property
+    def observer(self):
+        if not self._observer:
+            self._observer = Observer()
+            self._observer.daemon = True
+            self._observer.start()
+        return self._observer
+
+    def watch(self, path):
+        if path in self._watches:
+            return
+        try:
+            self._watches[path] = self.observer.schedule(
+                LocalFileEventHandler(self), path, recursive=False
+            )
+        except OSError as e:
+            # doesn't exist yet -- picked up when revalidated
+            logger.debug(f"can't watch {path}: {e}")
+
+    def unwatch(self, path):
+        watch = self._watches.pop(path, None)
+        if watch:
+            try:
+                self.observer.unschedule(watch)
+            except (KeyError, OSError):
+                pass
+
+    def apply_events(self):
+        while self.events:
+            (op, path) = self.events.popleft()
+            getattr(self, op)(path)
+
+    def directory(self, path):
+
+        self.apply_events()
+        path = os.path.normpath(path)
+        directory = self.directories.pop(path, None)
+        if directory is None:
+            directory = DirectoryIndex(path)
+        elif time.monotonic() - directory.checked > self.REVALIDATE_INTERVAL:
+            directory.revalidate()
+        if directory.mtime is not None:
+            self.watch(path)
+        self.directories[path] = directory
+
+        while len(self.directories) > self.MAX_DIRECTORIES:
+            (evicted, _) = self.directories.popitem(last=False)
+            self.unwatch(evicted)
+
+        return directory
+
+    def glob(self, pattern):
+        """
+        Return the first path matching `pattern`, or None, like
+        `next(glob.iglob(pattern), None)`.
+        """
+        (dirname, basename) = os.path.split(pattern)
+        if not basename or glob.has_magic(dirname):
+            return next(glob.iglob(pattern), None)
+
+        name = self.directory(dirname or os.curdir).match(basename)
+        return os.path.join(dirname, name) if name else None
+
+    def find_directory(self, path, name):
+        """
+        Return the name of the subdirectory of `path` matching `name` (see
+        `DirectoryIndex.find`), or None.
+        """
+        directory = self.directory(path)
+        match = directory.find(name)
+        if match and directory.is_dir(match):
+            return match
+        return None
+
+    def add(self, path):
+        (dirname, name) = os.path.split(os.path.normpath(path))
+        directory = self.directories.get(dirname)
+        if directory:
+            directory.add(name)
+
+    def discard(self, path):
+        (dirname, name) = os.path.split(os.path.normpath(path))
+        directory = self.directories.get(dirname)
+        if directory:
+            directory.remove(name)
+
+
+local_files = LocalFileIndex()
@@ -6,6 +6,7 @@ from datetime import datetime, timedelta
 import typing
 import types
 import re
+import functools
 import dateparser.search
 import abc
 import asyncio
@@ -15,6 +16,8 @@ from unidecode import unidecode
 import tempfile
 import traceback
 import glob
+import string
+import time
 from functools import lru_cache
 import hashlib
 from itertools import chain
@@ -33,6 +36,8 @@ from . import config
 from . import providers
 from . import utils
 from .exceptions import *
+from .query import FilterQuery, QueryCache
+from .localindex import local_files
 
 CACHE_DURATION_SHORT = 60 # 60 seconds
 CACHE_DURATION_MEDIUM = 60*60*24 # 1 day
@@ -41,6 +46,23 @@ CACHE_DURATION_DEFAULT = CACHE_DURATION_SHORT
 
 db = Database()
 
+
+class ChangeCounter(object):
+    """
+    Bumped whenever a channel, listing or source is inserted, updated or
+    deleted, so that cached query results can tell whether they're still
+    current.
+    """
+
+    def __init__(self):
+        self.value = 0
+
+    def bump(self, *args):
+        self.value += 1
+
+data_changes = ChangeCounter()
+query_cache = QueryCache(lambda: data_changes.value)
+
 # Monkey-patch "upsert"-ish functionality into the Pony ORM db.Entity class.
 # via: https://github.com/ponyorm/pony/issues/131
 @db_session
@@ -312,6 +334,8 @@ class MediaChannel(MediaChannelMixin, db.Entity):
     listings = Set(lambda: ChannelMediaListing, reverse="channel")
     attrs = Required(Json, default={})
 
+    after_insert = after_update = after_delete = data_changes.bump
+
     SUBTYPES = dict()
 
     @classmethod
@@ -324,7 +348,118 @@ class SafeDict(dict):
     def __missing__(self, key):
         return '{' + key + '}'
 
-SUBJECT_MAP = dict()
+
+class FilenameTemplate(object):
+    """
+    A `str.format` template compiled once into a Python function that
+    renders it with a single f-string, rather than parsing it again with
+    `format_map` on every call.
+
+    As with `SafeDict`, a field whose name isn't in the supplied values is
+    left in the output as `{name}`.
+    """
+
+    FIELD_RE = re.compile(r"([^.[]*)(.*)")
+    ACCESSOR_RE = re.compile(r"\.([^.[]+)|\[([^\]]*)\]")
+
+    def __init__(self, template):
+        self.template = template
+        self.render = self.compile(template)
+
+    @classmethod
+    def compile(cls, template):
+
+        consts = dict()
+        body = []
+        fstring = []
+
+        def const(value):
+            name = f"_c{len(consts)}"
+            consts[name] = value
+            return name
+
+        for (literal, field, spec, conversion) in string.Formatter().parse(template):
+            if literal:
+                fstring.append("{%s}" % const(literal))
+            if field is None:
+                continue
+
+            (name, rest) = cls.FIELD_RE.match(field).groups()
+            expr = f"(v[{name!r}] if {name!r} in v else {const('{' + name + '}')})"
+            for (attr, key) in cls.ACCESSOR_RE.findall(rest):
+                if attr:
+                    if not attr.isidentifier():
+                        raise ValueError(f"invalid field: {field}")
+                    expr += f".{attr}"
+                else:
+                    expr += f"[{int(key) if key.isdigit() else key!r}]"
+            var = f"_f{len(body)}"
+            body.append(f"{var} = {expr}")
+
+            if "{" in spec:
+                spec_var = f"{var}_spec"
+                body.append(
+                    f"{spec_var} = {const(FilenameTemplate(spec).render)}(v)"
+                )
+            else:
+                spec_var = const(spec) if spec else None
+            fstring.append(
+                "{" + var
+                + (f"!{conversion}" if conversion else "")
+                + (":{%s}" % spec_var if spec_var else "")
+                + "}"
+            )
+
+        source = "def render(v):\n%s    return f%r\n" % (
+            "".join(f"    {line}\n" for line in body),
+            "".join(fstring)
+        )
+        namespace = dict(consts)
+        exec(compile(source, f"<template {template!r}>", "exec"), namespace)
+        return namespace["render"]
+
+
+@lru_cache(256)
+def compile_template(template, safe=False):
+    if safe:
+        template = re.sub(r"{listing.title\b", "{listing.safe_title", template)
+    return FilenameTemplate(template)
+
+
+def filename_template_benchmark(count=100000):
+    """
+    Compare rendering a filename template the way `download_filename` used
+    to (safe-title substitution, `format_map`, then a second `format_map`
+    for the extension) against a compiled template.
+    """
+
+    template = "{listing.feed_name}/{listing.title}.{listing.content_date}.{uri}.{index:02d}.{ext}"
+    values = dict(
+        listing=types.SimpleNamespace(
+            feed_name="feed", title="Some Video Title",
+            safe_title="Some Video Title", content_date="2024-01-01",
+        ),
+        title="Some Video Title", uri="uri=yt+abc123=", index=1
+    )
+
+    start = time.perf_counter()
+    for i in range(count):
+        s = re.sub(r"{listing.title\b", "{listing.safe_title", template)
+        expected = s.format_map(SafeDict(values))
+        expected = expected.format_map(SafeDict(ext="mp4"))
+    elapsed_format = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(count):
+        rendered = compile_template(template, safe=True).render(
+            dict(values, ext="mp4")
+        )
+    elapsed_compiled = time.perf_counter() - start
+
+    assert rendered == expected, (rendered, expected)
+    print(f"format_map: {count/elapsed_format:.0f} templates/sec")
+    print(f"compiled:   {count/elapsed_compiled:.0f} templates/sec")
+
 
 class MediaSourceMixin(object):
 
@@ -431,6 +566,8 @@ class MediaSourceMixin(object):
         if listing is None:
             listing = self.listing
 
+        if "outfile" in kwargs:
+            return kwargs.get("outfile")
 
         with db_session:
             try:
@@ -441,76 +578,67 @@ class MediaSourceMixin(object):
             if group is None:
                 group = f"{listing.group}" if listing.group else ""
 
-        subjects = listing.subjects
-
-        if isinstance(index, int):
-            index += 1
+            subjects = listing.subjects
 
-        if "outfile" in kwargs:
-            return kwargs.get("outfile")
-
-        template = (
-            self.provider.config.get_path("output.template")
-            or
-            config.settings.profile.get_path("output.template")
-        )
+            template = (
+                self.provider.config.get_path("output.template")
+                or
+                config.settings.profile.get_path("output.template")
+            )
 
-        group_by = (
-            self.provider.config.get_path("output.group_by")
-            or
-            config.settings.profile.get_path("output.group_by")
-        )
+            group_by = (
+                self.provider.config.get_path("output.group_by")
+                or
+                config.settings.profile.get_path("output.group_by")
+            )
 
-        def expand_template(s, safe=False, **tokens):
+            if not template:
+                template = "{self.provider}.{self.default_name}.{self.timestamp}.{self.ext}"
+                outfile = template.format(self=self)
+                if match_glob:
+                    outfile = re.sub("({[^}]+})", "*", outfile)
+                return os.path.join(listing.output_path, outfile)
 
-            if safe:
-                s = re.sub(r"{listing.title\b", "{listing.safe_title", s)
             try:
                 title = listing.safe_title
-                # group_title = f"""{"[%s] " %(group) if group else ""}{title}"""
-                # if match_glob:
-                #     group_title = glob.escape(group_title)
-                if self.provider.config.output.title_prefix:
-                    if self.provider.config.output.title_prefix == "group":
-                        title = f"""{"[%s] " %(group) if group else ""}{title}"""
-                    if self.provider.config.output.title_prefix == "subjects":
-                        title = f"""{"[%s] " %(", ".join(subjects)) if subjects else ""}{title}"""
-                    else:
-                        raise NotImplementedError
+                title_prefix = self.provider.config.output.title_prefix
+                if title_prefix == "group":
+                    title = f"""{"[%s] " %(group) if group else ""}{title}"""
+                elif title_prefix == "subjects":
+                    title = f"""{"[%s] " %(", ".join(subjects)) if subjects else ""}{title}"""
+                elif title_prefix:
+                    raise NotImplementedError
 
                 if match_glob:
                     title = glob.escape(title)
 
-                with db_session:
-
-                    # import ipdb; ipdb.set_trace()
-                    outfile = s.format_map(
-                        SafeDict(
-                            self=self, listing=listing, # FIXME
-                            uri="uri=" + self.uri.replace("/", "+") +"=" if not match_glob else "*",
-                            index=self.rank+1,
-                            num=num or len(listing.sources) if listing else 0,
-                            subject=",".join(subjects) if subjects else None,
-                            title=title,
-                            group=group,
-                            subjects=subjects,
-                            **tokens
-                            # subject_dir=subject_dir
-                        )
-                    )
+                values = dict(
+                    self=self, listing=listing, # FIXME
+                    uri="uri=" + self.uri.replace("/", "+") +"=" if not match_glob else "*",
+                    index=self.rank+1,
+                    num=num or len(listing.sources) if listing else 0,
+                    subject=",".join(subjects) if subjects else None,
+                    title=title,
+                    group=group,
+                    subjects=subjects,
+                )
+                if not match_glob:
+                    values["ext"] = self.ext
+            except Exception as e:
+                logger.exception("".join(traceback.format_exc()))
+                raise SGInvalidFilenameTemplate(str(e))
 
+            def expand_template(s, safe=False):
+                try:
+                    outfile = compile_template(s, safe=safe).render(values)
                     if not match_glob:
-                        outfile = outfile.format_map(SafeDict(ext=self.ext))
                         outfile = self.provider.translate_template(outfile)
                     if config.settings.profile.unicode_normalization:
                         outfile = unicodedata.normalize(config.settings.profile.unicode_normalization, outfile)
-            except Exception as e:
-                logger.exception("".join(traceback.format_exc()))
-                raise SGInvalidFilenameTemplate(str(e))
-
-            return outfile
-
-        if template:
+                except Exception as e:
+                    logger.exception("".join(traceback.format_exc()))
+                    raise SGInvalidFilenameTemplate(str(e))
+                return outfile
 
             (template_dir, template_file) = os.path.split(template)
 
@@ -521,41 +649,23 @@ class MediaSourceMixin(object):
             else:
                 template_dir = "."
 
-            if group_by == "subject":
-                try:
-                    if group and not group in SUBJECT_MAP:
-                        SUBJECT_MAP[group] = next(
-                        e.name for e in os.scandir(
-                            os.path.join(
-                                listing.output_path,
-                                template_dir
-                                )
-                            )
-                        if e.is_dir()
-                        and (
-                            e.name == group
-                            or unidecode(e.name) == unidecode(group)
-                        )
-                    )
-                    if SUBJECT_MAP.get(group):
-                        path_list.append(SUBJECT_MAP[group])
-
-                except StopIteration:
-                    SUBJECT_MAP[group] = None
+            if group_by == "subject" and group:
+                subject_dir = local_files.find_directory(
+                    os.path.normpath(
+                        os.path.join(listing.output_path, template_dir)
+                    ),
+                    group
+                )
+                if subject_dir:
+                    path_list.append(subject_dir)
 
             path_list.append(expand_template(template_file, safe=True))
 
-            # import ipdb; ipdb.set_trace()
             outfile = os.path.join(*path_list)
 
-        else:
-            template = "{self.provider}.{self.default_name}.{self.timestamp}.{self.ext}"
-            outfile = template.format(self=self)
         if match_glob:
             outfile = re.sub("({[^}]+})", "*", outfile)
 
-        # import ipdb; ipdb.set_trace()
-
         return os.path.join(listing.output_path, outfile)
 
     def __str__(self):
@@ -624,7 +734,7 @@ class MediaSourceMixin(object):
                 else:
                     raise NotImplementedError
 
-                ret = next(glob.iglob(path), None)
+                ret = local_files.glob(path)
                 if ret:
                     return (ret, match_type)
 
@@ -653,6 +763,8 @@ class MediaSource(MediaSourceMixin, db.Entity):
     downloaded = Optional(datetime)
     viewed = Optional(datetime)
 
+    after_insert = after_update = after_delete = data_changes.bump
+
 
 class InflatableMediaSourceMixin(object):
 
@@ -868,6 +980,8 @@ class MediaListing(MediaListingMixin, db.Entity):
     locator = Optional(str)
     cover_locator = Optional(str)
 
+    after_insert = after_update = after_delete = data_changes.bump
+
 
 class ContentMediaListingMixin(object):
 
@@ -1056,6 +1170,12 @@ class MediaDownload(MediaListingMixin, db.Entity):
     retries = Required(int, default=0)
     done = Required(bool, default=False)
     source_index = Required(int, default=0)
+    # pending, active, waiting (to be retried) or failed
+    state = Required(str, default="pending", index=True)
+    error = Optional(str, nullable=True)
+    next_attempt = Optional(datetime)
+    # the file being downloaded to, so an interrupted download can resume
+    partial = Optional(str, nullable=True)
 
     @classmethod
     @db_session
@@ -1086,7 +1206,8 @@ class ProgramMediaTaskMixin(object):
         self.result = asyncio.get_event_loop().create_future()
 
     def reset(self):
-        # self.program = asyncio.get_event_loop().create_future()
+        # each postprocessing stage runs a new program
+        self.program = asyncio.get_event_loop().create_future()
         self.proc = asyncio.get_event_loop().create_future()
 
     def finalize(self):
@@ -1144,13 +1265,22 @@ class PlayMediaTask(PlayMediaTaskMixin, ProgramMediaTask):
 class DownloadMediaTaskMixin(object):
 
     tempdir_ :typing.Optional[str] = None
+    partial :typing.Optional[str] = None
 
     @property
     def tempdir(self):
         if not self.tempdir_:
+            # private to this attempt: another download of the same source
+            # gets its own, and stages aren't resumed, so nothing in here is
+            # needed once the attempt ends
             self.tempdir_ = tempfile.mkdtemp(prefix="streamglob")
         return self.tempdir_
 
+    def remove_tempdir(self):
+        if self.tempdir_:
+            shutil.rmtree(self.tempdir_, ignore_errors=True)
+            self.tempdir_ = None
+
     @property
     def stage(self):
         return len(self.stage_results)
@@ -1179,10 +1309,9 @@ class DownloadMediaTaskMixin(object):
             if not os.path.isdir(d):
                 os.makedirs(d)
             shutil.move(self.stage_results[-1], self.dest)
-        try:
-            shutil.rmtree(self.tempdir)
-        except FileNotFoundError:
-            pass
+        if self.dest and os.path.exists(self.dest):
+            local_files.add(self.dest)
+        self.remove_tempdir()
         with db_session:
             now = datetime.now()
             for s in self.sources:
@@ -1201,6 +1330,8 @@ class DownloadMediaTaskMixin(object):
         super().stop()
         if self.dest and os.path.isfile(self.dest):
             os.remove(self.dest)
+            local_files.discard(self.dest)
+        self.remove_tempdir()
 
 
 @attrclass(DownloadMediaTaskMixin)
@@ -1225,6 +1356,110 @@ class CacheEntry(db.Entity):
             lambda e: e.last_seen < datetime.now() - timedelta(seconds=age)
         ).delete()
 
+class SavedSearch(db.Entity):
+    """
+    A filter expression whose matching listings are kept in a membership
+    table.  Triggers on the listing table record which rows have been
+    inserted, updated or deleted, and only those rows are re-evaluated the
+    next time the saved searches are used.
+
+    `plan` is the compiled filter: SQL with `?` placeholders and the values
+    to go in them.
+    """
+
+    saved_search_id = PrimaryKey(int, auto=True)
+    provider_id = Required(str)
+    name = Optional(str)
+    expression = Required(str)
+    plan = Required(Json, default=[])
+    members = Set(lambda: SavedSearchMember, cascade_delete=True)
+    composite_key(provider_id, expression)
+
+    TRIGGERS = {"insert": "NEW", "update": "NEW", "delete": "OLD"}
+
+    @classmethod
+    @db_session
+    def install_triggers(cls):
+        # rows only need tracking while there's a saved search to update
+        for event, row in cls.TRIGGERS.items():
+            db.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS saved_search_{event}
+            AFTER {event.upper()} ON "{MediaListing._table_}"
+            WHEN EXISTS (SELECT 1 FROM "{cls._table_}")
+            BEGIN
+                INSERT OR IGNORE INTO "{SavedSearchChange._table_}"
+                (media_listing_id) VALUES ({row}.media_listing_id);
+            END
+            """)
+
+    @classmethod
+    @db_session
+    def apply_changes(cls):
+        """
+        Re-evaluate the listings that have changed since the last call
+        against every saved search.
+        """
+        flush()
+        changes = SavedSearchChange._table_
+        if not db.select(f'SELECT 1 FROM "{changes}" LIMIT 1'):
+            return
+        changed = f'media_listing_id IN (SELECT media_listing_id FROM "{changes}")'
+        db.execute(f'DELETE FROM "{SavedSearchMember._table_}" WHERE {changed}')
+        for search in cls.select():
+            search.evaluate(changed)
+        db.execute(f'DELETE FROM "{changes}"')
+
+    def evaluate(self, scope="1"):
+        (sql, params) = self.plan
+        fragment = FilterQuery(
+            f'SELECT ?, media_listing_id FROM "{MediaListing._table_}" '
+            f'WHERE {scope} AND provider_id = ? AND ({sql})',
+            [self.saved_search_id, self.provider_id] + params
+        )
+        p = fragment.params
+        db.execute(
+            f'INSERT OR IGNORE INTO "{SavedSearchMember._table_}" '
+            f'(saved_search, media_listing_id) {fragment.pony_sql}'
+        )
+
+    def rebuild(self):
+        logger.info(f"rebuilding saved search: {self.name or self.expression}")
+        p = self.saved_search_id
+        db.execute(
+            f'DELETE FROM "{SavedSearchMember._table_}" WHERE saved_search = $p'
+        )
+        self.evaluate()
+
+    def remove(self):
+        # faster than letting the cascade load every member
+        p = self.saved_search_id
+        db.execute(
+            f'DELETE FROM "{SavedSearchMember._table_}" WHERE saved_search = $p'
+        )
+        self.delete()
+
+    @property
+    def query(self):
+        return FilterQuery(
+            "media_listing_id IN ("
+            f'SELECT media_listing_id FROM "{SavedSearchMember._table_}" '
+            "WHERE saved_search = ?)",
+            [self.saved_search_id]
+        )
+
+
+class SavedSearchMember(db.Entity):
+
+    saved_search = Required(SavedSearch)
+    media_listing_id = Required(int, index=True)
+    PrimaryKey(saved_search, media_listing_id)
+
+
+class SavedSearchChange(db.Entity):
+
+    media_listing_id = PrimaryKey(int)
+
+
 class ApplicationData(db.Entity):
     """
     Providers can use this entity to cache data that doesn't belong in the
@@ -1245,18 +1480,51 @@ class ProviderData(db.Entity):
 @db.on_connect(provider="sqlite")
 def sqlite_regexp_search(db, conn):
 
+    # called once per row, so don't recompile the pattern every time
+    compile_regexp = functools.lru_cache(maxsize=256)(re.compile)
+
     def regexp(expr, item):
-        reg = re.compile(expr)
-        return reg.search(item) is not None
+        if item is None:
+            return None
+        return compile_regexp(expr).search(item) is not None
 
     conn.create_function("REGEXP", 2, regexp)
 
+# columns added to tables since they were first created, with the SQL to add
+# them to an older database
+SCHEMA_ADDITIONS = {
+    "MediaDownload": [
+        ("state", "TEXT NOT NULL DEFAULT 'pending'"),
+        ("error", "TEXT"),
+        ("next_attempt", "DATETIME"),
+        ("partial", "TEXT"),
+    ]
+}
+
+
+@db_session
+def add_missing_columns():
+    for table, columns in SCHEMA_ADDITIONS.items():
+        existing = {
+            row[1] for row in db.execute(f'PRAGMA table_info("{table}")')
+        }
+        if not existing:
+            # not created yet
+            continue
+        for (name, definition) in columns:
+            if name in existing:
+                continue
+            logger.info(f"adding column {name} to {table}")
+            db.execute(f'ALTER TABLE "{table}" ADD COLUMN "{name}" {definition}')
+
+
 def init(filename=None, *args, **kwargs):
 
     logger.info("initializing data model")
     if not filename:
         filename = os.path.join(config.settings.CONFIG_DIR, f"{config.PACKAGE_NAME}.sqlite")
     db.bind("sqlite", filename, create_db=True, *args, **kwargs)
+    add_missing_columns()
     try:
         db.generate_mapping(create_tables=True)
     except pony.orm.dbapiprovider.OperationalError:
@@ -1265,4 +1533,5 @@ def init(filename=None, *args, **kwargs):
         shutil.move(filename, new_name)
         db.generate_mapping(create_tables=True)
 
+    SavedSearch.install_triggers()
     CacheEntry.purge()
@@ -0,0 +1,631 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import asyncio
+import multiprocessing
+import concurrent.futures
+import hashlib
+import json
+import shutil
+import tempfile
+import time
+
+import wand.image
+import ffmpeg
+import xdg
+from orderedattrdict import AttrDict
+
+from . import config
+
+DEFAULT_PREVIEW_WORKERS = 2
+
+DEFAULT_CACHE_MAX_SIZE = 1024 # MB
+DEFAULT_CACHE_MAX_AGE = 30 # days
+
+PREVIEW_WIDTH = 1280
+PREVIEW_HEIGHT = 720
+
+
+def sample_evenly_indexes(m, n):
+    return [i*n//m + n//(2*m) for i in range(m)]
+
+def sample_evenly(l, n):
+    return [l[idx] for idx in sample_evenly_indexes(min(n, len(l)), len(l))]
+
+
+def storyboard_tiles(boards, cols, rows, skip=None):
+    """
+    Yield (board index, crop box) for each storyboard tile to be used, given
+    the (width, height) of each storyboard sheet.
+    """
+    tile_width = 0
+    tile_height = 0
+    i = 0
+    for b, (width, height) in enumerate(boards):
+        if b == 0:
+            # calculate tile width / height on first iteration since
+            # last board might not be full height
+            tile_width = width // cols
+            tile_height = height // rows
+        for h in range(0, height, tile_height):
+            for w in range(0, width, tile_width):
+                i += 1
+                if skip and i % skip:
+                    continue
+                yield (b, (w, h, w + tile_width, h + tile_height))
+
+
+def render_montage(board_files, cols, rows, layout):
+    """
+    Crop storyboard tiles out of `board_files` and lay them out on a grid,
+    writing the result to `layout["output"]`.  Runs in a worker process.
+    """
+
+    out_cols, out_rows = layout["grid"]
+    boards = [wand.image.Image(filename=f) for f in board_files]
+    try:
+        tiles = list(storyboard_tiles(
+            [img.size for img in boards], cols, rows, skip=layout.get("skip")
+        ))
+        tiles = sample_evenly(tiles, layout.get("images") or out_cols*out_rows)
+
+        with wand.image.Image(
+                width=layout.get("width", PREVIEW_WIDTH),
+                height=layout.get("height", PREVIEW_HEIGHT),
+                background="black"
+        ) as img:
+            tile_width = img.width // out_cols
+            tile_height = img.height // out_rows
+            for n, (b, (left, top, right, bottom)) in enumerate(tiles):
+                r, c = divmod(n, out_cols)
+                if r >= out_rows:
+                    break
+                with boards[b][left:right, top:bottom] as tile:
+                    tile.transform(resize=f"{tile_width}x{tile_height}")
+                    img.composite(tile, left=c * tile_width, top=r * tile_height)
+            img.save(filename=layout["output"])
+    finally:
+        for board in boards:
+            board.close()
+
+    return layout["output"]
+
+
+def prepare_thumbnail(thumbnail_file, layout):
+
+    thumbnail = wand.image.Image(filename=thumbnail_file)
+    thumbnail.trim(fuzz=layout.get("trim_fuzz", 20))
+    if thumbnail.width != PREVIEW_WIDTH:
+        thumbnail.transform(
+            resize=layout.get("resize", f"{PREVIEW_WIDTH}x{PREVIEW_HEIGHT}")
+        )
+    thumbnail.depth = 8
+    return thumbnail
+
+
+def inset_size(thumbnail, layout):
+    inset_scale = layout.get("scale") or 0.25
+    return (
+        int(thumbnail.width * inset_scale),
+        int(thumbnail.height * inset_scale)
+    )
+
+
+def encode_inset_frames(thumbnail, tiles, num_frames, layout, cancel=None):
+    """
+    Composite each of `tiles` as an inset over `thumbnail`, piping the raw
+    frames into a single ffmpeg encoder.  Returns (output file, duration),
+    or None if `cancel` was set or the encoder failed.
+    """
+
+    inset_offset = layout.get("offset") or 0
+    border_color = layout.get("border_color") or "black"
+    border_width = layout.get("border_width") or 1
+    inset_width, inset_height = inset_size(thumbnail, layout)
+
+    if layout.get("frame_rate"):
+        frame_rate = layout["frame_rate"]
+        duration = num_frames/frame_rate
+    elif layout.get("duration"):
+        duration = layout["duration"]
+        frame_rate = num_frames/duration
+    else:
+        duration = num_frames
+        frame_rate = 1
+
+    output = layout["output"]
+    proc = (
+        ffmpeg
+        .input(
+            "pipe:", format="rawvideo", pix_fmt="rgb24",
+            s=f"{thumbnail.width}x{thumbnail.height}", framerate=frame_rate
+        )
+        .output(
+            output, pix_fmt="yuv420p",
+            vf="pad=ceil(iw/2)*2:ceil(ih/2)*2"
+        )
+        .global_args("-loglevel", "error")
+        .overwrite_output()
+        .run_async(pipe_stdin=True, quiet=True)
+    )
+
+    cancelled = False
+    written = 0
+    try:
+        for tile in tiles:
+            if cancel is not None and cancel.is_set():
+                cancelled = True
+                break
+            written += 1
+            with thumbnail.clone() as frame:
+                tile.transform(resize=f"{inset_width}x{inset_height}")
+                tile.border(border_color, border_width, border_width)
+                frame.composite(
+                    tile,
+                    left=frame.width-tile.width-inset_offset,
+                    top=frame.height-tile.height-inset_offset
+                )
+                proc.stdin.write(frame.make_blob("RGB"))
+    except BrokenPipeError:
+        logger.warning(f"encoder for {output} exited early")
+    finally:
+        if cancelled:
+            proc.kill()
+        else:
+            proc.stdin.close()
+        proc.wait()
+
+    if cancelled or proc.returncode or not written:
+        if os.path.exists(output):
+            os.remove(output)
+        return None
+
+    if written != num_frames:
+        duration = written/frame_rate
+
+    return (output, duration)
+
+
+def render_combined(thumbnail_file, animation_file, board_files,
+                    cols, rows, layout, cancel=None):
+    """
+    Composite animation frames and storyboard tiles as insets over the
+    thumbnail.  Runs in a worker process.
+    """
+
+    animation_skip = layout.get("animation_skip") or 4
+
+    thumbnail = prepare_thumbnail(thumbnail_file, layout)
+    animation = (
+        wand.image.Image(filename=animation_file)
+        if animation_file
+        else None
+    )
+    boards = [wand.image.Image(filename=f) for f in board_files]
+
+    def tiles():
+        if animation:
+            for i in range(len(animation.sequence)//animation_skip):
+                with wand.image.Image(
+                        image=animation.sequence[i * animation_skip]
+                ) as tile:
+                    yield tile
+        for b, (left, top, right, bottom) in storyboard_tiles(
+                [img.size for img in boards], cols, rows,
+                skip=layout.get("skip")
+        ):
+            with boards[b][left:right, top:bottom] as tile:
+                yield tile
+
+    num_frames = (
+        (len(animation.sequence)//animation_skip if animation else 0)
+        + len(list(storyboard_tiles(
+            [img.size for img in boards], cols, rows, skip=layout.get("skip")
+        )))
+    )
+
+    try:
+        return encode_inset_frames(
+            thumbnail, tiles(), num_frames, layout, cancel=cancel
+        )
+    finally:
+        for img in [thumbnail, animation] + boards:
+            if img:
+                img.close()
+
+
+def extract_frames(video_file, num_frames, video_duration, size,
+                   start_ratio=None, end_ratio=0.95, keyframes=True):
+    """
+    Start a single ffmpeg process that pulls `num_frames` evenly spaced
+    frames out of `video_file`, scaled and padded to `size`, and writes them
+    to stdout as raw RGB.  With `keyframes` set, only keyframes are decoded,
+    so each tile is the first keyframe within its interval.
+    """
+
+    width, height = size
+    interval = (video_duration * end_ratio) / num_frames
+    start = interval if start_ratio is None else video_duration * start_ratio
+
+    return (
+        ffmpeg
+        .input(
+            video_file,
+            **(dict(skip_frame="nokey") if keyframes else {})
+        )
+        .video
+        .filter(
+            "select",
+            # first frame in each interval-wide bin, so sparse keyframes
+            # don't cause tiles to be skipped
+            f"gte(t,{start:.3f})*(isnan(prev_selected_t)"
+            f"+gt(floor((t-{start:.3f})/{interval:.3f}),"
+            f"floor((prev_selected_t-{start:.3f})/{interval:.3f})))"
+        )
+        .filter("scale", width, height, force_original_aspect_ratio="decrease")
+        .filter("pad", width, height, "(ow-iw)/2", "(oh-ih)/2")
+        .output(
+            "pipe:", format="rawvideo", pix_fmt="rgb24",
+            vsync="vfr", vframes=num_frames
+        )
+        # stderr is piped but never read, so keep ffmpeg from filling it
+        .global_args("-loglevel", "error")
+        .run_async(pipe_stdout=True, quiet=True)
+    )
+
+
+def read_frames(proc, size):
+    width, height = size
+    frame_size = width * height * 3
+    while True:
+        data = proc.stdout.read(frame_size)
+        if len(data) < frame_size:
+            break
+        yield data
+
+
+def render_video_storyboard(video_file, thumbnail_file, video_duration,
+                            layout, cancel=None):
+    """
+    Build a storyboard for a local video: one ffmpeg process extracts all of
+    the tiles, which are composited over the thumbnail and piped to the
+    encoder without touching any intermediate files.  Runs in a worker
+    process.
+    """
+
+    num_tiles = layout.get("num_tiles") or 10
+    thumbnail = prepare_thumbnail(thumbnail_file, layout)
+    size = inset_size(thumbnail, layout)
+
+    extractor = extract_frames(
+        video_file, num_tiles, video_duration, size,
+        keyframes=layout.get("keyframes", True)
+    )
+
+    def tiles():
+        for data in read_frames(extractor, size):
+            with wand.image.Image(
+                    blob=data, format="rgb",
+                    width=size[0], height=size[1], depth=8
+            ) as tile:
+                yield tile
+
+    try:
+        return encode_inset_frames(
+            thumbnail, tiles(), num_tiles, layout, cancel=cancel
+        )
+    finally:
+        if extractor.poll() is None:
+            extractor.kill()
+        extractor.wait()
+        thumbnail.close()
+
+
+async def wait_process(proc):
+    """
+    Wait for an asyncio subprocess, killing it if the waiting task is
+    cancelled so abandoned previews don't keep encoding in the background.
+    """
+    try:
+        return await proc.wait()
+    except asyncio.CancelledError:
+        if proc.returncode is None:
+            proc.kill()
+        raise
+
+
+class PreviewRenderer(object):
+    """
+    Pool of worker processes for CPU-heavy preview rendering, so storyboard
+    crops/composites and encodes don't block the event loop.
+    """
+
+    def __init__(self, workers=None):
+        self._workers = workers
+        self._pool = None
+        self._manager = None
+
+    @property
+    def workers(self):
+        return (
+            self._workers
+            or config.settings.profile.get_path("preview.workers")
+            or DEFAULT_PREVIEW_WORKERS
+        )
+
+    @property
+    def pool(self):
+        if not self._pool:
+            # spawn so workers don't inherit the event loop / urwid state
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    @property
+    def manager(self):
+        if not self._manager:
+            self._manager = multiprocessing.get_context("spawn").Manager()
+        return self._manager
+
+    async def run(self, fn, *args, cancellable=False):
+        """
+        Run `fn` in the worker pool.  If `cancellable` is set, `fn` is passed
+        a `cancel` event which is set if the awaiting task is cancelled, so
+        the worker can abandon the job instead of running it to completion.
+        """
+        loop = asyncio.get_running_loop()
+        kwargs = {}
+        if cancellable:
+            kwargs["cancel"] = self.manager.Event()
+        future = self.pool.submit(fn, *args, **kwargs)
+        try:
+            return await asyncio.wrap_future(future, loop=loop)
+        except asyncio.CancelledError:
+            if not future.cancel() and cancellable:
+                kwargs["cancel"].set()
+            raise
+
+    def shutdown(self):
+        if self._pool:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+        if self._manager:
+            self._manager.shutdown()
+            self._manager = None
+
+
+renderer = PreviewRenderer()
+
+
+class PreviewCache(object):
+    """
+    Persistent, content-addressed store for generated preview files.
+
+    Entries are keyed by a hash of (source key, preview type, layout
+    parameters) and indexed in a small JSON file alongside the cached files.
+    Files and the index are written atomically, and the least recently used
+    entries are evicted once the cache exceeds its size or age limits.
+    """
+
+    INDEX_FILE = "index.json"
+    INDEX_FLUSH_INTERVAL = 60
+
+    def __init__(self, path=None, max_size=None, max_age=None):
+        self._path = path
+        self._max_size = max_size
+        self._max_age = max_age
+        self._index = None
+        self._last_flush = 0
+        self._dirty = False
+
+    @property
+    def cfg(self):
+        return config.settings.profile.get_path("preview.cache") or AttrDict()
+
+    @property
+    def path(self):
+        if not self._path:
+            self._path = os.path.expanduser(
+                self.cfg.get("path")
+                or os.path.join(xdg.xdg_cache_home(), config.PACKAGE_NAME, "previews")
+            )
+            os.makedirs(self._path, exist_ok=True)
+        return self._path
+
+    @property
+    def max_size(self):
+        return (
+            self._max_size
+            or self.cfg.get("max_size", DEFAULT_CACHE_MAX_SIZE)
+        ) * 1024 * 1024
+
+    @property
+    def max_age(self):
+        return (
+            self._max_age
+            or self.cfg.get("max_age", DEFAULT_CACHE_MAX_AGE)
+        ) * 60 * 60 * 24
+
+    @property
+    def index(self):
+        if self._index is None:
+            try:
+                with open(os.path.join(self.path, self.INDEX_FILE)) as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = dict()
+        return self._index
+
+    @staticmethod
+    def key(source_key, preview_type, params=None):
+        return hashlib.sha1(
+            json.dumps(
+                [source_key, preview_type, params],
+                sort_keys=True, default=str
+            ).encode("utf-8")
+        ).hexdigest()
+
+    def atomic_write(self, dest, write):
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".tmp.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                write(f)
+            os.replace(tmp, dest)
+        except:
+            os.remove(tmp)
+            raise
+
+    def flush(self, force=False):
+        if not (self._dirty or force):
+            return
+        self.atomic_write(
+            os.path.join(self.path, self.INDEX_FILE),
+            lambda f: json.dump(self.index, f)
+        )
+        self._dirty = False
+        self._last_flush = time.time()
+
+    def get(self, source_key, preview_type, params=None):
+
+        key = self.key(source_key, preview_type, params)
+        entry = self.index.get(key)
+        if not entry:
+            return None
+
+        path = os.path.join(self.path, entry["file"])
+        if not os.path.exists(path):
+            del self.index[key]
+            self._dirty = True
+            return None
+
+        entry["accessed"] = time.time()
+        self._dirty = True
+        if time.time() - self._last_flush > self.INDEX_FLUSH_INTERVAL:
+            self.flush()
+
+        return AttrDict(entry.get("meta", {}), path=path)
+
+    def put(self, source_key, preview_type, src, params=None, **meta):
+        """
+        Move the generated file `src` into the cache and return its new path.
+        """
+
+        key = self.key(source_key, preview_type, params)
+        filename = key + os.path.splitext(src)[1]
+        dest = os.path.join(self.path, filename)
+
+        # move into the cache directory first so the final rename is atomic
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".tmp.")
+        os.close(fd)
+        try:
+            shutil.move(src, tmp)
+            os.replace(tmp, dest)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        now = time.time()
+        self.index[key] = dict(
+            file=filename,
+            size=os.path.getsize(dest),
+            created=now,
+            accessed=now,
+            meta=meta
+        )
+        self._dirty = True
+        self.evict()
+        self.flush()
+        return dest
+
+    def remove(self, key):
+        entry = self.index.pop(key, None)
+        if not entry:
+            return
+        try:
+            os.remove(os.path.join(self.path, entry["file"]))
+        except FileNotFoundError:
+            pass
+        self._dirty = True
+
+    def evict(self):
+
+        now = time.time()
+        for key, entry in list(self.index.items()):
+            if now - entry["created"] > self.max_age:
+                self.remove(key)
+
+        total = sum(entry["size"] for entry in self.index.values())
+        for key, entry in sorted(
+                self.index.items(),
+                key=lambda item: item[1]["accessed"]
+        ):
+            if total <= self.max_size:
+                break
+            total -= entry["size"]
+            self.remove(key)
+
+
+cache = PreviewCache()
+
+
+def storyboard_benchmark(duration=600, num_tiles=25, size=(1280, 720)):
+    """
+    Compare per-tile seeking (one ffmpeg per tile) with single-pass
+    extraction on synthetic videos generated with ffmpeg's test source.
+    """
+
+    import subprocess
+
+    tile_size = (size[0]//4, size[1]//4)
+    tmp_dir = tempfile.mkdtemp()
+
+    def legacy(video_file):
+        for n in range(num_tiles):
+            (
+                ffmpeg
+                .input(video_file, ss=(duration*0.95)*(n+1)/num_tiles)
+                .filter("scale", tile_size[0], -2)
+                .output(os.path.join(tmp_dir, f"board.{n:04d}.jpg"), vframes=1)
+                .overwrite_output()
+                .run(quiet=True)
+            )
+
+    def single_pass(video_file, keyframes):
+        proc = extract_frames(
+            video_file, num_tiles, duration, tile_size, keyframes=keyframes
+        )
+        frames = sum(1 for _ in read_frames(proc, tile_size))
+        proc.wait()
+        return frames
+
+    try:
+        for gop in [30, 250]:
+            video_file = os.path.join(tmp_dir, f"test.{gop}.mp4")
+            subprocess.run(
+                [
+                    "ffmpeg", "-y", "-loglevel", "error",
+                    "-f", "lavfi",
+                    "-i", f"testsrc2=duration={duration}:size={size[0]}x{size[1]}:rate=30",
+                    "-g", str(gop), "-c:v", "libx264", "-preset", "ultrafast",
+                    video_file
+                ],
+                check=True
+            )
+            for name, fn in [
+                    ("per-tile seek", lambda: legacy(video_file)),
+                    ("single pass (keyframes)", lambda: single_pass(video_file, True)),
+                    ("single pass (all frames)", lambda: single_pass(video_file, False)),
+            ]:
+                start = time.perf_counter()
+                fn()
+                print(f"gop={gop} {name}: {time.perf_counter() - start:.2f}s")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    storyboard_benchmark()
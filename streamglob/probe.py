@@ -0,0 +1,238 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import asyncio
+import atexit
+import concurrent.futures
+import json
+import tempfile
+import time
+
+import ffmpeg
+from pymediainfo import MediaInfo
+import xdg
+from orderedattrdict import AttrDict
+
+from . import config
+from .state import *
+
+DEFAULT_PROBE_WORKERS = 2
+DEFAULT_BATCH_CONCURRENCY = 1
+
+
+def probe_file(path):
+    """
+    Probe `path` with ffprobe and mediainfo, returning the stream list and
+    duration in seconds.  Files that can't be probed (not media, truncated,
+    etc.) return an empty result rather than raising so that the failure is
+    cached too.
+    """
+
+    result = dict(streams=[], duration=None)
+
+    try:
+        probe = ffmpeg.probe(path)
+    except ffmpeg.Error as e:
+        logger.debug(f"ffprobe failed for {path}: {e}")
+        return result
+    result["streams"] = probe.get("streams", [])
+
+    # stream durations aren't present for MKV, so prefer the container
+    # duration from mediainfo
+    try:
+        media_info = MediaInfo.parse(path)
+        result["duration"] = next(
+            t for t in media_info.tracks
+            if t.track_type == "General"
+        ).duration/1000
+    except (TypeError, StopIteration, OSError):
+        try:
+            result["duration"] = float(probe["format"]["duration"])
+        except (KeyError, TypeError, ValueError):
+            pass
+
+    return result
+
+
+class MediaProbe(object):
+    """
+    Runs media probes off the event loop and remembers the results.
+
+    Results are keyed by path and tagged with the file's size, mtime and
+    inode, so an entry is only reused while the file is unchanged.  They are
+    kept in a JSON file under the cache directory so that revisiting a
+    directory in a later session doesn't re-probe everything.
+    """
+
+    STORE_FILE = "probe.json"
+    FLUSH_INTERVAL = 30
+    MAX_ENTRIES = 50000
+
+    def __init__(self, path=None, workers=None):
+        self._path = path
+        self._workers = workers
+        self._store = None
+        self._executor = None
+        self._pending = dict()
+        self._dirty = False
+        self._last_flush = 0
+        self._batch_semaphore = None
+
+    @property
+    def cfg(self):
+        return config.settings.profile.get_path("preview.probe") or AttrDict()
+
+    @property
+    def path(self):
+        if not self._path:
+            self._path = os.path.expanduser(
+                self.cfg.get("path")
+                or os.path.join(xdg.xdg_cache_home(), config.PACKAGE_NAME)
+            )
+            os.makedirs(self._path, exist_ok=True)
+        return self._path
+
+    @property
+    def workers(self):
+        return self._workers or self.cfg.get("workers", DEFAULT_PROBE_WORKERS)
+
+    @property
+    def executor(self):
+        if not self._executor:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers
+            )
+        return self._executor
+
+    @property
+    def batch_semaphore(self):
+        # leave workers free for probes of the focused file
+        if not self._batch_semaphore:
+            self._batch_semaphore = asyncio.Semaphore(
+                min(
+                    self.cfg.get("batch_concurrency", DEFAULT_BATCH_CONCURRENCY),
+                    self.workers
+                )
+            )
+        return self._batch_semaphore
+
+    @property
+    def store(self):
+        if self._store is None:
+            try:
+                with open(os.path.join(self.path, self.STORE_FILE)) as f:
+                    self._store = json.load(f)
+            except (OSError, ValueError):
+                self._store = dict()
+        return self._store
+
+    @staticmethod
+    def fingerprint(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def flush(self, force=False):
+        if not (self._dirty or force):
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".tmp.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.store, f)
+            os.replace(tmp, os.path.join(self.path, self.STORE_FILE))
+        except:
+            os.remove(tmp)
+            raise
+        self._dirty = False
+        self._last_flush = time.time()
+
+    def get(self, path, fingerprint=None):
+        """
+        Return the cached probe result for `path` if the file hasn't changed
+        since it was probed, otherwise None.  Never blocks on a probe.
+        """
+        path = os.path.abspath(path)
+        entry = self.store.get(path)
+        if not entry:
+            return None
+        if entry["fingerprint"] != (fingerprint or self.fingerprint(path)):
+            return None
+        return AttrDict(entry["result"])
+
+    def put(self, path, fingerprint, result):
+        path = os.path.abspath(path)
+        # re-insert so the oldest entries are the first to go
+        self.store.pop(path, None)
+        self.store[path] = dict(
+            fingerprint=fingerprint,
+            result=result
+        )
+        while len(self.store) > self.MAX_ENTRIES:
+            del self.store[next(iter(self.store))]
+        self._dirty = True
+        if time.time() - self._last_flush > self.FLUSH_INTERVAL:
+            self.flush()
+
+    async def probe(self, path):
+
+        path = os.path.abspath(path)
+        fingerprint = self.fingerprint(path)
+        if not fingerprint:
+            return None
+
+        result = self.get(path, fingerprint)
+        if result is not None:
+            return result
+
+        # share one probe between concurrent callers for the same file
+        key = (path, *fingerprint)
+        if key not in self._pending:
+            self._pending[key] = asyncio.ensure_future(
+                state.event_loop.run_in_executor(
+                    self.executor, probe_file, path
+                )
+            )
+        future = self._pending[key]
+        try:
+            result = await asyncio.shield(future)
+        finally:
+            if future.done():
+                self._pending.pop(key, None)
+
+        self.put(path, fingerprint, result)
+        return AttrDict(result)
+
+    async def probe_all(self, paths):
+        """
+        Probe every file in `paths` that isn't already cached, a few at a
+        time, in the background.
+        """
+
+        async def probe_one(path):
+            async with self.batch_semaphore:
+                try:
+                    await self.probe(path)
+                except Exception as e:
+                    logger.warning(f"probe failed for {path}: {e}")
+
+        paths = [p for p in paths if self.get(p) is None]
+        if not paths:
+            return
+        logger.debug(f"probing {len(paths)} files")
+        try:
+            await asyncio.gather(*(probe_one(p) for p in paths))
+        finally:
+            self.flush()
+
+    def shutdown(self):
+        self.flush()
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+media_probe = MediaProbe()
+atexit.register(media_probe.flush)
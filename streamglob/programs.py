@@ -25,6 +25,11 @@ import shutil
 import json
 import time
 import enum
+import urllib.parse
+import collections
+import hashlib
+import base64
+import binascii
 from aio_mpv_jsonipc import MPV
 from aio_mpv_jsonipc.MPV import MPVError
 if platform.system() != "Windows":
@@ -32,6 +37,7 @@ if platform.system() != "Windows":
 
 from orderedattrdict import AttrDict, Tree
 import bitmath
+import aiohttp
 import youtube_dl
 import streamlink
 from pony.orm import *
@@ -130,6 +136,9 @@ class Program(object):
 
     FOREGROUND = False
 
+    # runs in-process, so doesn't need an executable
+    NATIVE = False
+
     PROGRAM_CMD_RE = re.compile(
         '.+?(?:(?<=[a-z])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])|$)'
     )
@@ -784,6 +793,12 @@ class Downloader(Program):
 
     use_fifo = False
 
+    # arguments that continue a partially downloaded file, if supported
+    RESUME_ARGS = None
+
+    # the class of error (see RetryPolicy) that each exit status stands for
+    RETURNCODE_ERRORS = {}
+
     def __init__(self, path,
                  player_integrated=False,
                  use_fifo=None, *args, **kwargs):
@@ -832,7 +847,14 @@ class Downloader(Program):
                 raise
 
             if outfile and os.path.exists(outfile):
-                raise SGFileExists(f"File {outfile} already exists")
+                if outfile != task.partial:
+                    raise SGFileExists(f"File {outfile} already exists")
+                elif downloader.RESUME_ARGS is None:
+                    os.remove(outfile)
+                else:
+                    logger.info(f"resuming {outfile}")
+                    downloader.extra_args_pre += downloader.RESUME_ARGS
+            task.partial = outfile
 
             downloader.process_args(task, outfile, **kwargs)
 
@@ -891,9 +913,132 @@ class Downloader(Program):
 
         return locator or super().get_locator(source)
 
+class ExtractorMatcher(object):
+    """
+    Decides whether youtube-dl has a dedicated (non-generic) extractor for a
+    URL without instantiating every extractor on each call.
+
+    Extractor classes are indexed by the literal words in their `_VALID_URL`
+    patterns, and the candidate list for each host is computed once and
+    reused.  Extractors whose host portion can't be reduced to literals
+    (wildcard hosts, templated instances, non-URL schemes) are always
+    checked, so the answer is the same as a full scan.
+    """
+
+    URL_CACHE_SIZE = 4096
+
+    HOST_SEGMENT_RE = re.compile(r"://\s*(.*?)(?<!\[\^)/", re.S)
+    SUBDOMAIN_RE = re.compile(r"\(\?:\[[^\]]+\][+*]\\\.\)[?*]")
+    WILDCARD_RE = re.compile(r"\[|\\[wdSs]|(?<!\\)\.|%|\(\?P<")
+    NOISE_RE = re.compile(
+        r"\\[a-zA-Z]|\[[^\]]*\]|\(\?P?<\w+>|\(\?[aiLmsux]+\)|\{[\d,]+\}|.[?*]|#.*$",
+        re.M
+    )
+    TOKEN_RE = re.compile(r"[a-z0-9][a-z0-9-]*")
+    IGNORE_TOKENS = {"www", "com", "org", "net", "http", "https"}
+
+    def __init__(self, module=None):
+        self.module = module or youtube_dl.extractor
+        self._classes = None
+        self._index = None
+        self._unindexed = None
+        self._host_candidates = dict()
+        self.supports_url = functools.lru_cache(
+            maxsize=self.URL_CACHE_SIZE
+        )(self._supports_url)
+
+    @property
+    def classes(self):
+        if self._classes is None:
+            self._classes = [
+                ie for ie in self.module.gen_extractor_classes()
+                if ie.IE_NAME != "generic"
+            ]
+        return self._classes
+
+    def extractor(self, key):
+        return self.module.get_info_extractor(key)
+
+    @classmethod
+    def tokens_for(cls, ie):
+        pattern = getattr(ie, "_VALID_URL", None)
+        if not isinstance(pattern, str):
+            return None
+        segments = cls.HOST_SEGMENT_RE.findall(pattern)
+        if not segments:
+            return None
+        if any(
+            cls.WILDCARD_RE.search(cls.SUBDOMAIN_RE.sub("", segment))
+            for segment in segments
+        ):
+            return None
+        return {
+            token
+            for token in cls.TOKEN_RE.findall(
+                cls.NOISE_RE.sub(" ", pattern.lower())
+            )
+            if len(token) > 1 and token not in cls.IGNORE_TOKENS
+        } or None
+
+    def build_index(self):
+        index = dict()
+        unindexed = set()
+        for ie in self.classes:
+            tokens = self.tokens_for(ie)
+            if not tokens:
+                unindexed.add(ie)
+                continue
+            for token in tokens:
+                index.setdefault(token, set()).add(ie)
+        self._index = index
+        self._unindexed = unindexed
+        self._host_candidates.clear()
+
+    def candidates_for_host(self, host):
+
+        try:
+            return self._host_candidates[host]
+        except KeyError:
+            pass
+
+        if self._index is None:
+            self.build_index()
+
+        matches = set(self._unindexed)
+        for label in set(host.split(".")) - self.IGNORE_TOKENS:
+            # short tokens only count at the start or end of a label so that
+            # e.g. "id" doesn't pull in every extractor for "vidible"
+            for i in range(len(label)):
+                for j in range(i+2, len(label)+1):
+                    if j-i < 4 and i != 0 and j != len(label):
+                        continue
+                    matches.update(self._index.get(label[i:j], ()))
+
+        # preserve youtube-dl's extractor ordering
+        candidates = [ie for ie in self.classes if ie in matches]
+        self._host_candidates[host] = candidates
+        return candidates
+
+    def _supports_url(self, url):
+        try:
+            host = urllib.parse.urlsplit(url).hostname
+        except ValueError:
+            host = None
+        candidates = (
+            self.candidates_for_host(host)
+            if host
+            else self.classes
+        )
+        return any(ie.suitable(url) for ie in candidates)
+
+
+YOUTUBE_DL_EXTRACTORS = ExtractorMatcher()
+
+
 class YouTubeDLDownloader(Downloader):
 
     CMD = "youtube-dl"
+    RESUME_ARGS = ["--continue"]
     PROGRESS_RE = re.compile(
         r"(\d+\.\d+)% of ~?(\d+.\d+\S+)(?: at\s+(\d+\.\d{2}\d*\S+) ETA (\d+:\d+))?"
     )
@@ -908,7 +1053,7 @@ class YouTubeDLDownloader(Downloader):
 
     FORMATS =  AttrDict({
         k: AttrDict(video=v.get("vcodec"), audio=v.get("acodec"))
-        for k, v in youtube_dl.extractor.youtube.YoutubeIE._formats.items()
+        for k, v in YOUTUBE_DL_EXTRACTORS.extractor("Youtube")._formats.items()
     })
 
     output_handling = OutputHandling.WATCH
@@ -937,12 +1082,8 @@ class YouTubeDLDownloader(Downloader):
 
     @classmethod
     def supports_url(cls, url):
-        ies = youtube_dl.extractor.gen_extractors()
-        for ie in ies:
-            if ie.suitable(url) and ie.IE_NAME != 'generic':
-                # Site has dedicated extractor
-                return True
-        return False
+        # Site has dedicated extractor
+        return YOUTUBE_DL_EXTRACTORS.supports_url(url)
 
     async def process_output_line(self, line):
         if not line:
@@ -1188,6 +1329,14 @@ class WgetDownloader(Downloader):
         "--show-progress", "--progress=bar:force"
     ]
 
+    RESUME_ARGS = ["--continue"]
+
+    RETURNCODE_ERRORS = {
+        4: "network",
+        5: "network",
+        8: "server"
+    }
+
     SIZE_LINE_RE=re.compile(
         "Length: (\d+)"
     )
@@ -1248,6 +1397,19 @@ class WgetDownloader(Downloader):
 
 class CurlDownloader(Downloader):
 
+    RESUME_ARGS = ["--continue-at", "-"]
+
+    RETURNCODE_ERRORS = {
+        6: "network",
+        7: "network",
+        18: "network",
+        28: "network",
+        35: "network",
+        52: "network",
+        56: "network",
+        22: "server"
+    }
+
     @property
     def is_simple(self):
         return True
@@ -1260,6 +1422,454 @@ class CurlDownloader(Downloader):
         self.extra_args_post += ["-o", outfile]
 
 
+class NativeProcess(object):
+    """
+    Stands in for the process of a program that runs in-process, so the task
+    manager can wait for it and stop it like any other.
+    """
+
+    pid = None
+
+    def __init__(self, coro):
+        self.returncode = None
+        self.task = state.event_loop.create_task(coro)
+        self.task.add_done_callback(self.exited)
+
+    def exited(self, task):
+        if task.cancelled():
+            self.returncode = -signal.SIGTERM
+        elif task.exception():
+            logger.error("Exception: ", exc_info=task.exception())
+            self.returncode = 1
+        else:
+            self.returncode = task.result()
+
+    async def wait(self):
+        await asyncio.wait([self.task])
+        return self.returncode
+
+    def terminate(self):
+        self.task.cancel()
+
+    def kill(self):
+        self.task.cancel()
+
+
+class HTTPDownloader(Downloader):
+    """
+    Downloads over HTTP(S) without an external program.  The file is fetched
+    in `segment_size` byte ranges over up to `connections` connections at
+    once, and each chunk is written straight to its place in a preallocated
+    file.  How much of each segment has been written is kept in a
+    ".segments" file alongside, so an interrupted download picks up where it
+    left off.  If the server sends a digest of the file (Repr-Digest or
+    Digest), or the task passes a `checksum` like "sha256:<hex>", the file is
+    checked against it once it's complete.
+    """
+
+    NATIVE = True
+
+    # resumes from its segment map rather than by arguments
+    RESUME_ARGS = []
+
+    # exit statuses follow wget's, plus 10 for a file that isn't there
+    RETURNCODE_ERRORS = {
+        4: "network",
+        8: "server",
+        10: "not_found"
+    }
+
+    HEADERS = {
+        # ranges have to be of the file itself, not a compressed copy of it
+        "Accept-Encoding": "identity"
+    }
+
+    DIGEST_ALGORITHMS = {
+        "sha-512": "sha512",
+        "sha-256": "sha256",
+        "sha": "sha1",
+        "md5": "md5"
+    }
+
+    CONTENT_RANGE_RE = re.compile(
+        r"bytes (\d+)-(\d+)/(\d+|\*)"
+    )
+
+    SEGMENT_SIZE = 8*1024*1024
+    CONNECTIONS = 4
+    TIMEOUT = 30
+    PROGRESS_INTERVAL = 0.5
+    SAVE_INTERVAL = 5
+
+    def __init__(self, path, segment_size=None, connections=None,
+                 checksum=None, *args, **kwargs):
+        super().__init__(path, *args, **kwargs)
+        if isinstance(segment_size, str):
+            segment_size = bitmath.parse_string(segment_size).bytes
+        self.segment_size = int(segment_size or self.SEGMENT_SIZE)
+        self.connections = int(connections or self.CONNECTIONS)
+        self.checksum = self.parse_checksum(checksum) if checksum else None
+        self.expected = None
+        self.outfile = None
+        self.fd = None
+        self.total = None
+        self.validator = None
+        self.ranges = False
+        self.done = None
+
+    @classmethod
+    def parse_checksum(cls, checksum):
+        (algorithm, _, value) = checksum.partition(":")
+        algorithm = algorithm.replace("-", "").lower()
+        try:
+            hashlib.new(algorithm)
+            return (algorithm, bytes.fromhex(value))
+        except ValueError:
+            raise SGException(f"invalid checksum: {checksum}")
+
+    @property
+    def is_simple(self):
+        return True
+
+    @classmethod
+    def supports_url(cls, url):
+        return urllib.parse.urlparse(url or "").scheme in ["http", "https"]
+
+    def process_args(self, task, outfile, **kwargs):
+        self.outfile = outfile
+
+    def pipe_to_dst(self):
+        raise SGException(f"{self.cmd} can't stream to another program")
+
+    async def run(self, source=None, *args, **kwargs):
+        if source:
+            self.source = source
+        self.proc = NativeProcess(self.fetch())
+        return self.proc
+
+    @property
+    def segments_file(self):
+        return self.outfile + ".segments"
+
+    def segment(self, index):
+        if not self.ranges:
+            return (0, self.total)
+        start = index * self.segment_size
+        return (start, min(start + self.segment_size, self.total))
+
+    def pending(self):
+        pending = []
+        for index, done in enumerate(self.done):
+            (start, end) = self.segment(index)
+            if end is None or start + done < end:
+                pending.append(index)
+        return pending
+
+    def plan(self, total, validator, ranges=True):
+        self.total = total
+        self.validator = validator
+        self.ranges = ranges and bool(total)
+        self.done = [0] * (
+            -(-total // self.segment_size) if self.ranges else 1
+        )
+
+    def load_segments(self):
+        if not os.path.exists(self.outfile):
+            return False
+        try:
+            with open(self.segments_file) as f:
+                saved = json.load(f)
+            self.segment_size = saved["segment_size"]
+            self.plan(saved["total"], saved["validator"])
+            self.done = saved["done"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        return True
+
+    def save_segments(self):
+        if not (self.ranges and self.done):
+            return
+        tmp = self.segments_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(dict(
+                total=self.total,
+                validator=self.validator,
+                segment_size=self.segment_size,
+                done=self.done
+            ), f)
+        os.replace(tmp, self.segments_file)
+        self.saved_at = time.monotonic()
+
+    def discard_segments(self):
+        self.done = None
+        if os.path.exists(self.segments_file):
+            os.remove(self.segments_file)
+
+    def open_file(self, fresh):
+        self.fd = os.open(
+            self.outfile,
+            os.O_WRONLY | os.O_CREAT | (os.O_TRUNC if fresh else 0),
+            0o644
+        )
+        if fresh and self.total:
+            try:
+                os.posix_fallocate(self.fd, 0, self.total)
+            except (AttributeError, OSError):
+                os.ftruncate(self.fd, self.total)
+
+    def close_file(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def response_validator(self, response):
+        etag = response.headers.get("ETag")
+        # weak validators can't be used for ranges
+        if etag and not etag.startswith("W/"):
+            return etag
+        return response.headers.get("Last-Modified")
+
+    def content_range(self, response):
+        try:
+            (start, end, total) = self.CONTENT_RANGE_RE.match(
+                response.headers.get("Content-Range", "")
+            ).groups()
+        except AttributeError:
+            return (None, None)
+        return (int(start), None if total == "*" else int(total))
+
+    def expected_digest(self, response):
+        if self.checksum:
+            return self.checksum
+        for header in ["Repr-Digest", "Digest"]:
+            for item in response.headers.get(header, "").split(","):
+                (algorithm, _, value) = item.strip().partition("=")
+                algorithm = self.DIGEST_ALGORITHMS.get(algorithm.lower())
+                if not algorithm:
+                    continue
+                try:
+                    return (
+                        algorithm,
+                        base64.b64decode(value.strip(":"), validate=True)
+                    )
+                except (binascii.Error, ValueError):
+                    continue
+        return None
+
+    async def request(self, session, url, offset=None, end=None):
+        headers = {}
+        if offset is not None:
+            headers["Range"] = f"bytes={offset}-{end-1 if end else ''}"
+            if self.validator:
+                headers["If-Range"] = self.validator
+        response = await session.get(url, headers=headers)
+        response.raise_for_status()
+        return response
+
+    def report_progress(self, force=False):
+        now = time.monotonic()
+        elapsed = now - self.reported_at
+        if elapsed < self.PROGRESS_INTERVAL and not force:
+            return
+        if elapsed:
+            rate = (self.received - self.reported) / elapsed
+            self.rate = rate if self.rate is None else (self.rate + rate) / 2
+        (self.reported, self.reported_at) = (self.received, now)
+
+        self.progress.dled = bitmath.Byte(self.received)
+        self.progress.rate = bitmath.Byte(self.rate or 0)
+        if self.total:
+            remaining = self.total - self.received
+            self.progress.total = bitmath.Byte(self.total)
+            self.progress.remaining = bitmath.Byte(remaining)
+            self.progress.pct = self.received / self.total
+            if self.rate:
+                self.progress.eta = timedelta(seconds=int(remaining / self.rate))
+        if now - self.saved_at >= self.SAVE_INTERVAL:
+            self.save_segments()
+
+    async def fetch_segment(self, session, url, index, response=None):
+        (start, end) = self.segment(index)
+        while True:
+            offset = start + self.done[index]
+            if end is not None and offset >= end:
+                return
+            if response is None:
+                response = await self.request(session, url, offset, end)
+                if self.content_range(response)[0] != offset:
+                    response.close()
+                    raise SGException(f"{url} changed since the download started")
+            began = offset
+            async with response:
+                async for chunk in response.content.iter_any():
+                    if end is not None and offset + len(chunk) > end:
+                        chunk = memoryview(chunk)[:end - offset]
+                    view = memoryview(chunk)
+                    while view:
+                        written = os.pwrite(self.fd, view, offset)
+                        view = view[written:]
+                        offset += written
+                    self.done[index] += len(chunk)
+                    self.received += len(chunk)
+                    self.report_progress()
+                    if offset == end:
+                        break
+            response = None
+            if not self.ranges:
+                if end is not None and offset < end:
+                    raise ConnectionError(f"{url} ended {end - offset} bytes early")
+                return
+            if offset == began:
+                raise ConnectionError(f"{url} ended {end - offset} bytes early")
+
+    async def fetch_segments(self, session, url):
+        resumed = self.load_segments()
+        if resumed:
+            pending = self.pending()
+            if not pending:
+                return
+            (start, end) = self.segment(pending[0])
+            offset = start + self.done[pending[0]]
+        else:
+            (offset, end) = (0, self.segment_size)
+
+        try:
+            response = await self.request(session, url, offset, end)
+        except aiohttp.ClientResponseError as e:
+            if e.status != 416:
+                raise
+            # the file is empty, or got smaller since the last attempt
+            response = await self.request(session, url)
+
+        (start, total) = self.content_range(response)
+        if response.status == 206 and total is None:
+            # no size given, so no way to divide it up
+            response.close()
+            response = await self.request(session, url)
+
+        self.expected = self.expected_digest(response)
+        fresh = True
+        if response.status == 206:
+            validator = self.response_validator(response)
+            if resumed and (total, validator) == (self.total, self.validator):
+                fresh = False
+            else:
+                self.plan(total, validator)
+        else:
+            # no ranges, so the whole file comes in one go
+            self.plan(response.content_length, None, ranges=False)
+        if resumed and fresh:
+            logger.info(f"{url} has changed, starting over")
+            os.remove(self.segments_file)
+
+        self.open_file(fresh)
+        self.received = self.reported = sum(self.done)
+        self.reported_at = self.saved_at = time.monotonic()
+        self.rate = None
+
+        pending = collections.deque(self.pending())
+        if response.status == 206 and not (
+                pending
+                and start == self.segment(pending[0])[0] + self.done[pending[0]]
+        ):
+            # it isn't where the first pending segment carries on from, e.g.
+            # the file changed and we're starting over
+            response.close()
+            response = None
+
+        async def fetch_pending(response=None):
+            # the first one carries on with the response we already have,
+            # which is for the first pending segment
+            while pending:
+                await self.fetch_segment(session, url, pending.popleft(), response)
+                response = None
+
+        workers = [
+            state.event_loop.create_task(
+                fetch_pending(response if i == 0 else None)
+            )
+            for i in range(min(self.connections, len(pending)))
+        ]
+        try:
+            if workers:
+                (done, _) = await asyncio.wait(
+                    workers, return_when=asyncio.FIRST_EXCEPTION
+                )
+                for worker in done:
+                    worker.result()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            if response is not None:
+                response.close()
+        self.report_progress(force=True)
+
+    @staticmethod
+    def file_digest(path, algorithm):
+        digest = hashlib.new(algorithm)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024*1024), b""):
+                digest.update(block)
+        return digest.digest()
+
+    async def verify(self):
+        if not self.expected:
+            return
+        (algorithm, expected) = self.expected
+        self.progress.status = "verifying"
+        digest = await state.event_loop.run_in_executor(
+            None, self.file_digest, self.outfile, algorithm
+        )
+        self.progress.status = None
+        if digest != expected:
+            os.remove(self.outfile)
+            raise SGChecksumMismatch(f"{self.outfile} failed {algorithm} check")
+
+    async def fetch(self):
+
+        from .session import USER_AGENT
+
+        url = self.source_args[0]
+        self.progress.dest = self.outfile
+        self.expected = self.checksum
+        try:
+            async with aiohttp.ClientSession(
+                    headers=dict(self.HEADERS, **{"User-Agent": USER_AGENT}),
+                    timeout=aiohttp.ClientTimeout(
+                        sock_connect=self.TIMEOUT, sock_read=self.TIMEOUT
+                    ),
+                    connector=aiohttp.TCPConnector(limit=self.connections),
+                    auto_decompress=False
+            ) as session:
+                await self.fetch_segments(session, url)
+            self.close_file()
+            await self.verify()
+            self.discard_segments()
+        except aiohttp.ClientResponseError as e:
+            logger.warning(f"{url}: {e.status} {e.message}")
+            return 10 if e.status in [404, 410] else 8
+        except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError) as e:
+            logger.warning(f"{url}: {e!r}")
+            return 4
+        except SGException as e:
+            # what we have can't be trusted, so the next attempt starts over
+            logger.warning(e)
+            self.discard_segments()
+            return 1
+        except OSError as e:
+            logger.error(f"{self.outfile}: {e}")
+            return 3
+        finally:
+            self.close_file()
+            if os.path.exists(self.outfile):
+                self.save_segments()
+            else:
+                # stopped, and the task's removed the file, so there's
+                # nothing left to resume
+                self.discard_segments()
+        return 0
+
 
 class Postprocessor(Program):
 
@@ -1314,9 +1924,6 @@ def load():
                 "command",
                 distutils.spawn.find_executable(name)
             )
-            if not path and not cfg.disabled:
-                logger.warning(f"couldn't find command for {name}")
-                continue
             # First, try to find by "type" config value, if present
             try:
                 klass = next(
@@ -1334,6 +1941,9 @@ def load():
                 except StopIteration:
                     # Give up and make it a generic program
                     klass = pcls
+            if not path and not klass.NATIVE and not cfg.disabled:
+                logger.warning(f"couldn't find command for {name}")
+                continue
             if cfg.get("disabled") == True:
                 continue
             state.PROGRAMS[ptype][name] = ProgramDef(
@@ -1349,8 +1959,8 @@ def load():
             cfg = config.settings.profile[cfgkey][name]
             if name in state.PROGRAMS[ptype] or (cfg and cfg.disabled == True):
                 continue
-            path = distutils.spawn.find_executable(name)
-            if path:
+            path = None if klass.NATIVE else distutils.spawn.find_executable(name)
+            if path or klass.NATIVE:
                 state.PROGRAMS[ptype][name] = ProgramDef(
                     cls=klass,
                     name=name,
@@ -1439,6 +2049,100 @@ async def cat_test():
 
 
 
+def supports_url_benchmark(count=10000):
+
+    import random
+
+    urls = [
+        t["url"]
+        for ie in YOUTUBE_DL_EXTRACTORS.classes
+        for t in list(getattr(ie, "_TESTS", [])) + [getattr(ie, "_TEST", None)]
+        if t
+    ]
+    urls += [
+        f"https://site{i}.example.org/posts/{i}.html"
+        for i in range(len(urls))
+    ]
+    random.shuffle(urls)
+    urls = (urls * (count // len(urls) + 1))[:count]
+
+    def legacy(url):
+        return any(
+            ie.suitable(url) and ie.IE_NAME != "generic"
+            for ie in youtube_dl.extractor.gen_extractors()
+        )
+
+    matcher = ExtractorMatcher()
+    for name, fn in [("legacy", legacy), ("matcher", matcher.supports_url)]:
+        start = time.perf_counter()
+        results = [fn(url) for url in urls]
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {len(urls)} urls in {elapsed:.3f}s ({sum(results)} supported)")
+
+
+def http_downloader_benchmark(size=32*1024*1024, latency=0.1,
+                              rate=4*1024*1024, connections=[1, 2, 4, 8]):
+    """
+    Download `size` bytes with HTTPDownloader from a local server that
+    waits `latency` seconds before each response and sends at most `rate`
+    bytes per second on each connection, like a distant host would, using
+    each number of `connections`.  The server runs in the same process, so
+    its work is counted in the CPU time too.
+    """
+
+    from aiohttp import web
+
+    data = os.urandom(size)
+
+    async def handle(request):
+        await asyncio.sleep(latency)
+        (start, end) = (0, size)
+        match = re.match(r"bytes=(\d+)-(\d*)", request.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or size - 1) + 1, size)
+        response = web.StreamResponse(
+            status=206 if match else 200,
+            headers={"Content-Range": f"bytes {start}-{end-1}/{size}"} if match else {}
+        )
+        response.content_length = end - start
+        await response.prepare(request)
+        for offset in range(start, end, 64*1024):
+            chunk = data[offset:min(offset + 64*1024, end)]
+            await response.write(chunk)
+            await asyncio.sleep(len(chunk) / rate)
+        return response
+
+    async def run():
+        state.event_loop = asyncio.get_running_loop()
+        app = web.Application()
+        app.router.add_get("/file", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for count in connections:
+                downloader = HTTPDownloader(
+                    None, connections=count, segment_size=size // 16
+                )
+                downloader.process_args(None, os.path.join(tmp, f"{count}.bin"))
+                downloader.source = f"http://127.0.0.1:{port}/file"
+                start = time.perf_counter()
+                cpu = time.process_time()
+                proc = await downloader.run()
+                returncode = await proc.wait()
+                elapsed = time.perf_counter() - start
+                print(f"{count} connections: {size/elapsed/1024/1024:.1f}MiB/s, "
+                      f"cpu {(time.process_time() - cpu)*1000/(size/1024/1024):.2f}ms/MiB "
+                      f"(exit status {returncode})")
+        await runner.cleanup()
+
+    asyncio.run(run())
+
+
 def postprocessor_test():
 
     # p = next(Postprocessor.get("test"))
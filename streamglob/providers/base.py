@@ -7,6 +7,8 @@ import asyncio
 import dataclasses
 import re
 from itertools import chain
+import collections
+import time
 from collections.abc import Mapping
 # import textwrap
 # import tempfile
@@ -18,6 +20,7 @@ from panwid.dialog import *
 from panwid.keymap import *
 from pydantic import BaseModel
 import imgkit
+from aiolimiter import AsyncLimiter
 
 # from .widgets import *
 from . import widgets
@@ -31,6 +34,7 @@ from ..programs import Player, Downloader
 from .. import model
 from .. import config
 from .. import utils
+from ..previews import cache as previews_cache
 from  ..utils import classproperty
 
 
@@ -210,6 +214,7 @@ class BaseProvider(
 
     MEDIA_TYPES = None
     RPC_METHODS = []
+    MAX_TITLE_TOKENS = 10000
 
     def __init__(self, *args, **kwargs):
         self._view = None
@@ -272,11 +277,20 @@ class BaseProvider(
             group={"width": 20, "truncate": True},
         )
 
+    def title_tokens(self, title):
+        # rows with the same title share the work of tokenizing it
+        if getattr(self, "_title_tokens_version", None) != self.rules.version:
+            self._title_tokens = dict()
+            self._title_tokens_version = self.rules.version
+        if title not in self._title_tokens:
+            if len(self._title_tokens) >= self.MAX_TITLE_TOKENS:
+                self._title_tokens.clear()
+            self._title_tokens[title] = self.rules.tokenize(title)
+        return self._title_tokens[title]
+
     def token_value(self, token, default=None):
         def inner(table, row):
-            tokens = self.rules.tokenize(
-                row.title
-            )
+            tokens = self.title_tokens(row.title)
             return next(
                 (
                     value
@@ -342,6 +356,9 @@ class BaseProvider(
     def load_rules(self):
 
         self._conf_rules = None
+        if getattr(self, "rules", None):
+            # make sure changes waiting to be written aren't lost
+            self.rules.flush()
         self.rules = HighlightRuleConfig(
             os.path.join(
                 self.conf_dir,
@@ -844,6 +861,16 @@ class PreviewState(object):
         self.previews = DefaultAttrDict(lambda: asyncio.Future())
         for stage in stages:
             self.previews[stage.mode] = asyncio.Future()
+        # running preview tasks -> whether they're foreground (focused row)
+        self.tasks = dict()
+        # set while this is the focused row, so its background work stops
+        # waiting its turn
+        self.promoted = asyncio.Event()
+
+    def cancel(self, foreground_only=False):
+        for task, foreground in list(self.tasks.items()):
+            if foreground or not foreground_only:
+                task.cancel()
 
     def __getitem__(self, key):
         return self.previews.__getitem__(key)
@@ -872,6 +899,319 @@ class PreviewState(object):
 
 
 
+class PreviewRegistry(object):
+    """
+    Bounded, least-recently-used map of source key -> PreviewState.
+
+    Evicting a source or moving focus away from it cancels its preview work,
+    which propagates into worker processes and ffmpeg subprocesses.  Work
+    for the focused row takes priority: background (prefetch) jobs wait
+    while any foreground job is running, unless their own row gets the focus.
+    """
+
+    DEFAULT_MAX_SIZE = 50
+
+    def __init__(self, view):
+        self.view = view
+        self.states = collections.OrderedDict()
+        self.focused = None
+        self.foreground_jobs = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.busy = asyncio.Event()
+        self.metrics = AttrDict(
+            started=0,
+            completed=0,
+            cancelled=0,
+            evicted=0,
+            abandoned_seconds=0.0
+        )
+
+    @property
+    def max_size(self):
+        return self.view.config.auto_preview.get("max_jobs", self.DEFAULT_MAX_SIZE)
+
+    def __len__(self):
+        return len(self.states)
+
+    def __contains__(self, key):
+        return key in self.states
+
+    def __getitem__(self, key):
+        if key in self.states:
+            self.states.move_to_end(key)
+        else:
+            self.states[key] = PreviewState(self.view.preview_stages)
+            if key == self.focused:
+                self.states[key].promoted.set()
+            self.evict()
+        return self.states[key]
+
+    def evict(self):
+        for key in list(self.states):
+            if len(self.states) <= self.max_size:
+                break
+            if key == self.focused:
+                continue
+            self.states.pop(key).cancel()
+            self.metrics.evicted += 1
+
+    def focus(self, key):
+        self.focused = key
+        for k, preview_state in self.states.items():
+            if k == key:
+                # anything already running for this row (e.g. a prefetch)
+                # is now foreground work
+                for task in preview_state.tasks:
+                    preview_state.tasks[task] = True
+                preview_state.promoted.set()
+            else:
+                preview_state.promoted.clear()
+                preview_state.cancel(foreground_only=True)
+
+    def clear(self):
+        for preview_state in self.states.values():
+            preview_state.cancel()
+        self.states.clear()
+
+    async def wait_turn(self, preview_state):
+        """
+        Wait until no foreground work is running, or until the row
+        `preview_state` is for gets the focus.
+        """
+
+        if self.idle.is_set() or (preview_state and preview_state.promoted.is_set()):
+            return
+        waiters = [asyncio.ensure_future(self.idle.wait())]
+        if preview_state:
+            waiters.append(asyncio.ensure_future(preview_state.promoted.wait()))
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+
+    async def run(self, key, coro, foreground=True):
+        """
+        Track `coro` as preview work for `key`, recording how long it ran
+        if it ends up being cancelled.
+        """
+
+        task = asyncio.current_task()
+        preview_state = self.states.get(key)
+        if preview_state:
+            preview_state.tasks[task] = foreground
+
+        if not foreground:
+            try:
+                await self.wait_turn(preview_state)
+            except asyncio.CancelledError:
+                coro.close()
+                if preview_state:
+                    preview_state.tasks.pop(task, None)
+                self.metrics.cancelled += 1
+                raise
+            if preview_state:
+                # its row may have been focused while it waited
+                foreground = preview_state.tasks.get(task, foreground)
+
+        if foreground:
+            self.foreground_jobs += 1
+            self.idle.clear()
+            self.busy.set()
+
+        self.metrics.started += 1
+        start = time.monotonic()
+        try:
+            result = await coro
+            self.metrics.completed += 1
+            return result
+        except asyncio.CancelledError:
+            self.metrics.cancelled += 1
+            self.metrics.abandoned_seconds += time.monotonic() - start
+            logger.debug(f"preview work abandoned: {self.metrics}")
+            raise
+        finally:
+            if preview_state:
+                preview_state.tasks.pop(task, None)
+            if foreground:
+                self.foreground_jobs -= 1
+                if not self.foreground_jobs:
+                    self.idle.set()
+                    self.busy.clear()
+
+
+
+class PreviewPrefetcher(object):
+    """
+    Warms previews for the rows the user is likely to land on next, based on
+    the direction and speed they're moving through the table.  Prefetches
+    run in the background under a concurrency limit (CPU) and a rate limit
+    on new jobs (bandwidth), and are cancelled when the rows they're for
+    fall out of the predicted window.
+    """
+
+    HISTORY_SIZE = 5
+
+    DEFAULT_ROWS = 2
+    DEFAULT_MAX_ROWS = 5
+    DEFAULT_HORIZON = 1 # seconds of scrolling to look ahead
+    DEFAULT_MAX_VELOCITY = 10 # rows/sec, faster than this waits for a pause
+    DEFAULT_SETTLE = 0.5
+    DEFAULT_CONCURRENCY = 1
+    DEFAULT_RATE = 30 # jobs per minute
+
+    def __init__(self, view):
+        self.view = view
+        self.history = collections.deque(maxlen=self.HISTORY_SIZE)
+        self.tasks = dict()
+        self.schedule_task = None
+        self._semaphore = None
+        self._limiter = None
+
+    @property
+    def cfg(self):
+        cfg = self.view.config.auto_preview.get("prefetch", Tree())
+        if not isinstance(cfg, Mapping):
+            cfg = Tree(rows=(self.DEFAULT_ROWS if cfg else 0))
+        return cfg
+
+    @property
+    def enabled(self):
+        return self.cfg.get("rows", self.DEFAULT_ROWS) > 0
+
+    @property
+    def semaphore(self):
+        if not self._semaphore:
+            self._semaphore = asyncio.Semaphore(
+                self.cfg.get("concurrency", self.DEFAULT_CONCURRENCY)
+            )
+        return self._semaphore
+
+    @property
+    def limiter(self):
+        if not self._limiter:
+            self._limiter = AsyncLimiter(
+                self.cfg.get("rate", self.DEFAULT_RATE), 60
+            )
+        return self._limiter
+
+    @property
+    def velocity(self):
+        if len(self.history) < 2:
+            return 0
+        (t0, p0), (t1, p1) = self.history[0], self.history[-1]
+        if t1 == t0:
+            return 0
+        return (p1 - p0) / (t1 - t0)
+
+    @property
+    def direction(self):
+        if len(self.history) < 2:
+            return 1
+        delta = self.history[-1][1] - self.history[-2][1]
+        return -1 if delta < 0 else 1
+
+    def predict(self, position):
+        speed = abs(self.velocity)
+        rows = self.cfg.get("rows", self.DEFAULT_ROWS)
+        count = min(
+            max(rows, round(rows + speed * self.cfg.get("horizon", self.DEFAULT_HORIZON))),
+            self.cfg.get("max_rows", self.DEFAULT_MAX_ROWS)
+        )
+        return [
+            p for p in (
+                position + self.direction * n
+                for n in range(1, count+1)
+            )
+            if 0 <= p < len(self.view)
+        ]
+
+    def on_focus(self, position):
+
+        if not self.enabled or position is None:
+            return
+
+        self.history.append((time.monotonic(), position))
+        if self.schedule_task:
+            self.schedule_task.cancel()
+        self.schedule_task = state.event_loop.create_task(
+            self.schedule(position)
+        )
+
+    async def schedule(self, position):
+
+        # if the user is flying through the list, wait for them to settle
+        # before spending anything on rows they'll probably skip past
+        if abs(self.velocity) > self.cfg.get("max_velocity", self.DEFAULT_MAX_VELOCITY):
+            await asyncio.sleep(self.cfg.get("settle", self.DEFAULT_SETTLE))
+            self.history.clear()
+            self.history.append((time.monotonic(), position))
+
+        wanted = set(self.predict(position))
+        for p in list(self.tasks):
+            if p not in wanted and p != position:
+                self.tasks.pop(p).cancel()
+
+        for p in sorted(wanted, key=lambda p: abs(p - position)):
+            if p not in self.tasks:
+                task = state.event_loop.create_task(self.prefetch(p))
+                task.add_done_callback(
+                    lambda t, p=p: self.tasks.get(p) is t and self.tasks.pop(p)
+                )
+                self.tasks[p] = task
+
+    async def resolve(self, listing):
+        """
+        Look up the stream locators of a listing that doesn't have them yet,
+        as focusing it would.  Returns True if its sources have changed.
+        """
+        if (getattr(listing, "is_inflated", True)
+            or not getattr(listing, "should_inflate_on_focus", True)):
+            return False
+        with db_session:
+            listing = listing.attach()
+        return await listing.inflate()
+
+    async def prefetch(self, position):
+
+        try:
+            listing = self.view.get_listing(position)
+        except (IndexError, TypeError, AttributeError):
+            return
+        if not listing:
+            return
+
+        async with self.semaphore:
+            async with self.limiter:
+                if await self.resolve(listing):
+                    self.view.invalidate_rows([listing.media_listing_id])
+                    listing = self.view.get_listing(position)
+                try:
+                    source = self.view.get_source(listing)
+                except (IndexError, TypeError, AttributeError):
+                    return
+                if not source:
+                    return
+                for cfg in self.view.preview_stages:
+                    if cfg.mode in [None, "default"] or cfg.prefetch is False:
+                        continue
+                    if cfg.media_types and source.media_type not in cfg.media_types:
+                        continue
+                    logger.debug(f"prefetch: {position} {cfg.mode}")
+                    await self.view.get_preview(
+                        [cfg], listing, source, foreground=False
+                    )
+
+    def cancel(self):
+        if self.schedule_task:
+            self.schedule_task.cancel()
+            self.schedule_task = None
+        while len(self.tasks):
+            (_, task) = self.tasks.popitem()
+            task.cancel()
+
+
 @keymapped()
 class SynchronizedPlayerMixin(object):
 
@@ -899,6 +1239,7 @@ class SynchronizedPlayerMixin(object):
         self.playlist_lock = asyncio.Lock()
         self.preview_lock = asyncio.Lock()
         self.preview_stage = -1
+        self.prefetcher = PreviewPrefetcher(self)
 
     @property
     def preview_stage_mode(self):
@@ -907,10 +1248,7 @@ class SynchronizedPlayerMixin(object):
     @property
     def previews(self):
         if not hasattr(self, "_previews"):
-            self._previews = DefaultAttrDict(
-                lambda: PreviewState(self.preview_stages)
-            )
-            # self._previews = DefaultAttrDict(lambda: DefaultAttrDict(lambda: asyncio.Future()))
+            self._previews = PreviewRegistry(self)
         return self._previews
 
     def on_requery(self, source, count):
@@ -919,6 +1257,7 @@ class SynchronizedPlayerMixin(object):
         while len(self.pending_event_tasks):
             t = self.pending_event_tasks.pop()
             t.cancel()
+        self.prefetcher.cancel()
         # if state.get("tui_enabled"):
         #     state.event_loop.create_task(self.preview_all())
         self.enable_focus_handler()
@@ -1175,6 +1514,10 @@ borderw={border_width}:shadowx={shadow_x}:shadowy={shadow_y}:shadowcolor={shadow
     def playlist_position(self):
         return self.row_to_playlist_pos(self.focus_position)
 
+    @property
+    def prefetch_position(self):
+        return self.focus_position
+
     async def playlist_position_changed(self, pos):
         pass
 
@@ -1204,21 +1547,39 @@ borderw={border_width}:shadowx={shadow_x}:shadowy={shadow_y}:shadowcolor={shadow
         # await self.playlist_replace(source.locator, idx=position)
 
 
-    async def get_preview(self, stages, listing, source):
+    def preview_cache_params(self, cfg, source):
+        return dict(cfg)
+
+    async def get_preview(self, stages, listing, source, foreground=True):
 
         previews = self.previews[source.key]
 
         async def generate_preview(cfg):
 
+            params = self.preview_cache_params(cfg, source)
+            cached = previews_cache.get(source.key, cfg.mode, params)
+            if cached:
+                previews[cfg.mode].set_result(cached.path)
+                return
+
             # import ipdb; ipdb.set_trace()
             preview_fn = getattr(self, f"preview_content_{cfg.mode}")
 
             try:
-                res = await preview_fn(cfg, listing, source)
+                res = await self.previews.run(
+                    source.key,
+                    preview_fn(cfg, listing, source),
+                    foreground=foreground
+                )
+                if (isinstance(res, str)
+                    and res.startswith(state.tmp_dir)
+                    and os.path.isfile(res)):
+                    res = previews_cache.put(source.key, cfg.mode, res, params)
                 previews[cfg.mode].set_result(res)
             except asyncio.exceptions.CancelledError:
-                logger.warning("CancelledError from preview function")
+                logger.debug("CancelledError from preview function")
                 previews[cfg.mode] = asyncio.Future()
+                raise
 
         # import ipdb; ipdb.set_trace()
 
@@ -1231,7 +1592,9 @@ borderw={border_width}:shadowx={shadow_x}:shadowy={shadow_y}:shadowcolor={shadow
                     if previews[cfg.mode].done() and previews[cfg.mode].result():
                         break
 
-        await self.update_video_filters()
+        if foreground:
+            # background work mustn't touch the filters of what's playing
+            await self.update_video_filters()
         return previews[cfg.mode]
 
     @property
@@ -1353,7 +1716,12 @@ borderw={border_width}:shadowx={shadow_x}:shadowy={shadow_y}:shadowcolor={shadow
         # )
         # import ipdb; ipdb.set_trace()
         if self.provider.auto_preview_enabled:
+            try:
+                self.previews.focus(self.selected_source.key)
+            except (AttributeError, IndexError, TypeError):
+                pass
             state.event_loop.create_task(self.sync_playlist_position())
+            self.prefetcher.on_focus(self.prefetch_position)
         if len(self):
             with db_session:
                 try:
@@ -1376,6 +1744,8 @@ borderw={border_width}:shadowx={shadow_x}:shadowy={shadow_y}:shadowcolor={shadow
         while len(self.pending_event_tasks):
             t = self.pending_event_tasks.pop()
             t.cancel()
+        self.prefetcher.cancel()
+        self.previews.focus(None)
         super().on_deactivate()
 
     def on_player_load_failed(self, url):
@@ -3,6 +3,7 @@ logger = logging.getLogger(__name__)
 
 import os
 import re
+import json
 from datetime import datetime
 from dataclasses import *
 import functools
@@ -24,6 +25,9 @@ import wand.image
 from wand.color import Color
 from .. import model
 from .. import utils
+from ..query import (
+    FilterQuery, compile_filter, filter_fields, listing_columns, parse_filter
+)
 
 from .base import *
 
@@ -172,13 +176,17 @@ class FeedMediaChannelMixin(object):
 
     @property
     def listing_count(self):
-        with db_session:
-            return self.items.select().count()
+        def count():
+            with db_session:
+                return self.items.select().count()
+        return model.query_cache.get(("listing_count", self.channel_id), count)
 
     @property
     def unread_count(self):
-        with db_session:
-            return self.items.select(lambda i: not i.read).count()
+        def count():
+            with db_session:
+                return self.items.select(lambda i: not i.read).count()
+        return model.query_cache.get(("unread_count", self.channel_id), count)
 
 
 
@@ -290,6 +298,9 @@ class FeedMediaListing(FeedMediaListingMixin, model.ChannelMediaListing, model.T
     fetched = Required(datetime, default=datetime.now)
     read = Optional(datetime)
 
+    # serves the next unread seek and the per-feed unread lookups
+    composite_index(model.ChannelMediaListing.channel, read, created)
+
 
 class FeedMediaSourceMixin(object):
 
@@ -470,15 +481,7 @@ class CachedFeedProviderDataTable(SynchronizedPlayerProviderMixin, ProviderDataT
         return self.CachedFeedProvideDetailTable(self, *args, **kwargs)
 
     def query_result_count(self):
-        if self.update_count:
-            with db_session:
-                if self.provider.items_query is None:
-                    return 0
-                # self._row_count = len(self.provider.feed.items)
-                self._row_count = self.provider.items_query.count()
-                logger.debug(f"row count: {self._row_count}")
-                self.update_count = False
-        return self._row_count
+        return self.provider.query_result_count()
 
     def unseen_sources(self, row):
         with db_session:
@@ -589,19 +592,44 @@ class CachedFeedProviderDataTable(SynchronizedPlayerProviderMixin, ProviderDataT
 
     @staticmethod
     def is_unread(listing):
-        return not listing.data_source.attach().read
+        return not listing.data.read
 
     async def next_unread(self, no_sources=False):
-        return await self.next_matching(self.is_unread, no_sources=no_sources)
+        return await self.next_matching(
+            self.is_unread, no_sources=no_sources,
+            query=FilterQuery("read IS NULL")
+        )
+
+    def seek_matching(self, query):
+        """
+        Load the page starting with the first listing matching `query` past
+        the loaded rows, and return its index, or None if there isn't one.
+        """
+        if not len(self):
+            return None
+        after = getattr(self[len(self)-1].data, self.sort_by[0])
+        found = self.provider.seek_listing(query, after, sort=self.sort_by)
+        if not found:
+            return None
+        (idx, cursor) = found
+        if cursor == after:
+            self.load_more(len(self)-1)
+        else:
+            # skip whatever is in between instead of paging through it
+            self.df.delete_all_rows()
+            self.pagination_cursor = cursor
+            self.requery(offset=self.limit)
+        return idx
 
-    async def next_matching(self, predicate, no_sources=False):
+    async def next_matching(self, predicate, no_sources=False, query=None):
         # FIXME: this is sort of a mish-mash between a general purpose
         # function and one particular to marking read and moving to the next
         # unread.  Will require some cleanup if it's used for other purposes.
+        #
+        # `query` is the SQL equivalent of `predicate`, used to find a match
+        # beyond the rows that are loaded.
 
         idx = None
-        count = 0
-        last_count = None
 
         row = self.selection
         if not row:
@@ -629,7 +657,9 @@ class CachedFeedProviderDataTable(SynchronizedPlayerProviderMixin, ProviderDataT
             row.close_details()
             row.clear_attr("unread")
 
-            old_pos = self.focus_position
+            # before anything below replaces the rows
+            await self.mark_item_read(self.focus_position, no_signal=True)
+
             try:
                 idx = next(
                     r.data.media_listing_id
@@ -639,46 +669,23 @@ class CachedFeedProviderDataTable(SynchronizedPlayerProviderMixin, ProviderDataT
                     )
                     if predicate(r)
                 )
-                # idx = next(
-                #     r.data.media_listing_id
-                #     for r in self[self.focus_position+1:]
-                #     if predicate(r)
-                # )
             except (StopIteration, AttributeError):
-                if self.focus_position == len(self)-1:
-                    if self.selection.data["read"]:
+                if query:
+                    idx = self.seek_matching(query)
+                if idx is None:
+                    if (self.sort_by == ("created", True)
+                        and self.focus_position == len(self)-1
+                        and await self.provider.view.body.update(
+                            force=True, resume=True
+                        )):
+                        self.reset()
+                    else:
                         if self.sort_by == ("created", False):
                             self.provider.view.columns.focus_position = 0
-                            self.provider.view.channels.cycle_unread(1)
-                            # self.provider.view.channels.advance(skip=True)
-                            # self._emit("next_feed")
-                        elif self.sort_by == ("created", True):
-                            updated = self.load_more(self.focus_position)
-                            if updated:
-                                if self.focus_position < len(self) - 1:
-                                    self.focus_position += 1
-                            else:
-                                new = await self.provider.view.body.update(
-                                    force=True, resume=True
-                                )
-                                if new:
-                                    self.reset()
-                                else:
-                                    # await self.mark_item_read(self.focus_position, no_signal=True)
-                                    self.provider.view.channels.cycle_unread()
-                                    # break
-                                    # self._emit("unread_change", listing.channel.detach())
-                                    # return
-
-                else:
-                    # self.focus_position = len(self)-1
-                    self.provider.view.channels.cycle_unread()
-
-            await self.mark_item_read(self.focus_position, no_signal=True)
+                        self.provider.view.channels.cycle_unread()
 
             if idx:
                 pos = self.index_to_position(idx)
-                focus_position_orig = self.focus_position
                 self.focus_position = pos
                 self.mark_read_on_focus = True
                 self._modified()
@@ -855,7 +862,7 @@ class FeedProvider(BaseProvider):
         self.view.selected_channels = value
 
     @property
-    def selected_channels(self):
+    def selected_locators(self):
         selection = self.view.selected_channels
         def parse_node(node):
 
@@ -866,13 +873,16 @@ class FeedProvider(BaseProvider):
 
         # logger.info(f"selection: {selection}")
         if selection:
-            locators = list(chain.from_iterable([
+            return list(chain.from_iterable([
                 parse_node(node)
                 for node in selection
             ]))
         else:
-            locators = []
+            return []
 
+    @property
+    def selected_channels(self):
+        locators = self.selected_locators
         # logger.info(f"locators: {locators}")
         with db_session:
             return list(
@@ -1310,7 +1320,10 @@ class CachedFeedProvider(BackgroundTasksMixin, FeedProvider):
         super().__init__(*args, **kwargs)
         self.search_filter = None
         self.items_query = None
+        self.items_query_state = None
+        self.feed_items_state = None
         self.custom_filters = AttrDict()
+        self._channel_selection = None
         self.filters["status"].connect("changed", self.on_status_change)
         self.filters["custom"].connect("changed", self.on_custom_change)
         self.pagination_cursor = None
@@ -1454,6 +1467,8 @@ class CachedFeedProvider(BackgroundTasksMixin, FeedProvider):
             # for channel in channel_cls.select():
             #     if channel.locator not in [ c.get_key() for c in  all_channels ]:
             #         channel_cls[channel.channel_id].delete()
+        # channel configs (and their subject filters) may have changed
+        self._channel_selection = None
 
 
     def feed_attrs(self, feed_name):
@@ -1569,75 +1584,207 @@ class CachedFeedProvider(BackgroundTasksMixin, FeedProvider):
     #         self.view.quit_player()
     #     super().on_deactivate()
 
+    def query_state(self, sort=None, cursor=None):
+        """
+        Everything that update_query builds the query from, or None if it
+        can't be compared.
+        """
+        if self.feed_filters:
+            return None
+        return (
+            self.CONFIG_IDENTIFIER,
+            tuple(self.selected_locators),
+            self.apply_subject_filters,
+            self.rules.version,
+            self.filters.status.value,
+            self.search_filter,
+            self.saved_search_expression(self.custom_filters)
+            if self.custom_filters else None,
+            tuple(sort or self.view.sort_by),
+            cursor
+        )
+
+    def cached_query(self, name, key, fn):
+        def run():
+            with db_session:
+                return fn()
+        return model.query_cache.get(
+            (name, key) if key is not None else None, run
+        )
+
     @property
     def total_item_count(self):
-        with db_session:
-            return self.all_items_query.count()
+        return self.cached_query(
+            "total_item_count", self.CONFIG_IDENTIFIER,
+            lambda: self.all_items_query.count()
+        )
 
     @property
     def feed_item_count(self):
-        with db_session:
-            return self.feed_items_query.count()
+        return self.cached_query(
+            "feed_item_count", self.feed_items_state,
+            lambda: self.feed_items_query.count()
+        )
+
+    def query_result_count(self):
+        if self.items_query is None:
+            return 0
+        return self.cached_query(
+            "query_result_count", self.items_query_state,
+            lambda: self.items_query.count()
+        )
 
     def filter_config_to_query(self, config):
 
         OP_MAP = {
-            "all": "AND",
-            "any": "OR"
+            "all": FilterQuery.all,
+            "any": FilterQuery.any
         }
         op = OP_MAP.get(config.get("match", "all"))
 
-        return "(" + f" {op} ".join(
+        return op([
             self.filter_rule_to_query(rule) for rule in config["rules"]
-        ) + ")"
+        ])
 
+    @property
+    def filter_columns(self):
+        return listing_columns(self.LISTING_CLASS)
+
+    def filter_label_pattern(self, label):
+        try:
+            return self.rules[label].pattern
+        except (KeyError, AttributeError):
+            logger.warning(f"unknown label in filter: {label}")
+            return None
 
     def filter_rule_to_query(self, rule):
+        return compile_filter(
+            rule, self.filter_columns, labels=self.filter_label_pattern
+        )
 
-        BOOL_RE = re.compile(r"\s*([&|])\s*")
-        TERM_MAP = {
-            "&": "AND",
-            "|": "OR"
-        }
+    def channel_selection_query(self):
+        """
+        Filter for the listings in the selected channels.  Built once per
+        selection and reused for every page of results, until the selection,
+        the subject filter toggle or the highlight rules change.
+        """
 
-        OP_MAP = {
-            "=~": "regexp",
-            "!~": "not regexp",
+        key = (
+            tuple(self.selected_locators),
+            self.apply_subject_filters,
+            self.rules.version
+        )
+        if self._channel_selection and self._channel_selection[0] == key:
+            return self._channel_selection[1]
+
+        channel_ids = []
+        feed_queries = []
+        for feed in self.selected_channels:
+            feed_config = feed.config.get_value()
+            if self.apply_subject_filters and "filters" in feed_config:
+                feed_queries.append(
+                    FilterQuery("channel = ?", [feed.channel_id])
+                    & self.filter_config_to_query(feed_config["filters"])
+                )
+            else:
+                channel_ids.append(feed.channel_id)
+
+        # one IN over all the unfiltered channels, however many there are
+        if channel_ids or feed_queries:
+            query = FilterQuery.any(
+                ([FilterQuery.member("channel", channel_ids)] if channel_ids else [])
+                + feed_queries
+            )
+        else:
+            query = None
+        self._channel_selection = (key, query)
+        return query
+
+    def custom_filter_query(self, config):
+        """
+        The query for the custom filter `config`: its saved search, unless it
+        compares dates.  Those are resolved when the filter is compiled, and
+        relative ones ("1 week ago") move with the clock, so the members
+        saved for them would go stale and their plan would never match the
+        saved one.
+        """
+        date_fields = {
+            name for name, kind in self.filter_columns if kind == "date"
         }
+        if any(
+                filter_fields(parse_filter(rule)) & date_fields
+                for rule in config["rules"]
+        ):
+            return self.filter_config_to_query(config)
+        return self.saved_search(config).query
 
-        def parse_term(term):
-            if BOOL_RE.search(term):
-                return TERM_MAP.get(term)
+    @staticmethod
+    def saved_search_expression(config):
+        return json.dumps(config, sort_keys=True, default=str)
 
-            try:
-                (attr, op, value) = re.search(
-                    r"""(\w+)\s*(\S+)\s*(.*)""", term
-                ).groups()
-            except ValueError:
-                import ipdb; ipdb.set_trace()
-            op = OP_MAP.get(op, op)
-            if attr == "label":
-                attr = "title"
-                value = self.rules[value].pattern
-
-            if attr in ["title", "content"]:
-                sql = f"""lower({attr}) {op} lower('{value.replace("'", "''")}')"""
-            else:
-                sql = f"""{attr} {op} {value}"""
-            return sql
+    @db_session
+    def saved_search(self, config):
+        """
+        The saved search for the custom filter `config`, with its members
+        brought up to date.  Created, and evaluated against every listing,
+        the first time the filter is used, then maintained from the listings
+        that change.
+        """
+
+        model.SavedSearch.apply_changes()
+
+        expression = self.saved_search_expression(config)
+        fragment = self.filter_config_to_query(config)
+        # dates are stored as text, so compare them as text too
+        plan = json.loads(
+            json.dumps([fragment.sql, fragment.params], default=str)
+        )
+
+        search = model.SavedSearch.get(
+            provider_id=self.CONFIG_IDENTIFIER,
+            expression=expression
+        )
+        if not search:
+            self.prune_saved_searches()
+            search = model.SavedSearch(
+                provider_id=self.CONFIG_IDENTIFIER,
+                name=self.saved_search_names().get(expression),
+                expression=expression,
+                plan=plan
+            )
+            flush()
+            search.rebuild()
+        elif search.plan != plan:
+            # the filter refers to something that's changed, e.g. the rules
+            # for a label
+            search.plan = plan
+            search.rebuild()
+        return search
+
+    def saved_search_names(self):
+        return {
+            self.saved_search_expression(cfg): name
+            for name, cfg in (self.config.get_path("filters") or {}).items()
+        }
 
-        return "(" + " ".join([
-            parse_term(term)
-            for term in BOOL_RE.split(rule)
-        ]) + ")"
+    @db_session
+    def prune_saved_searches(self):
+        current = self.saved_search_names()
+        for search in model.SavedSearch.select(
+                lambda s: s.provider_id == self.CONFIG_IDENTIFIER
+        ):
+            if search.expression not in current:
+                search.remove()
 
+    def filter_query(self, query, fragment):
+        # raw_sql evaluates the placeholders in this frame
+        p = fragment.params
+        return query.filter(raw_sql(fragment.pony_sql))
 
     def apply_filters(self, query, filters):
 
         for rule in filters:
-            sql = self.filter_rule_to_query(rule)
-            # logger.info(sql)
-            query = query.filter(raw_sql(sql))
+            query = self.filter_query(query, self.filter_rule_to_query(rule))
 
         return query
 
@@ -1647,6 +1794,8 @@ class CachedFeedProvider(BackgroundTasksMixin, FeedProvider):
         if isinstance(self.view, InvalidConfigView):
             return
         logger.debug(f"update_query: {cursor}")
+        self.items_query_state = self.query_state(sort=sort, cursor=cursor)
+        self.feed_items_state = self.items_query_state and self.items_query_state[:4]
         # import ipdb; ipdb.set_trace()
         status_filters =  {
             "all": lambda: True,
@@ -1658,26 +1807,10 @@ class CachedFeedProvider(BackgroundTasksMixin, FeedProvider):
             self.LISTING_CLASS.select()
         )
 
-        def feed_to_filter(feed):
-            sql = f"channel = '{feed.channel_id}'"
-            feed_config = feed.config.get_value()
-            if self.apply_subject_filters and "filters" in feed_config:
-                sql += " AND " + self.filter_config_to_query(feed_config["filters"])
-                # import ipdb; ipdb.set_trace()
-            return sql
-
-        self.feed_items_query = self.all_items_query
-        if self.selected_channels:
-            self.feed_items_query = self.feed_items_query.filter(
-                raw_sql(
-                    "("
-                    +
-                    " OR ".join(
-                        [feed_to_filter(feed)
-                         for feed in self.selected_channels
-                        ])
-                    + ")"
-                )
+        channel_query = self.channel_selection_query()
+        if channel_query:
+            self.feed_items_query = self.filter_query(
+                self.all_items_query, channel_query
             )
         else:
             self.feed_items_query = self.all_items_query
@@ -1726,15 +1859,19 @@ class CachedFeedProvider(BackgroundTasksMixin, FeedProvider):
                 )
 
         if self.custom_filters:
-           self.items_query = self.items_query.filter(
-               raw_sql(self.filter_config_to_query(self.custom_filters))
+            self.items_query = self.filter_query(
+                self.items_query,
+                self.custom_filter_query(self.custom_filters)
             )
 
         (sort_field, sort_desc) = sort if sort else self.view.sort_by
         if cursor:
+            if sort_field not in dict(self.filter_columns):
+                raise SGInvalidFilterExpression(f"can't sort by {sort_field}")
             op = "<" if sort_desc else ">"
-            self.items_query = self.items_query.filter(
-                raw_sql(f"{sort_field} {op} '{cursor}'")
+            self.items_query = self.filter_query(
+                self.items_query,
+                FilterQuery(f"{sort_field} {op} ?", [cursor])
             )
 
         if sort_field:
@@ -1752,6 +1889,55 @@ class CachedFeedProvider(BackgroundTasksMixin, FeedProvider):
             # logger.info(self.items_query.get_sql())
         self.view.update_count = True
 
+    @db_session
+    def seek_listing(self, fragment, after, sort=None):
+        """
+        Find the first listing matching `fragment` that sorts after the key
+        `after` in the current results.  Returns its id and the pagination
+        cursor for the page that starts with it, or None.
+        """
+
+        (sort_field, sort_desc) = sort if sort else self.view.sort_by
+        try:
+            self.update_query(sort=sort, cursor=after)
+            listing = self.filter_query(self.items_query, fragment).first()
+            if not listing:
+                return None
+            key = getattr(listing, sort_field)
+
+            # the nearest distinct key before it, so ties with it are kept
+            self.update_query(sort=sort)
+            op = ">" if sort_desc else "<"
+            previous = self.filter_query(
+                self.items_query, FilterQuery(f"{sort_field} {op} ?", [key])
+            ).order_by(None).order_by(
+                (lambda i: getattr(i, sort_field)) if sort_desc
+                else (lambda i: desc(getattr(i, sort_field)))
+            ).first()
+            return (
+                listing.media_listing_id,
+                getattr(previous, sort_field) if previous else None
+            )
+        finally:
+            self.update_query(sort=sort, cursor=self.pagination_cursor)
+
+    def unread_locators(self):
+        """
+        Locators of the feeds that have unread items, from one query rather
+        than a count per feed.
+        """
+        def locators():
+            with db_session:
+                return frozenset(select(
+                    c.locator for c in model.MediaChannel
+                    if c.provider_id == self.CONFIG_IDENTIFIER
+                    and exists(l for l in self.LISTING_CLASS
+                               if l.channel == c and l.read is None)
+                ))
+        return model.query_cache.get(
+            ("unread_locators", self.CONFIG_IDENTIFIER), locators
+        )
+
     async def apply_search_query(self, query):
         self.pagination_cursor=None
         self.search_filter = query
@@ -1764,6 +1950,27 @@ class CachedFeedProvider(BackgroundTasksMixin, FeedProvider):
     def show_message(self, message):
         self.view.show_message(message)
 
+    def detach_listing(self, listing):
+        sources = [
+            source.detach()
+            for source in listing.sources.select().order_by(lambda s: s.rank)
+        ]
+        listing = listing.detach()
+        listing.channel = listing.channel.detach()
+        listing.channel.listings = None
+        listing.sources = sources
+
+        # get last item's sort key and store it as our pagination cursor
+        # cursor = getattr(listing, self.view.sort_by[0])
+
+        # if not listing.check():
+        #     logger.debug("listing broken, fixing...")
+        #     listing.refresh()
+        #     # have to force a reload here since sources may have changed
+        #     listing = listing.attach().detach()
+
+        return listing
+
     def listings(self, sort=None, cursor=None, offset=None, limit=None, *args, **kwargs):
 
         count = 0
@@ -1782,26 +1989,18 @@ class CachedFeedProvider(BackgroundTasksMixin, FeedProvider):
 
             self.update_query(sort=sort, cursor=cursor)
 
-            for listing in self.items_query[:limit]:
-                sources = [
-                    source.detach()
-                    for source in listing.sources.select().order_by(lambda s: s.rank)
+            # an unchanged page, e.g. on refresh, comes from memory
+            page = self.cached_query(
+                "listings",
+                (self.items_query_state, limit)
+                if self.items_query_state else None,
+                lambda: [
+                    self.detach_listing(listing)
+                    for listing in self.items_query[:limit]
                 ]
-                listing = listing.detach()
-                listing.channel = listing.channel.detach()
-                listing.channel.listings = None
-                listing.sources = sources
-
-                # get last item's sort key and store it as our pagination cursor
-                # cursor = getattr(listing, self.view.sort_by[0])
-
-                # if not listing.check():
-                #     logger.debug("listing broken, fixing...")
-                #     listing.refresh()
-                #     # have to force a reload here since sources may have changed
-                #     listing = listing.attach().detach()
+            )
 
-                yield listing
+        yield from page
 
         self.update_query(sort=sort, cursor=cursor)
 
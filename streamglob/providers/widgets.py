@@ -4,6 +4,8 @@ logger = logging.getLogger(__name__)
 import functools
 import re
 import bisect
+import asyncio
+import collections
 
 import urwid
 from panwid.dialog import ConfirmDialog
@@ -25,6 +27,7 @@ from .filters import *
 from ..state import *
 from .. import model
 from .. import programs
+from ..localindex import local_files
 
 class FilterToolbar(urwid.WidgetWrap):
 
@@ -258,7 +261,6 @@ class DownloadDialog(OKCancelDialog):
                 group
             )
 
-        self.parent.provider.load_rules()
         self.parent.provider.reset()
         await self.parent.download_selection(group=group or None)
 
@@ -425,6 +427,205 @@ class ShellCommandViewMixin(object):
         self.open_popup(popup, width=60, height=10)
 
 
+class RowMarkupCache(object):
+    """
+    Highlighted text markup for table cells, keyed by row index, column,
+    rules version, display variant (translation / emoji stripping) and
+    display width (i.e. how much of the value is shown).
+
+    Entries remember the value they were made from, so a row whose data has
+    changed is regenerated without any explicit invalidation; a change to
+    the rules clears the cache.  Markup for the full text of every row can
+    be filled in ahead of time by `fill`, and is used for cells that show
+    all of it.  Cells that only show part of the text are highlighted on
+    what's shown, so a name that's cut off isn't highlighted.  Rows with
+    identical text share the highlighting work.
+    """
+
+    MAX_ENTRIES = 50000
+    MAX_TEXTS = 20000
+    BATCH_SIZE = 200
+
+    def __init__(self):
+        self.version = None
+        self.entries = collections.OrderedDict()
+        self.texts = dict()
+        self.aliases = dict()
+
+    def clear(self):
+        self.entries.clear()
+        self.texts.clear()
+        self.aliases.clear()
+
+    def check_version(self, rules):
+        if rules.version != self.version:
+            self.entries.clear()
+            self.texts.clear()
+            self.version = rules.version
+
+    def aliases_for(self, index, aliases_fn):
+        if index not in self.aliases:
+            self.aliases[index] = tuple(
+                (subject, tuple(alias_list))
+                for subject, alias_list in (aliases_fn() or {}).items()
+            )
+        return self.aliases[index]
+
+    def markup(self, rules, text, aliases):
+        key = (text, aliases)
+        markup = self.texts.get(key)
+        if markup is None:
+            markup = rules.apply(text, aliases=dict(aliases))
+            if len(self.texts) >= self.MAX_TEXTS:
+                self.texts.clear()
+            self.texts[key] = markup
+        return markup
+
+    def put(self, key, value, text, markup):
+        self.entries[key] = (value, text, markup)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.MAX_ENTRIES:
+            self.entries.popitem(last=False)
+
+    def get(self, rules, index, column, variant, value, text_fn, aliases_fn):
+        """
+        Return the markup for `value` shown in a cell.  `text_fn` turns the
+        value into the text to be highlighted, and `aliases_fn` returns the
+        row's subject aliases; neither is called if the markup is cached.
+        """
+
+        self.check_version(rules)
+        width = (
+            len(value) if value.isascii()
+            else urwid.util.calc_width(value, 0, len(value))
+        )
+        key = (index, column, rules.version, variant, width)
+        entry = self.entries.get(key)
+        if entry and entry[0] == value:
+            self.entries.move_to_end(key)
+            return entry[2]
+
+        text = text_fn(value)
+        full = self.entries.get((index, column, rules.version, variant, None))
+        if full and full[1] == text:
+            markup = full[2]
+        else:
+            markup = self.markup(
+                rules, text, self.aliases_for(index, aliases_fn)
+            )
+        self.put(key, value, text, markup)
+        return markup
+
+    def discard(self, index):
+        self.aliases.pop(index, None)
+        for key in [k for k in self.entries if k[0] == index]:
+            del self.entries[key]
+
+    async def fill(self, rules, variant, cells):
+        """
+        Make markup for the full text of each (index, column, value,
+        text_fn, aliases_fn) in `cells`, a batch at a time so as not to hold
+        up the event loop.
+        """
+        for (n, (index, column, value, text_fn, aliases_fn)) in enumerate(cells):
+            if n and not n % self.BATCH_SIZE:
+                await asyncio.sleep(0)
+            self.check_version(rules)
+            key = (index, column, rules.version, variant, None)
+            entry = self.entries.get(key)
+            if entry and entry[0] == value:
+                continue
+            text = text_fn(value)
+            self.put(key, value, text, self.markup(
+                rules, text, self.aliases_for(index, aliases_fn)
+            ))
+
+
+def row_markup_benchmark(rows=5000, redraws=5, width=60):
+    """
+    Compare redrawing the decorated column of a table the way `decorate`
+    used to (strip emoji and apply the highlight rules for every cell)
+    against `RowMarkupCache`, on generated rules and titles.
+    """
+
+    import os
+    import random
+    import tempfile
+    import timeit
+    import yaml
+    from ..rules import HighlightRuleConfig
+
+    random.seed(0)
+    syllables = ["ar", "ben", "cal", "dor", "el", "fa", "gon", "har", "is", "jo",
+                 "ka", "lon", "mar", "nel", "or", "pa", "ro", "san", "tor", "van"]
+
+    def name(parts):
+        return "".join(random.choice(syllables) for _ in range(parts)).title()
+
+    teams = list({f"{name(2)} {random.choice(['FC', 'United', 'City'])}" for _ in range(300)})
+    players = list({f"{name(1)} {name(2)}" for _ in range(1000)})
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False) as f:
+        yaml.dump(dict(
+            highlight=dict(team="red", player="blue"),
+            match=dict(case_sensitive=False, fuzzy_whitespace=True),
+            label=dict(
+                team={t: None for t in teams},
+                player={p: None for p in players}
+            )
+        ), f)
+    rules = HighlightRuleConfig(f.name)
+    os.remove(f.name)
+
+    titles = [
+        f"{random.choice(teams)} vs {random.choice(teams)} \N{SOCCER BALL} "
+        f"{random.choice(players)} scores twice | full match highlights"
+        for _ in range(rows // 3)
+    ]
+    # plenty of repeats, as with re-uploads and multiple feeds
+    titles = [random.choice(titles) for _ in range(rows)]
+    aliases_fn = lambda: {}
+
+    def old_redraw(w):
+        return [
+            rules.apply(utils.strip_emoji(t[:w]), aliases=aliases_fn())
+            for t in titles
+        ]
+
+    cache = RowMarkupCache()
+
+    def new_redraw(w):
+        return [
+            cache.get(rules, i, "title", (False, True), t[:w], utils.strip_emoji, aliases_fn)
+            for (i, t) in enumerate(titles)
+        ]
+
+    start = timeit.default_timer()
+    for _ in range(redraws):
+        expected = old_redraw(width)
+    elapsed = timeit.default_timer() - start
+    print(f"apply per cell: {elapsed/redraws*1000:.1f} ms/redraw")
+
+    start = timeit.default_timer()
+    asyncio.run(cache.fill(rules, (False, True), (
+        (i, "title", t, utils.strip_emoji, aliases_fn)
+        for (i, t) in enumerate(titles)
+    )))
+    print(f"cache fill (in batches): {(timeit.default_timer()-start)*1000:.1f} ms")
+
+    for (label, w) in [("first", width), ("cached", width), ("resized", width+10)]:
+        start = timeit.default_timer()
+        result = new_redraw(w)
+        print(f"{label} redraw: {(timeit.default_timer()-start)*1000:.1f} ms")
+
+    start = timeit.default_timer()
+    for _ in range(redraws):
+        result = new_redraw(width)
+    elapsed = timeit.default_timer() - start
+    print(f"cached: {elapsed/redraws*1000:.1f} ms/redraw")
+    same = sum(a == b for (a, b) in zip(expected, result))
+    print(f"identical markup for {same}/{rows} rows")
+
+
 class DecoratedTableMixin(object):
 
     def __init__(self, provider, *args, **kwargs):
@@ -433,37 +634,88 @@ class DecoratedTableMixin(object):
         self.translate = self.provider.translate
         self.strip_emoji = self.provider.strip_emoji
         self._translator = None
+        self.markup_cache = RowMarkupCache()
+        self.markup_task = None
         super(DecoratedTableMixin,  self).__init__(*args, **kwargs)
 
+    def row_flag(self, index, name):
+        try:
+            return self.df.get(index, name)
+        except (KeyError, ValueError):
+            return None
+
+    def cell_text(self, index, attr, value):
+
+        if self.row_flag(index, f"_{attr}_translated") and (self.translate or self.row_flag(index, "_translate")):
+            value = self.df.get(index, f"_{attr}_translated")
+
+        if self.strip_emoji or self.row_flag(index, "_strip_emoji"):
+            value = utils.strip_emoji(value)
+
+        return value
+
+    @property
+    def markup_variant(self):
+        return (self.translate, self.strip_emoji)
+
     def decorate(self, row, column, value):
 
-        for attr in self.provider.config.display.tables.decorate:
-            if column.name == attr:
-
-                if row.get(f"_{attr}_translated") and (self.translate or row.get("_translate")):
-                    value = row.get(f"_{attr}_translated")
-
-                if self.strip_emoji or row.get("_strip_emoji"):
-                    value = utils.strip_emoji(value)
-
-                if self.provider.rules:
-                    listing = row.data_source
-                    index = getattr(listing, self.df.index_name)
-                    markup_column = f"_markup_{attr}"
-                    if not row.get(markup_column):
-                        self.df.set(
-                            index, markup_column,
-                            self.provider.rules.apply(
-                                value,
-                                aliases=listing.token_aliases,
-                            )
-                        )
-                    markup = self.df.get(index, markup_column)
-                    if len(markup):
-                        value = urwid.Text(markup)
+        if column.name in self.provider.config.display.tables.decorate:
+
+            index = row.index
+            text_fn = functools.partial(self.cell_text, index, column.name)
+
+            if self.provider.rules:
+                markup = self.markup_cache.get(
+                    self.provider.rules, index, column.name,
+                    self.markup_variant, value, text_fn,
+                    lambda: row.data_source.token_aliases
+                )
+                if len(markup):
+                    value = urwid.Text(markup)
+            else:
+                value = text_fn(value)
 
         return super().decorate(row, column, value)
 
+    def fill_markup(self):
+
+        if self.markup_task:
+            self.markup_task.cancel()
+            self.markup_task = None
+        if not self.provider.rules:
+            return
+
+        def cells():
+            for index in list(self.filtered_rows):
+                for attr in self.provider.config.display.tables.decorate:
+                    try:
+                        value = self.df.get(index, attr)
+                    except (KeyError, ValueError):
+                        continue
+                    if not isinstance(value, str):
+                        continue
+                    yield (
+                        index, attr, value,
+                        functools.partial(self.cell_text, index, attr),
+                        lambda index=index: (
+                            self.get_dataframe_row_object(index).token_aliases
+                        )
+                    )
+
+        self.markup_task = state.event_loop.create_task(
+            self.markup_cache.fill(
+                self.provider.rules, self.markup_variant, cells()
+            )
+        )
+
+    def requery(self, *args, **kwargs):
+        # channel config may have changed the aliases
+        self.markup_cache.aliases.clear()
+        result = super().requery(*args, **kwargs)
+        self.fill_markup()
+        return result
+
     @property
     def translator(self):
         if not self._translator:
@@ -479,6 +731,7 @@ class DecoratedTableMixin(object):
         except ValueError:
             strip_emoji = not strip_emoji
         self.df.set(index, "_strip_emoji", strip_emoji)
+        self.markup_cache.discard(index)
         self.invalidate_rows([index])
 
     def translate_selection(self):
@@ -498,8 +751,7 @@ class DecoratedTableMixin(object):
                         dest=self.provider.translate_dest
                     ).text
                     self.df.set(index, f"_{attr}_translated", translated)
-                    # force regeneration of text markup
-                    self.df.set(index, f"_markup_{attr}", None)
+        self.markup_cache.discard(index)
         self.invalidate_rows([index])
 
     def toggle_translate_all(self):
@@ -529,7 +781,7 @@ class DecoratedTableMixin(object):
                 for (index, _), t in zip(texts, translates):
                     self.df.set(index, "_translate", True)
                     self.df.set(index, f"_{attr}_translated", t)
-                    self.df.set(index, f"_markup_{attr}", None)
+                self.markup_cache.clear()
                 self.invalidate_rows(
                     [ row.index for row in self if row.get(f"_{attr}_translated") ]
                 )
@@ -811,17 +1063,15 @@ class ProviderDataTable(
 
                 if self.create.get_state():
                     dirname = group or subject
-                    if dirname in model.SUBJECT_MAP:
-                        del model.SUBJECT_MAP[dirname]
                     path = os.path.join(self.parent.provider.output_path, dirname)
                     if not os.path.exists(path):
                         os.makedirs(path)
+                        local_files.add(path)
 
                 self.parent.provider.rules.add_rule(
                     self.tag.selected_label,
                     subject, group=group, patterns=patterns
                 )
-                self.parent.provider.load_rules()
                 self.parent.reset()
 
         dialog = AddHighlightRuleDialog(self)
@@ -849,7 +1099,6 @@ class ProviderDataTable(
                 self.parent.provider.rules.remove_rule(
                     self.text.get_edit_text()
                 )
-                self.parent.provider.load_rules()
                 self.parent.reset()
 
         dialog = RemoveHighlightRuleDialog(self)
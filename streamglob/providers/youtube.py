@@ -32,6 +32,7 @@ from ..widgets import *
 from .. import config
 from .. import model
 from .. import session
+from .. import previews
 
 from .filters import *
 
@@ -705,12 +706,6 @@ class YouTubeFeed(FeedMediaChannel):
                         self.newest_timestamp = listing.created
                 yield listing
 
-def sample_evenly_indexes(m, n):
-    return [i*n//m + n//(2*m) for i in range(m)]
-
-def sample_evenly(l, n):
-    return [l[idx] for idx in sample_evenly_indexes(min(n, len(l)), len(l))]
-
 @keymapped()
 class YouTubeDataTable(MultiSourceListingMixin, CachedFeedProviderDataTable):
 
@@ -746,8 +741,14 @@ class YouTubeDataTable(MultiSourceListingMixin, CachedFeedProviderDataTable):
 
     async def thumbnail_for(self, listing):
         if listing.guid not in self.thumbnails:
-            thumbnail = os.path.join(self.tmp_dir, f"thumbnail.{listing.guid}.jpg")
-            await self.download_file(listing.sources[0].locator_thumbnail, thumbnail)
+            source = listing.sources[0]
+            cached = previews.cache.get(source.key, "thumbnail_file")
+            if cached:
+                thumbnail = cached.path
+            else:
+                thumbnail = os.path.join(self.tmp_dir, f"thumbnail.{listing.guid}.jpg")
+                await self.download_file(source.locator_thumbnail, thumbnail)
+                thumbnail = previews.cache.put(source.key, "thumbnail_file", thumbnail)
             self.thumbnails[listing.guid] = thumbnail
         return self.thumbnails[listing.guid]
 
@@ -755,17 +756,48 @@ class YouTubeDataTable(MultiSourceListingMixin, CachedFeedProviderDataTable):
 
         async with self.storyboard_lock:
             if listing.guid not in self.storyboards:
-                self.storyboards[listing.guid] = await self.make_preview_combined(listing, cfg)
+                source = listing.sources[0]
+                params = self.preview_cache_params(cfg, source)
+                cached = previews.cache.get(source.key, cfg.mode, params)
+                if cached:
+                    storyboard = AttrDict(
+                        img_file=cached.path,
+                        duration=cached.duration
+                    )
+                else:
+                    storyboard = await self.make_preview_combined(listing, cfg)
+                    if storyboard:
+                        storyboard.img_file = previews.cache.put(
+                            source.key, cfg.mode, storyboard.img_file, params,
+                            duration=storyboard.duration
+                        )
+                self.storyboards[listing.guid] = storyboard
         return self.storyboards[listing.guid]
 
     async def montage_for(self, listing, cfg):
 
         if listing.guid not in self.montages:
-            self.montages[listing.guid] = await self.make_preview_montage(listing, cfg)
+            source = listing.sources[0]
+            params = self.preview_cache_params(cfg, source)
+            cached = previews.cache.get(source.key, cfg.mode, params)
+            if cached:
+                montage = AttrDict(img_file=cached.path)
+            else:
+                montage = await self.make_preview_montage(listing, cfg)
+                if montage:
+                    montage.img_file = previews.cache.put(
+                        source.key, cfg.mode, montage.img_file, params
+                    )
+            self.montages[listing.guid] = montage
         return self.montages[listing.guid]
 
     async def animation_for(self, listing):
         if listing.guid not in self.animations:
+            source = listing.sources[0]
+            cached = previews.cache.get(source.key, "animation_file")
+            if cached:
+                self.animations[listing.guid] = cached.path
+                return cached.path
             url = await listing.animation
             if not url:
                 self.animations[listing.guid] = None
@@ -781,7 +813,10 @@ class YouTubeDataTable(MultiSourceListingMixin, CachedFeedProviderDataTable):
                 img = wand.image.Image(filename=thumb_file)
                 thumb_mp4 = os.path.join(self.tmp_dir, f"animation.{listing.guid}.mp4")
                 img.save(filename=thumb_mp4)
-                self.animations[listing.guid] = thumb_mp4
+                os.remove(thumb_file)
+                self.animations[listing.guid] = previews.cache.put(
+                    source.key, "animation_file", thumb_mp4
+                )
         return self.animations[listing.guid]
 
     def keypress(self, size, key):
@@ -871,16 +906,12 @@ class YouTubeDataTable(MultiSourceListingMixin, CachedFeedProviderDataTable):
                     await f.write(chunk)
 
 
-    async def make_preview_montage(self, listing, cfg):
-
-        MONTAGE_WIDTH = 1280
-        MONTAGE_HEIGHT = 720
-        DEFAULT_GRID = (5, 5)
+    async def download_storyboards(self, listing):
 
         board_files = []
         boards = await listing.storyboards
         if not boards:
-            return None
+            return (None, None, None)
 
         for i, board in enumerate(boards):
             url = board.url
@@ -888,10 +919,13 @@ class YouTubeDataTable(MultiSourceListingMixin, CachedFeedProviderDataTable):
             try:
                 try:
                     await self.download_file(url, board_file)
-                except (asyncio.CancelledError, asyncio.TimeoutError, aiohttp.client_exceptions.ClientResponseError) as e:
+                except (asyncio.TimeoutError, aiohttp.client_exceptions.ClientResponseError) as e:
                     logger.warn(f"{e} downloading {url}")
-                    return
+                    return (None, None, None)
                 board_files.append(board_file)
+            except asyncio.CancelledError:
+                self.remove_storyboards(listing)
+                raise
             except:
                 # sometimes the last one doesn't exist
                 if i == len(boards)-1:
@@ -899,36 +933,20 @@ class YouTubeDataTable(MultiSourceListingMixin, CachedFeedProviderDataTable):
                 else:
                     logger.error("".join(traceback.format_exc()))
 
-        cols = boards[0].cols
-        rows = boards[0].rows
-
-        i = 0
-        tile_width = 0
-        tile_height = 0
-        tile_skip = cfg.skip or None
-
-        tile_images = []
-        for board_file in board_files:
-            # logger.debug(board_file)
-            img = wand.image.Image(filename=board_file)
-            if i == 0:
-                # calculate tile width / height on first iteration since
-                # last board might not be full height
-                tile_width = img.width // cols
-                tile_height = img.height // rows
-            for h in range(0, img.height, tile_height):
-                for w in range(0, img.width, tile_width):
-                    i += 1
-                    if tile_skip and i % tile_skip:
-                        continue
-                    # n += 1
-                    w_end = w + tile_width
-                    h_end = h + tile_height
-                    tile = img[w:w_end, h:h_end]
-                    tile_images.append(tile)
+        return (board_files, boards[0].cols, boards[0].rows)
+
+    def remove_storyboards(self, listing):
+        for p in pathlib.Path(self.tmp_dir).glob(f"board.{listing.guid}.*"):
+            p.unlink()
+
+    async def make_preview_montage(self, listing, cfg):
+
+        DEFAULT_GRID = (5, 5)
+
+        board_files, cols, rows = await self.download_storyboards(listing)
+        if not board_files:
+            return None
 
-        # import ipdb; ipdb.set_trace()
-        montage_file = os.path.join(self.tmp_dir, f"montage.{listing.guid}.jpg")
         try:
             out_cols, out_rows = [
                 int(n)
@@ -936,39 +954,20 @@ class YouTubeDataTable(MultiSourceListingMixin, CachedFeedProviderDataTable):
             ]
         except (TypeError, AttributeError):
             out_cols, out_rows = DEFAULT_GRID
-        tile_images = sample_evenly(tile_images, cfg.get("images", out_cols*out_rows))
-
-        with wand.image.Image(
-                width=MONTAGE_WIDTH,
-                height=MONTAGE_HEIGHT,
-                background="black"
-        ) as img:
-            tile_width = MONTAGE_WIDTH // out_cols
-            tile_height = MONTAGE_HEIGHT // out_rows
-            # img.options["ashlar:best-fit"] = "true"
-            for r in range(out_rows):
-                for c in range(out_cols):
-                    n = (r * out_cols) + c
-                    try:
-                        tile_img = tile_images[n]
-                    except IndexError:
-                        break
-                    tile_img.transform(
-                        resize=f"{tile_width}x{tile_height}"
-                    )
-                    img.composite(
-                        tile_img,
-                        left=c * tile_width,
-                        top=r * tile_height
-                    )
 
-                # img.sequence.append(tile_img)
-            img.save(filename=montage_file)
-
-        for p in itertools.chain(
-            pathlib.Path(self.tmp_dir).glob(f"board.{listing.guid}.*")
-        ):
-            p.unlink()
+        try:
+            montage_file = await previews.renderer.run(
+                previews.render_montage,
+                board_files, cols, rows,
+                dict(
+                    grid=(out_cols, out_rows),
+                    images=cfg.get("images"),
+                    skip=cfg.skip or None,
+                    output=os.path.join(self.tmp_dir, f"montage.{listing.guid}.jpg")
+                )
+            )
+        finally:
+            self.remove_storyboards(listing)
 
         return AttrDict(
             img_file=montage_file
@@ -976,135 +975,35 @@ class YouTubeDataTable(MultiSourceListingMixin, CachedFeedProviderDataTable):
 
     async def make_preview_combined(self, listing, cfg):
 
-        PREVIEW_WIDTH = 1280
-        PREVIEW_HEIGHT = 720
-        ANIMATION_SKIP = 4
-
-        # TILES_X = 5
-        # TILES_Y = 5
-
-        inset_scale = cfg.scale or 0.25
-        inset_offset = cfg.offset or 0
-        border_color = cfg.border.color or "black"
-        border_width = cfg.border.width or 1
-        tile_skip = cfg.skip or None
-
-        n = 0
-
         thumbnail = await self.thumbnail_for(listing)
-        thumbnail = wand.image.Image(filename=thumbnail)
-        thumbnail.trim(fuzz=20)
-        if thumbnail.width != PREVIEW_WIDTH:
-            thumbnail.transform(resize=f"{PREVIEW_WIDTH}x{PREVIEW_HEIGHT}")
-
         animation = await self.animation_for(listing)
-        if animation:
-            animation_img = wand.image.Image(filename=animation)
-            for i in range(len(animation_img.sequence)//ANIMATION_SKIP):
-                clone = thumbnail.clone()
-                tile = animation_img.sequence[i * ANIMATION_SKIP]
-                tile_width = int(clone.width * inset_scale)
-                tile_height = int(clone.height * inset_scale)
-                tile.transform(
-                    resize=f"{tile_width}x{tile_height}"
-                )
-                tile.border(border_color, border_width, border_width)
-                clone.composite(
-                    tile,
-                    left=clone.width-tile.width-inset_offset,
-                    top=clone.height-tile.height-inset_offset
-                )
-                tile_file=os.path.join(self.tmp_dir, f"tile.{listing.guid}.{n:04d}.jpg")
-                clone.save(filename=tile_file)
-                n += 1
-
-        board_files = []
-        boards = await listing.storyboards
-
-        for i, board in enumerate(boards):
-            url = board.url
-            board_file = os.path.join(self.tmp_dir, f"board.{listing.guid}.{i:02d}.jpg")
-            try:
-                try:
-                    await self.download_file(url, board_file)
-                except (asyncio.CancelledError, asyncio.TimeoutError, aiohttp.client_exceptions.ClientResponseError) as e:
-                    logger.warn(f"{e} downloading {url}")
-                    return
-                board_files.append(board_file)
-            except:
-                # sometimes the last one doesn't exist
-                if i == len(boards)-1:
-                    pass
-                else:
-                    logger.error("".join(traceback.format_exc()))
+        board_files, cols, rows = await self.download_storyboards(listing)
+        if not board_files:
+            return None
 
-        cols = boards[0].cols
-        rows = boards[0].rows
-
-        logger.debug(board_files)
-
-        i = 0
-        tile_width = 0
-        tile_height = 0
-        for board_file in board_files:
-            # logger.debug(board_file)
-            with wand.image.Image(filename=board_file) as img:
-                if i == 0:
-                    # calculate tile width / height on first iteration since
-                    # last board might not be full height
-                    tile_width = img.width // cols
-                    tile_height = img.height // rows
-                for h in range(0, img.height, tile_height):
-                    for w in range(0, img.width, tile_width):
-                        i += 1
-                        if tile_skip and i % tile_skip:
-                            continue
-                        n += 1
-                        w_end = w + tile_width
-                        h_end = h + tile_height
-                        with img[w:w_end, h:h_end] as tile:
-                            clone = thumbnail.clone()
-                            new_tile_width = int(clone.width * inset_scale)
-                            new_tile_height = int(clone.height * inset_scale)
-                            tile.transform(
-                                resize=f"{new_tile_width}x{new_tile_height}"
-                            )
-                            # tile.resize(int(thumbnail.width * inset_scale),
-                            #              int(thumbnail.height * inset_scale))
-                            tile.border(border_color, border_width, border_width)
-                            clone.composite(
-                                tile,
-                                left=clone.width-tile.width-inset_offset,
-                                top=clone.height-tile.height-inset_offset
-                            )
-                            tile_file = os.path.join(self.tmp_dir, f"tile.{listing.guid}.{n:04d}.jpg")
-                            clone.save(filename=tile_file)
-
-        if cfg.frame_rate:
-            frame_rate = cfg.frame_rate
-            duration = n/frame_rate
-        elif "duration" in cfg:
-            duration = cfg.duration
-            frame_rate = n/duration
-        else:
-            duration = n
-            frame_rate = 1
+        try:
+            result = await previews.renderer.run(
+                previews.render_combined,
+                thumbnail, animation, board_files, cols, rows,
+                dict(
+                    scale=cfg.scale,
+                    offset=cfg.offset,
+                    border_color=cfg.border.color,
+                    border_width=cfg.border.width,
+                    skip=cfg.skip or None,
+                    frame_rate=cfg.frame_rate,
+                    duration=cfg.get("duration"),
+                    output=os.path.join(self.tmp_dir, f"storyboard.{listing.guid}.mp4")
+                ),
+                cancellable=True
+            )
+        finally:
+            self.remove_storyboards(listing)
 
-        inputs = ffmpeg.concat(
-            ffmpeg.input(os.path.join(self.tmp_dir, f"tile.{listing.guid}.*.jpg"),
-                                      pattern_type="glob",framerate=frame_rate)
-        )
-        storyboard_file=os.path.join(self.tmp_dir, f"storyboard.{listing.guid}.mp4")
-        proc = await inputs.output(storyboard_file).run_asyncio(overwrite_output=True, quiet=True)
-        await proc.wait()
-
-        for p in itertools.chain(
-            pathlib.Path(self.tmp_dir).glob(f"board.{listing.guid}.*"),
-            pathlib.Path(self.tmp_dir).glob(f"tile.{listing.guid}.*")
-        ):
-            p.unlink()
+        if not result:
+            return None
 
-        # return storyboard_file
+        storyboard_file, duration = result
         return AttrDict(
             img_file=storyboard_file,
             duration=duration
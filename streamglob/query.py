@@ -0,0 +1,459 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import re
+import json
+import functools
+import collections
+from datetime import datetime
+
+import dateparser
+
+from .exceptions import *
+
+# Filter expressions, as used in the `filters` section of feed configs:
+#
+#     title =~ "live|replay" & !(read != null) | channel in [1, 2, 3]
+#
+# Expressions are compiled to SQL fragments with `?` placeholders.  Literal
+# values are never spliced into the SQL, so fragments that differ only in
+# their values share one plan, and one prepared statement once they reach
+# the database.
+
+FOLDED_FIELDS = {"title", "content"}
+NEVER_MATCH = "(?!)"
+
+DATE_SETTINGS = {"PREFER_DAY_OF_MONTH": "first"}
+
+OPERATORS = {
+    "=": "=",
+    "==": "=",
+    "!=": "!=",
+    "<": "<",
+    "<=": "<=",
+    ">": ">",
+    ">=": ">=",
+    "=~": "REGEXP",
+    "!~": "NOT REGEXP",
+    "in": "IN",
+}
+
+
+class FilterQuery(object):
+    """
+    A SQL fragment with `?` placeholders and the values that go in them.
+    """
+
+    PLACEHOLDER_RE = re.compile(r"\?")
+
+    def __init__(self, sql, params=()):
+        self.sql = sql
+        self.params = list(params)
+
+    @property
+    def pony_sql(self):
+        """
+        The fragment with Pony `raw_sql` placeholders, which are evaluated
+        in the caller's frame against a local variable named `p` holding
+        `self.params`.
+        """
+        counter = iter(range(len(self.params)))
+        return self.PLACEHOLDER_RE.sub(
+            lambda m: f"$(p[{next(counter)}])", self.sql
+        )
+
+    @classmethod
+    def join(cls, op, queries):
+        queries = [q for q in queries if q is not None]
+        if not queries:
+            return cls("1" if op == "AND" else "0")
+        if len(queries) == 1:
+            return queries[0]
+        return cls(
+            "(" + f" {op} ".join(q.sql for q in queries) + ")",
+            [p for q in queries for p in q.params]
+        )
+
+    @classmethod
+    def member(cls, column, values):
+        # a single JSON parameter keeps the SQL the same for any number of
+        # values, and SQLite can still look each one up in an index
+        return cls(
+            f"{column} IN (SELECT value FROM json_each(?))",
+            [json.dumps(list(values), default=str)]
+        )
+
+    @classmethod
+    def all(cls, queries):
+        return cls.join("AND", queries)
+
+    @classmethod
+    def any(cls, queries):
+        return cls.join("OR", queries)
+
+    def __and__(self, other):
+        return self.all([self, other])
+
+    def __or__(self, other):
+        return self.any([self, other])
+
+    def __invert__(self):
+        return FilterQuery(f"NOT {self.sql}", self.params)
+
+    def __repr__(self):
+        return f"<FilterQuery: {self.sql} {self.params}>"
+
+
+class FilterParser(object):
+    """
+    Recursive descent parser for filter expressions.  Produces a tree of
+    tuples:
+
+        ("and", (node, ...))
+        ("or", (node, ...))
+        ("not", node)
+        ("cmp", field, op, kind, value)
+
+    where `kind` is one of "null", "str", "num", "list", "range" or
+    "label".
+    """
+
+    SPACE_RE = re.compile(r"\s*")
+    FIELD_RE = re.compile(r"(\w+)\s*")
+    OP_RE = re.compile(r"(=~|!~|==|!=|<=|>=|=|<|>|in\b)\s*", re.I)
+    STRING_RE = re.compile(r"""(["'])((?:\\.|(?!\1).)*)\1""")
+    NUMBER_RE = re.compile(r"[-+]?\d+(?:\.\d+)?$")
+    RANGE_SEPARATOR = ".."
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+
+    def error(self, message):
+        return SGInvalidFilterExpression(
+            f"{message} at position {self.pos}: {self.text!r}"
+        )
+
+    def skip_space(self):
+        self.pos = self.SPACE_RE.match(self.text, self.pos).end()
+
+    def peek(self):
+        self.skip_space()
+        return self.text[self.pos:self.pos+1]
+
+    def accept(self, char):
+        if self.peek() == char:
+            self.pos += 1
+            return True
+        return False
+
+    def parse(self):
+        node = self.parse_or()
+        if self.peek():
+            raise self.error("unexpected input")
+        return node
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.accept("|"):
+            nodes.append(self.parse_and())
+        return nodes[0] if len(nodes) == 1 else ("or", tuple(nodes))
+
+    def parse_and(self):
+        nodes = [self.parse_unary()]
+        while self.accept("&"):
+            nodes.append(self.parse_unary())
+        return nodes[0] if len(nodes) == 1 else ("and", tuple(nodes))
+
+    def parse_unary(self):
+        if self.accept("!"):
+            return ("not", self.parse_unary())
+        if self.accept("("):
+            node = self.parse_or()
+            if not self.accept(")"):
+                raise self.error("expected ')'")
+            return node
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        self.skip_space()
+        m = self.FIELD_RE.match(self.text, self.pos)
+        if not m:
+            raise self.error("expected field name")
+        field = m.group(1).lower()
+        self.pos = m.end()
+        m = self.OP_RE.match(self.text, self.pos)
+        if not m:
+            raise self.error(f"expected operator after {field!r}")
+        op = m.group(1).lower()
+        self.pos = m.end()
+
+        (kind, value) = self.parse_value()
+
+        if field == "label":
+            if op not in ("=", "==", "=~"):
+                raise self.error("labels can only be matched with '='")
+            return ("cmp", "title", "=~", "label", value)
+        if op == "in" and kind == "str" and self.RANGE_SEPARATOR in value:
+            (start, end) = (
+                v.strip() or None
+                for v in value.split(self.RANGE_SEPARATOR, 1)
+            )
+            kind, value = "range", (start, end)
+        if op == "in" and kind not in ("list", "range"):
+            raise self.error("'in' takes a list or a range")
+        if kind in ("list", "range") and op not in ("=", "==", "in"):
+            raise self.error(f"can't compare a {kind} with {op!r}")
+        if kind == "null" and op not in ("=", "==", "!="):
+            raise self.error(f"can't compare null with {op!r}")
+        return ("cmp", field, op, kind, value)
+
+    def parse_scalar(self, terminators):
+        self.skip_space()
+        m = self.STRING_RE.match(self.text, self.pos)
+        if m:
+            self.pos = m.end()
+            # only the quote needs escaping; leave regex escapes alone
+            (quote, value) = m.groups()
+            return ("str", value.replace("\\" + quote, quote))
+
+        # bare values run to the next operator or unbalanced parenthesis, so
+        # that unquoted regular expressions keep working
+        start = self.pos
+        depth = 0
+        while self.pos < len(self.text):
+            c = self.text[self.pos]
+            if c == "(":
+                depth += 1
+            elif c == ")":
+                if not depth:
+                    break
+                depth -= 1
+            elif c in terminators and not depth:
+                break
+            self.pos += 1
+        value = self.text[start:self.pos].strip()
+        if not value:
+            raise self.error("expected value")
+        if value.lower() in ("null", "none"):
+            return ("null", None)
+        if self.NUMBER_RE.match(value):
+            return ("num", float(value) if "." in value else int(value))
+        return ("str", value)
+
+    def parse_value(self):
+        if not self.accept("["):
+            return self.parse_scalar("&|")
+        values = []
+        while not self.accept("]"):
+            if values and not self.accept(","):
+                raise self.error("expected ',' or ']'")
+            (kind, value) = self.parse_scalar(",]")
+            if kind == "null":
+                raise self.error("lists can't contain null")
+            values.append(value)
+        return ("list", tuple(values))
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_filter(text):
+    return FilterParser(text).parse()
+
+
+def filter_shape(node):
+    """
+    The parts of a parsed expression that determine its SQL: everything
+    except the literal values.
+    """
+    if node[0] in ("and", "or"):
+        return (node[0], tuple(filter_shape(n) for n in node[1]))
+    elif node[0] == "not":
+        return ("not", filter_shape(node[1]))
+    (_, field, op, kind, value) = node
+    if kind == "range":
+        value = tuple(v is not None for v in value)
+    else:
+        value = None
+    return ("cmp", field, op, kind, value)
+
+
+def filter_fields(node):
+    """
+    The fields a parsed expression compares.
+    """
+    if node[0] in ("and", "or"):
+        return set().union(*(filter_fields(n) for n in node[1]))
+    elif node[0] == "not":
+        return filter_fields(node[1])
+    return {node[1]}
+
+
+@functools.lru_cache(maxsize=512)
+def filter_plan(shape, columns):
+    """
+    Compile an expression shape (see `filter_shape`) to SQL for a table with
+    `columns`, a tuple of (name, kind) pairs as returned by
+    `listing_columns`.
+    """
+
+    column_kinds = dict(columns)
+
+    def compile_node(node):
+        if node[0] in ("and", "or"):
+            return "(" + f" {node[0].upper()} ".join(
+                compile_node(n) for n in node[1]
+            ) + ")"
+        elif node[0] == "not":
+            return f"NOT {compile_node(node[1])}"
+
+        (_, field, op, kind, value) = node
+        try:
+            column_kind = column_kinds[field]
+        except KeyError:
+            raise SGInvalidFilterExpression(f"unknown field: {field}")
+        sql_op = OPERATORS[op]
+
+        if kind == "null":
+            return f"{field} IS {'NOT ' if op == '!=' else ''}NULL"
+        elif kind == "range":
+            (start, end) = value
+            bounds = (
+                ([f"{field} >= ?"] if start else [])
+                + ([f"{field} <= ?"] if end else [])
+            )
+            return "(" + " AND ".join(bounds or ["1"]) + ")"
+        elif kind == "list":
+            return FilterQuery.member(field, []).sql
+        elif sql_op.endswith("REGEXP"):
+            if column_kind != "text":
+                raise SGInvalidFilterExpression(
+                    f"can't match {field} with a regular expression"
+                )
+            return f"{field} {sql_op} ?"
+        elif column_kind == "text" and field in FOLDED_FIELDS:
+            return f"lower({field}) {sql_op} lower(?)"
+        return f"{field} {sql_op} ?"
+
+    logger.debug(f"compiling filter plan: {shape}")
+    return compile_node(shape)
+
+
+def filter_params(node, columns, labels=None):
+    """
+    The values for the placeholders in the plan for `node`, in order.
+    """
+
+    column_kinds = dict(columns)
+
+    def convert(field, value):
+        kind = column_kinds.get(field)
+        if kind == "date" and isinstance(value, str):
+            d = dateparser.parse(value, settings=DATE_SETTINGS)
+            if not d:
+                raise SGInvalidFilterValue(f"invalid date for {field}: {value}")
+            return d
+        elif kind == "text" and not isinstance(value, str):
+            return str(value)
+        elif kind == "number" and str(value).lower() in ("true", "false"):
+            return int(str(value).lower() == "true")
+        return value
+
+    def node_params(node):
+        if node[0] in ("and", "or"):
+            for n in node[1]:
+                yield from node_params(n)
+            return
+        elif node[0] == "not":
+            yield from node_params(node[1])
+            return
+
+        (_, field, op, kind, value) = node
+        if kind == "null":
+            return
+        elif kind == "range":
+            for v in value:
+                if v is not None:
+                    yield convert(field, v)
+        elif kind == "list":
+            yield json.dumps([convert(field, v) for v in value], default=str)
+        elif kind == "label":
+            pattern = labels(value) if labels else None
+            yield f"(?i){pattern}" if pattern else NEVER_MATCH
+        elif OPERATORS[op].endswith("REGEXP") and field in FOLDED_FIELDS:
+            yield f"(?i){value}"
+        else:
+            yield convert(field, value)
+
+    return list(node_params(node))
+
+
+def compile_filter(text, columns, labels=None):
+    """
+    Compile the filter expression `text` to a `FilterQuery` for a table with
+    `columns`.  `labels` maps highlight rule labels to the regular
+    expression matching any of their rules.
+    """
+    node = parse_filter(text)
+    return FilterQuery(
+        filter_plan(filter_shape(node), columns),
+        filter_params(node, columns, labels)
+    )
+
+
+@functools.lru_cache()
+def listing_columns(entity):
+    """
+    The (name, kind) pairs for the columns of `entity` that filters can
+    refer to.
+    """
+    columns = []
+    for attr in entity._attrs_:
+        if attr.is_collection:
+            continue
+        if attr.py_type is str:
+            kind = "text"
+        elif attr.py_type is datetime:
+            kind = "date"
+        elif attr.py_type in (int, float, bool) or hasattr(attr.py_type, "_pk_"):
+            kind = "number"
+        else:
+            continue
+        columns.append((attr.name, kind))
+    return tuple(columns)
+
+
+class QueryCache(object):
+    """
+    Memoizes query results by key for as long as the data they were computed
+    from is unchanged, i.e. until `generation()` returns a different value,
+    at which point every entry is dropped.
+    """
+
+    def __init__(self, generation, size=1024):
+        self.generation = generation
+        self.size = size
+        self._generation = None
+        self._entries = collections.OrderedDict()
+
+    def get(self, key, fn):
+        if key is None:
+            return fn()
+        generation = self.generation()
+        if generation != self._generation:
+            self._entries.clear()
+            self._generation = generation
+        try:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        except KeyError:
+            pass
+        value = fn()
+        # the query itself may have changed the data
+        if self.generation() == generation:
+            self._entries[key] = value
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self._entries.clear()
@@ -1,15 +1,324 @@
+import logging
+logger = logging.getLogger(__name__)
+
 import re
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import itertools
+import weakref
 from orderedattrdict import AttrDict, Tree
 from itertools import chain
 from collections.abc import MutableSequence
 import yaml
 import os
+import functools
 from functools import reduce
 from itertools import groupby
 
 from . import config
 
 FUZZY_WHITESPACE_RE = re.compile("(?<=\w) +(?![*+])")
+REGEX_SPECIAL_RE = re.compile(r"[.^$*+?{}\[\]\\|()]")
+UNFUZZY_SPACE_RE = re.compile(r"(?<!\w) |^ | $")
+WHITESPACE_RE = re.compile(r"\s+")
+IRREGULAR_WHITESPACE_RE = re.compile(r"\s\s|[^\S ]")
+
+
+class AhoCorasick(object):
+    """
+    Aho-Corasick automaton over a set of literal strings, each with a
+    payload.  `find_starts` finds every occurrence of every string in one
+    pass over the text.
+    """
+
+    def __init__(self, keywords=None):
+        self.goto = [dict()]
+        self.fail = [0]
+        self.out = [()]
+        self.built = False
+        for (keyword, payload) in (keywords or []):
+            self.add(keyword, payload)
+
+    def add(self, keyword, payload):
+        if not keyword:
+            raise ValueError("empty keyword")
+        state = 0
+        for c in keyword:
+            nxt = self.goto[state].get(c)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[state][c] = nxt
+                self.goto.append(dict())
+                self.fail.append(0)
+                self.out.append(())
+            state = nxt
+        self.out[state] += ((len(keyword), payload),)
+        self.built = False
+
+    def build(self):
+        queue = collections.deque(self.goto[0].values())
+        for state in queue:
+            self.fail[state] = 0
+        while queue:
+            state = queue.popleft()
+            for (c, nxt) in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(c, 0)
+                if self.fail[nxt] == nxt:
+                    self.fail[nxt] = 0
+                self.out[nxt] += self.out[self.fail[nxt]]
+        self.built = True
+
+    def find_starts(self, text):
+        """
+        Return a dict of start offset -> list of (end offset, payload) for
+        every occurrence in `text`.
+        """
+        if not self.built:
+            self.build()
+        goto, fail, out = self.goto, self.fail, self.out
+        starts = collections.defaultdict(list)
+        state = 0
+        for (i, c) in enumerate(text):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            for (length, payload) in out[state]:
+                starts[i+1-length].append((i+1, payload))
+        return starts
+
+
+class HighlightRuleMatcher(object):
+    """
+    Finds highlight rule matches in text the same way a single alternation
+    of every rule's patterns would: scanning left to right, the earliest
+    (by label, then rule, then pattern order) pattern matching at a position
+    wins, and scanning resumes after it.
+
+    Literal patterns go into an Aho-Corasick automaton, so the cost doesn't
+    grow with the number of rules; patterns using regex syntax are combined
+    into one regex.  Matches carry the rule that produced them.
+
+    Rules can be added and removed without rebuilding everything: new
+    literals go into a small secondary automaton that's folded into the
+    main one once it reaches `MAX_DELTA` keywords, and removed ones are
+    just dropped from the keyword table.  Only the regex tier is recompiled
+    when one of its patterns changes.
+    """
+
+    MAX_DELTA = 256
+
+    def __init__(self, rules, case_sensitive=False, fuzzy_whitespace=False):
+        self.case_sensitive = case_sensitive
+        self.fuzzy_whitespace = fuzzy_whitespace
+        self.flags = 0 if case_sensitive else re.IGNORECASE
+        self.labels = dict()
+        self.seq = 0
+        self.next_target = 0
+        # target id -> (priority, label, rule, literal key)
+        self.targets = dict()
+        self.rule_targets = dict()
+        # literal key -> target ids, in priority order
+        self.literals = dict()
+        self.regex_patterns = dict()
+        self._regex = None
+        self.automaton = AhoCorasick()
+        self.indexed = set()
+        self.delta = AhoCorasick()
+        self.delta_keys = set()
+        # labels rank in config order, whether or not they have rules yet
+        for label in rules:
+            self.labels.setdefault(label, len(self.labels))
+        for (label, rule_list) in rules.items():
+            for rule in rule_list:
+                self.add(label, rule, compact=False)
+        self.compact()
+
+    def is_literal(self, pattern):
+        if REGEX_SPECIAL_RE.search(pattern):
+            return False
+        # only whitespace that would have been made fuzzy can be normalized
+        if self.fuzzy_whitespace and UNFUZZY_SPACE_RE.search(pattern):
+            return False
+        return True
+
+    def normalize(self, text):
+        if self.fuzzy_whitespace:
+            text = WHITESPACE_RE.sub(" ", text)
+        if not self.case_sensitive:
+            folded = text.lower()
+            if len(folded) != len(text):
+                # keep offsets lined up with the original text
+                folded = "".join(
+                    c.lower() if len(c.lower()) == 1 else c
+                    for c in text
+                )
+            text = folded
+        return text
+
+    def priority(self, target):
+        return self.targets[target][0]
+
+    def add(self, label, rule, compact=True):
+        label_index = self.labels.setdefault(label, len(self.labels))
+        targets = []
+        for (i, pattern) in enumerate(rule.patterns):
+            if not pattern:
+                continue
+            target = self.next_target
+            self.next_target += 1
+            targets.append(target)
+            if self.is_literal(pattern):
+                key = self.normalize(pattern)
+                self.targets[target] = ((label_index, self.seq, i), label, rule, key)
+                found = self.literals.setdefault(key, [])
+                found.append(target)
+                found.sort(key=self.priority)
+                if key not in self.indexed and key not in self.delta_keys:
+                    self.delta.add(key, key)
+                    self.delta_keys.add(key)
+            else:
+                self.targets[target] = ((label_index, self.seq, i), label, rule, None)
+                if self.fuzzy_whitespace:
+                    pattern = FUZZY_WHITESPACE_RE.sub("\\\\s+", pattern)
+                self.regex_patterns[target] = pattern
+                self._regex = None
+        self.seq += 1
+        self.rule_targets[id(rule)] = targets
+        if compact and len(self.delta_keys) > self.MAX_DELTA:
+            self.compact()
+
+    def remove(self, rule):
+        for target in self.rule_targets.pop(id(rule), []):
+            (priority, label, rule, key) = self.targets.pop(target)
+            if key is None:
+                del self.regex_patterns[target]
+                self._regex = None
+                continue
+            found = self.literals[key]
+            found.remove(target)
+            if not found:
+                # left in the automaton, but matches for it are ignored
+                del self.literals[key]
+
+    def compact(self):
+        self.automaton = AhoCorasick(
+            (key, key) for key in self.literals
+        )
+        self.indexed = set(self.literals)
+        self.delta = AhoCorasick()
+        self.delta_keys = set()
+
+    @property
+    def regex(self):
+        if self._regex is None and self.regex_patterns:
+            self._regex = re.compile(
+                "|".join(
+                    f"(?P<_{target}>{pattern})"
+                    for (target, pattern) in sorted(
+                        self.regex_patterns.items(),
+                        key=lambda item: self.priority(item[0])
+                    )
+                ),
+                self.flags
+            )
+        return self._regex
+
+    def literal_starts(self, text):
+        """
+        Best (end, target) of the literal matches at each position of
+        `text`.
+        """
+
+        offsets = None
+        if self.fuzzy_whitespace and IRREGULAR_WHITESPACE_RE.search(text):
+            # map offsets in the collapsed text back to the original
+            offsets = []
+            pos = 0
+            for m in WHITESPACE_RE.finditer(text):
+                offsets.extend(range(pos, m.start()+1))
+                pos = m.end()
+            offsets.extend(range(pos, len(text)))
+
+        key = self.normalize(text)
+        starts = dict()
+        for automaton in [self.automaton] + ([self.delta] if self.delta_keys else []):
+            for (start, found) in automaton.find_starts(key).items():
+                for (end, keyword) in found:
+                    targets = self.literals.get(keyword)
+                    if not targets:
+                        continue
+                    best = starts.get(start)
+                    if best is None or self.priority(targets[0]) < self.priority(best[1]):
+                        starts[start] = (end, targets[0])
+
+        if offsets:
+            starts = {
+                offsets[start]: (offsets[end-1]+1, target)
+                for (start, (end, target)) in starts.items()
+            }
+        return starts
+
+    def finditer(self, text):
+        """
+        Yield (start, end, label, rule) for each match in `text`.
+        """
+
+        starts = self.literal_starts(text) if self.literals else {}
+        literal_positions = sorted(starts)
+        regex = self.regex
+        li = 0
+        regex_match = None
+        pos = 0
+        while True:
+            while li < len(literal_positions) and literal_positions[li] < pos:
+                li += 1
+            literal_start = (
+                literal_positions[li] if li < len(literal_positions) else None
+            )
+
+            if regex and (regex_match is None or regex_match.start() < pos):
+                regex_match = regex.search(text, pos)
+                while regex_match and regex_match.end() == regex_match.start():
+                    regex_match = regex.search(text, regex_match.start()+1)
+
+            if regex_match and (
+                    literal_start is None
+                    or regex_match.start() < literal_start
+                    or (
+                        regex_match.start() == literal_start
+                        and self.priority(int(regex_match.lastgroup[1:]))
+                        < self.priority(starts[literal_start][1])
+                    )
+            ):
+                (start, end) = regex_match.span()
+                target = int(regex_match.lastgroup[1:])
+            elif literal_start is not None:
+                start = literal_start
+                (end, target) = starts[literal_start]
+            else:
+                return
+
+            (_, label, rule, _) = self.targets[target]
+            yield (start, end, label, rule)
+            pos = end
+
+    def match(self, text):
+        """
+        Return the (label, rule) whose pattern matches all of `text`, or
+        (None, None).
+        """
+        if self.is_literal(text):
+            targets = self.literals.get(self.normalize(text))
+            if targets:
+                return self.targets[targets[0]][1:3]
+        return (None, None)
+
 
 class HighlightRule(object):
 
@@ -110,22 +419,36 @@ class HighlightRuleList(MutableSequence):
         if any([type(r.patterns) != list for r in self.rules ]):
             raise Exception([ r.patterns for r in self.rules ])
 
-        self.pattern = "|".join(
-            (
-                FUZZY_WHITESPACE_RE.sub("\\\\s+", p)
-                if self.config.match.fuzzy_whitespace
-                else p
-            )
-            for p in list(chain.from_iterable(
-            rule.patterns
-            for rule in self.rules
-        )))
-
-        self._re_search = re.compile(self.pattern, self.flags)
-        self._re_apply = re.compile(
-            f"\\b({self.pattern})|(?!{self.pattern})(.+?)",
-            self.flags
-        )
+        self._pattern = None
+        self._compiled = None
+
+    # the combined patterns are only compiled when needed, and again after
+    # the list changes
+
+    @property
+    def pattern(self):
+        if self._pattern is None:
+            self._pattern = "|".join(
+                (
+                    FUZZY_WHITESPACE_RE.sub("\\\\s+", p)
+                    if self.config.match.fuzzy_whitespace
+                    else p
+                )
+                for p in list(chain.from_iterable(
+                rule.patterns
+                for rule in self.rules
+            )))
+        return self._pattern
+
+    @property
+    def _re_search(self):
+        if self._compiled is None:
+            self._compiled = re.compile(self.pattern, self.flags)
+        return self._compiled
+
+    def changed(self):
+        self._pattern = None
+        self._compiled = None
 
     def __repr__(self):
         return f"<HighlightRuleList: {self.attr}, {self.rules}>"
@@ -134,13 +457,19 @@ class HighlightRuleList(MutableSequence):
 
     def __len__(self): return len(self.rules)
 
-    def __setitem__(self, i, v): self.rules[i] = v
+    def __setitem__(self, i, v):
+        self.rules[i] = v
+        self.changed()
 
     def __getitem__(self, i): return self.rules[i]
 
-    def __delitem__(self, i): del self.rules[i]
+    def __delitem__(self, i):
+        del self.rules[i]
+        self.changed()
 
-    def insert(self, i, v): self.rules.insert(i, v)
+    def insert(self, i, v):
+        self.rules.insert(i, v)
+        self.changed()
 
     def __contains__(self, rule):
         return rule in self.rules
@@ -167,7 +496,48 @@ class HighlightRuleList(MutableSequence):
             None
         )
 
+# shared by all rule sets, so a reloaded one doesn't reuse a version number
+RULE_VERSIONS = itertools.count()
+SAVE_EXECUTOR = None
+PENDING_SAVES = weakref.WeakSet()
+
+
+@atexit.register
+def flush_pending_saves():
+    for rule_config in list(PENDING_SAVES):
+        rule_config.flush()
+
+
+@functools.lru_cache(256)
+def compile_aliases(aliases):
+    """
+    Combine (subject, alias patterns) pairs into one regex, returning it
+    and a map of its group names to subjects, so that every alias can be
+    replaced with its subject in one pass.
+    """
+    subjects = dict()
+    patterns = []
+    for (i, (subject, alias_list)) in enumerate(aliases):
+        if not alias_list:
+            continue
+        subjects[f"_{i}"] = subject
+        patterns.append(f"(?P<_{i}>{'|'.join(alias_list)})")
+    return (re.compile("|".join(patterns)) if patterns else None, subjects)
+
+
 class HighlightRuleConfig(object):
+    """
+    The highlight rules from a rules file.
+
+    Adding or removing a rule updates the rule lists and the compiled
+    matcher in place, and bumps `version` so that anything derived from
+    the rules can tell it's out of date.  Changes are written back to the
+    file in the background once they've settled for `SAVE_DELAY` seconds.
+    """
+
+    MAX_MATCHERS = 16
+    MAX_TOKEN_RULES = 10000
+    SAVE_DELAY = 2
 
     # def __init__(self, config):
     def __init__(self, config_file):
@@ -187,7 +557,12 @@ class HighlightRuleConfig(object):
              )
             for label, rule_dict in self.label_config.items()
         ])
-        self.RE_MAP = dict()
+        self.version = next(RULE_VERSIONS)
+        self._matchers = dict()
+        self._token_rules = dict()
+        self._pattern_rules = None
+        self._save_handle = None
+        self._save_future = None
 
     @property
     def highlight_config(self):
@@ -204,34 +579,98 @@ class HighlightRuleConfig(object):
     def __getitem__(self, key):
         return self.rules[key]
 
+    def matcher(self, candidates=None):
+        key = frozenset(candidates or [])
+        if key not in self._matchers:
+            if key:
+                rules = AttrDict([
+                    (label, [r for r in rule_list if r.subject in key])
+                    for label, rule_list in self.rules.items()
+                ])
+            else:
+                rules = self.rules
+            if len(self._matchers) >= self.MAX_MATCHERS:
+                self._matchers = {
+                    k: v for k, v in self._matchers.items() if not k
+                }
+            self._matchers[key] = HighlightRuleMatcher(
+                rules,
+                case_sensitive=bool(self.config.match.case_sensitive),
+                fuzzy_whitespace=bool(self.config.match.fuzzy_whitespace)
+            )
+        return self._matchers[key]
+
+    @property
+    def pattern_rules(self):
+        # pattern -> [(label, rule)] for finding the rules to remove
+        if self._pattern_rules is None:
+            self._pattern_rules = dict()
+            for (label, rule_list) in self.rules.items():
+                for rule in rule_list:
+                    self.index_rule(label, rule)
+        return self._pattern_rules
+
+    def index_rule(self, label, rule):
+        for pattern in rule.patterns:
+            self._pattern_rules.setdefault(pattern, []).append((label, rule))
+
+    def changed(self, label, added=[], removed=[]):
+
+        self.version = next(RULE_VERSIONS)
+        self._token_rules.clear()
+        # candidate-filtered matchers are rarely used -- just rebuild them
+        self._matchers = {
+            k: v for k, v in self._matchers.items() if not k
+        }
+        matcher = self._matchers.get(frozenset())
+        for rule in removed:
+            if matcher:
+                matcher.remove(rule)
+            if self._pattern_rules is None:
+                continue
+            for pattern in rule.patterns:
+                entries = [
+                    e for e in self._pattern_rules.get(pattern, [])
+                    if e[1] is not rule
+                ]
+                if entries:
+                    self._pattern_rules[pattern] = entries
+                else:
+                    self._pattern_rules.pop(pattern, None)
+        for rule in added:
+            if matcher:
+                matcher.add(label, rule)
+            if self._pattern_rules is not None:
+                self.index_rule(label, rule)
+
     def add_rule(self, label, subject, group=None, patterns=None):
         targets = [subject] + (patterns if patterns else [])
-        self.remove_rule(targets)
-        rule = HighlightRule(subject, group=group, patterns=patterns)
+        self.remove_rule(targets, save=False)
+        rule = HighlightRule(
+            subject, group=group, patterns=patterns, config=self.config
+        )
         self.rules[label].append(rule)
+        self.changed(label, added=[rule])
         self.save()
 
-    def remove_rule(self, targets):
+    def remove_rule(self, targets, save=True):
         if not isinstance(targets, list):
             targets = [targets]
-        self.rules = AttrDict([
-            (label, HighlightRuleList(
-                self.highlight_config.get(label),
-                [
-                    r for r in self.rules[label]
-                    if r.subject not in targets
-                    and not any(pattern in targets for pattern in r.patterns)
-                ],
-                config=self.config
-            ))
-            for label, rule_list in self.rules.items()
-        ])
-
-        self.save()
-
-    def save(self):
-
-        self.config.label = {
+        found = dict()
+        for target in targets:
+            for (label, rule) in self.pattern_rules.get(target, []):
+                found[id(rule)] = (label, rule)
+        for (label, rule) in found.values():
+            rule_list = self.rules[label]
+            del rule_list[next(
+                i for (i, r) in enumerate(rule_list) if r is rule
+            )]
+            self.changed(label, removed=[rule])
+        if save:
+            self.save()
+
+    def label_tree(self):
+        return {
             label: {
                 d.subject: {
                     k: v for k, v in d.items()
@@ -245,62 +684,55 @@ class HighlightRuleConfig(object):
             for label, rule_list in self.rules.items()
         }
 
-        self.config.save()
-        # temp_config = config.Config(
-        #     self._config_file + ".new.yaml"
-        # )
-        # temp_config.update(self.config.tree)
-
-        # temp_config.label = {
-        #     label: {
-        #         d.subject: {
-        #             k: v for k, v in d.items()
-        #             if k != "subject"
-        #         } or None
-        #         for d in [
-        #             rule.to_dict()
-        #             for rule in sorted(rule_list)
-        #         ]
-        #     }
-        #     for label, rule_list in self.rules.items()
-        # }
-        # temp_config.save()
-
-    def get_regex(self, rules):
-        rules_set = frozenset(rules.items())
-        if rules_set not in self.RE_MAP:
-            pattern = '|'.join(
-                f"{rules_list.pattern}"
-                for label, rules_list in rules.items()
-                if len(rules_list)
-            )
-            pattern_grouped = '|'.join(
-                f"(?P<{label}>{rules_list.pattern})"
-                for label, rules_list in rules.items()
-                if len(rules_list)
-            )
-#             pattern_tokens = f"{pattern_grouped}|(?P<none>(?!{pattern})(.+?))"
-            pattern_tokens = "|".join([
-                p for p in [pattern_grouped, "(?P<none>(?!{pattern})(.+?))"]
-                if len(p)
-            ])
-            self.RE_MAP[rules_set] = tuple(
-                re.compile(p, self.flags)
-                for p in [pattern, pattern_grouped, pattern_tokens]
-            )
-        return self.RE_MAP[rules_set]
-
     @property
-    def pattern_rules(self):
-        return self.get_regex(self.rules)[0]
+    def save_executor(self):
+        global SAVE_EXECUTOR
+        if not SAVE_EXECUTOR:
+            # one thread, so writes happen in order
+            SAVE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return SAVE_EXECUTOR
 
-    @property
-    def pattern_rules_grouped(self):
-        return self.get_regex(self.rules)[1]
-
-    @property
-    def pattern_rules_tokens(self):
-        return self.get_regex(self.rules)[2]
+    def save(self):
+        """
+        Write the rules back to the rules file once there have been no
+        changes for `SAVE_DELAY` seconds, or right away if there's no event
+        loop running.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.write()
+            self.flush()
+            return
+        if self._save_handle:
+            self._save_handle.cancel()
+        self._save_handle = loop.call_later(self.SAVE_DELAY, self.write)
+        PENDING_SAVES.add(self)
+
+    def write(self):
+        self._save_handle = None
+        # the rules are copied here, so changes made while the file is being
+        # written don't affect it
+        self.config.label = self.label_tree()
+        self._save_future = self.save_executor.submit(self.config.save)
+        self._save_future.add_done_callback(self.on_saved)
+
+    def on_saved(self, future):
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"couldn't save rules to {self._config_file}: {e}")
+
+    def flush(self):
+        """
+        Write out any pending changes and wait for the file to be written.
+        """
+        if self._save_handle:
+            self._save_handle.cancel()
+            self.write()
+        if self._save_future:
+            concurrent.futures.wait([self._save_future])
+        PENDING_SAVES.discard(self)
 
     def search(self, text):
         return next(
@@ -316,45 +748,22 @@ class HighlightRuleConfig(object):
 
     def tokenize(self, text, candidates=[], aliases={}):
 
-        for subject, alias_list in aliases.items():
-            text = re.sub("|".join(
-                (
-                    alias
-                    for alias in alias_list
-                )
-            ), subject, text)
-
-        if candidates:
-            rules = AttrDict([
-                (label, HighlightRuleList(
-                    self.highlight_config[label],
-                    [
-                        r for r in rule_list
-                        if r.subject in candidates
-                    ],
-                    config=self.config
-                ))
-                for label, rule_list in self.rules.items()
-            ])
-        else:
-            rules = self.rules
-
-        (pattern, pattern_grouped, pattern_tokens) = self.get_regex(rules)
-
-        tokens = (
-            (match.lastgroup, match.group())
-            for match in re.finditer(pattern_tokens, text)
-        )
+        if aliases:
+            (alias_re, subjects) = compile_aliases(
+                tuple((subject, tuple(alias_list)) for subject, alias_list in aliases.items())
+            )
+            if alias_re:
+                text = alias_re.sub(lambda m: subjects[m.lastgroup], text)
 
         out = []
-        for k, g in groupby(tokens, lambda x: x[0] == "none"):
-            if k:
-                out.append(((None, None), "".join(item[1] for item in g)))
-            else:
-                (attr, text) = next(g)
-                label, rule = self.rule_for_token(text)
-                attr = rule.attr if (rule and rule.attr) else attr
-                out.append(((label, attr), text))
+        pos = 0
+        for (start, end, label, rule) in self.matcher(candidates).finditer(text):
+            if start > pos:
+                out.append(((None, None), text[pos:start]))
+            out.append(((label, rule.attr or label), text[start:end]))
+            pos = end
+        if pos < len(text):
+            out.append(((None, None), text[pos:]))
         return out
 
 
@@ -376,7 +785,15 @@ class HighlightRuleConfig(object):
         ]
 
     def rule_for_token(self, token):
-        return next(
+
+        if isinstance(token, str):
+            if token in self._token_rules:
+                return self._token_rules[token]
+            (label, rule) = self.matcher().match(token)
+            if rule:
+                return (label, rule)
+
+        result = next(
             (
                 (label, rule) for label, rule in (
                     (label, rules.rule_for_token(token))
@@ -386,3 +803,144 @@ class HighlightRuleConfig(object):
             ),
             (None, None)
         )
+        if isinstance(token, str):
+            if len(self._token_rules) >= self.MAX_TOKEN_RULES:
+                self._token_rules.clear()
+            self._token_rules[token] = result
+        return result
+
+
+def highlight_rules_benchmark(sizes=(100, 1000, 5000), titles=300,
+                              fuzzy_whitespace=True):
+    """
+    Compare tokenizing titles with the combined-regex approach `tokenize`
+    used to take (one alternation of every pattern, then a scan of every
+    rule to find the one that matched) against `HighlightRuleMatcher`, over
+    generated rule sets of team, player and competition names.
+    """
+
+    import random
+    import timeit
+
+    random.seed(0)
+    syllables = [
+        "ar", "ben", "cal", "dor", "el", "fa", "gon", "har", "is", "jo",
+        "ka", "lon", "mar", "nel", "or", "pa", "quin", "ro", "san", "tor",
+        "ul", "van", "wil", "xa", "yor", "zan"
+    ]
+
+    def name(parts):
+        return "".join(random.choice(syllables) for _ in range(parts)).title()
+
+    match_config = Tree(
+        match=Tree(case_sensitive=False, fuzzy_whitespace=fuzzy_whitespace)
+    )
+    competitions = [
+        dict(subject="Champions League", patterns=["(?:UEFA )?Champions League", "UCL"]),
+        dict(subject="Europa League", patterns=["Europa League", "UEL"]),
+        dict(subject="Under 21", patterns=[r"U-?21", "Under 21"]),
+        dict(subject="Premier League", patterns=["Premier League", r"EPL\b"]),
+    ]
+
+    for size in sizes:
+        teams = list({
+            f"{name(2)} {random.choice(['FC', 'United', 'City', 'Rovers', 'Athletic'])}"
+            for _ in range(size // 5)
+        })
+        players = list({f"{name(1)} {name(2)}" for _ in range(size - len(teams))})
+        rules = AttrDict([
+            ("competition", HighlightRuleList("competition", competitions, config=match_config)),
+            ("team", HighlightRuleList(
+                "team",
+                [
+                    dict(subject=t, patterns=[t.split()[0]]) if i % 3 == 0 else t
+                    for (i, t) in enumerate(teams)
+                ],
+                config=match_config
+            )),
+            ("player", HighlightRuleList(
+                "player",
+                [
+                    dict(subject=p, patterns=[p.split()[1]]) if i % 2 == 0 else p
+                    for (i, p) in enumerate(players)
+                ],
+                config=match_config
+            )),
+        ])
+        samples = [
+            (
+                f"{random.choice(teams)} vs {random.choice(teams)} | "
+                f"{random.choice(competitions)['subject']} highlights - "
+                f"{random.choice(players)} scores twice ({random.randint(2000, 2024)})"
+            )
+            for _ in range(titles)
+        ]
+        samples = [t.lower() if i % 5 == 0 else t for (i, t) in enumerate(samples)]
+        flags = re.IGNORECASE
+
+        start = timeit.default_timer()
+        pattern_grouped = "|".join(
+            f"(?P<{label}>{rule_list.pattern})"
+            for label, rule_list in rules.items()
+        )
+        regex = re.compile(pattern_grouped + "|(?P<none>.)", flags)
+        regex_build = timeit.default_timer() - start
+
+        def regex_tokenize(text):
+            out = []
+            for k, g in groupby(
+                    ((m.lastgroup, m.group()) for m in regex.finditer(text)),
+                    lambda x: x[0] == "none"
+            ):
+                if k:
+                    out.append((None, "".join(item[1] for item in g)))
+                else:
+                    for (attr, token) in g:
+                        (label, rule) = next(
+                            (
+                                (label, rule) for label, rule in (
+                                    (label, rules.rule_for_token(token))
+                                    for label, rules in rules.items()
+                                )
+                                if rule
+                            ),
+                            (None, None)
+                        )
+                        out.append((rule and rule.subject, token))
+            return out
+
+        start = timeit.default_timer()
+        matcher = HighlightRuleMatcher(
+            rules, fuzzy_whitespace=fuzzy_whitespace
+        )
+        matcher_build = timeit.default_timer() - start
+
+        def matcher_tokenize(text):
+            out = []
+            pos = 0
+            for (s, e, label, rule) in matcher.finditer(text):
+                if s > pos:
+                    out.append((None, text[pos:s]))
+                out.append((rule.subject, text[s:e]))
+                pos = e
+            if pos < len(text):
+                out.append((None, text[pos:]))
+            return out
+
+        results = dict()
+        for (label, fn) in [("regex", regex_tokenize), ("matcher", matcher_tokenize)]:
+            start = timeit.default_timer()
+            results[label] = [fn(t) for t in samples]
+            elapsed = timeit.default_timer() - start
+            print(f"{size} rules, {label}: {elapsed/titles*1000:.3f} ms/title")
+        print(f"{size} rules, build: regex {regex_build*1000:.1f} ms, "
+              f"matcher {matcher_build*1000:.1f} ms")
+
+        # the old path reports the first rule in order matching anywhere in
+        # the token, so only compare which text was matched
+        agree = sum(
+            [t for (_, t) in a] == [t for (_, t) in b]
+            and [s is None for (s, _) in a] == [s is None for (s, _) in b]
+            for (a, b) in zip(results["regex"], results["matcher"])
+        )
+        print(f"{size} rules: identical tokens for {agree}/{titles} titles")
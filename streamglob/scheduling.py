@@ -0,0 +1,148 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import collections
+import itertools
+import random
+from urllib.parse import urlparse
+
+
+def locator_host(locator):
+    try:
+        return urlparse(locator).hostname
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+class SchedulingPolicy(object):
+    """
+    Decides which pending task starts next.  At most `limit` tasks run at
+    once, `per_host` from any one host and `per_program[name]` for any one
+    program.  Providers take turns in proportion to their `weights`
+    (start-time fair queuing), so one provider's big batch can't hold up
+    everyone else's.
+
+    Tasks from the same provider, host and program start in the order they
+    were pushed.
+    """
+
+    def __init__(self, limit, per_host=None, per_program=None, weights=None):
+        self.limit = limit
+        self.per_host = per_host
+        self.per_program = per_program or {}
+        self.weights = weights or {}
+        self.flows = collections.OrderedDict()
+        self.finish_tags = {}
+        self.virtual_time = 0
+        self.running = {}
+        self.hosts = collections.Counter()
+        self.programs = collections.Counter()
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return sum(len(flow) for flow in self.flows.values())
+
+    def weight(self, provider):
+        try:
+            return max(float(self.weights.get(provider, 1)), 0.001)
+        except (TypeError, ValueError):
+            return 1
+
+    def push(self, task, provider=None, host=None, program=None):
+        start = max(self.virtual_time, self.finish_tags.get(provider, 0))
+        self.finish_tags[provider] = start + 1 / self.weight(provider)
+        key = (provider, host, program)
+        self.flows.setdefault(key, collections.deque()).append(
+            (start, next(self.sequence), task)
+        )
+
+    def admits(self, key):
+        (provider, host, program) = key
+        return (
+            len(self.running) < self.limit
+            and not (
+                self.per_host and host
+                and self.hosts[host] >= self.per_host
+            )
+            and not (
+                program in self.per_program
+                and self.programs[program] >= self.per_program[program]
+            )
+        )
+
+    def pop(self):
+        """
+        Take the next task that's allowed to start and count it as running,
+        or return None if there isn't one.
+        """
+
+        best = None
+        for key, flow in self.flows.items():
+            if not self.admits(key):
+                continue
+            if best is None or flow[0][:2] < self.flows[best][0][:2]:
+                best = key
+        if best is None:
+            return None
+
+        flow = self.flows[best]
+        (start, _, task) = flow.popleft()
+        if not flow:
+            del self.flows[best]
+        self.virtual_time = max(self.virtual_time, start)
+
+        (provider, host, program) = best
+        self.running[task.task_id] = best
+        self.hosts[host] += 1
+        self.programs[program] += 1
+        return task
+
+    def finished(self, task):
+        key = self.running.pop(task.task_id, None)
+        if not key:
+            return
+        (provider, host, program) = key
+        self.hosts[host] -= 1
+        self.programs[program] -= 1
+
+
+class RetryPolicy(object):
+    """
+    Whether, and how soon, a failed download is tried again, by the class of
+    error.  The delay doubles with each retry from `delay` seconds up to
+    `max_delay`, with jitter so that downloads which failed together don't
+    all come back at once.
+    """
+
+    DEFAULTS = {
+        "network": dict(retries=10, delay=30, max_delay=3600),
+        "server": dict(retries=5, delay=300, max_delay=6*3600),
+        "process": dict(retries=3, delay=60, max_delay=3600),
+        "not_found": dict(retries=0),
+        "invalid": dict(retries=0),
+        "exists": dict(retries=0),
+        "cancelled": dict(retries=0),
+    }
+
+    def __init__(self, overrides=None, random=random.random):
+        self.rules = {
+            name: dict(dict(retries=0, delay=60, max_delay=3600), **rule)
+            for name, rule in self.DEFAULTS.items()
+        }
+        for name, rule in (overrides or {}).items():
+            self.rules[name] = dict(self.rule(name), **rule)
+        self.random = random
+
+    def rule(self, error_class):
+        return self.rules.get(error_class) or self.rules["process"]
+
+    def backoff(self, error_class, retries):
+        """
+        Seconds to wait before retrying after `retries` earlier retries, or
+        None to give up.
+        """
+        rule = self.rule(error_class)
+        if retries >= rule["retries"]:
+            return None
+        delay = min(rule["delay"] * 2 ** retries, rule["max_delay"])
+        return delay / 2 + self.random() * delay / 2
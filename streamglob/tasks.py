@@ -6,6 +6,7 @@ from datetime import datetime, timedelta
 from orderedattrdict import AttrDict
 import dataclasses
 import itertools
+import collections
 import textwrap
 import tempfile
 import traceback
@@ -19,20 +20,180 @@ from . import utils
 from . import config
 from . import model
 from . import programs
+from .scheduling import SchedulingPolicy, RetryPolicy, locator_host
+
+from pony.orm import db_session, commit
 
 task_manager_task = None
 
-class TaskList(list):
+class TaskList(object):
+    """
+    Tasks in the order they were added, indexed by task_id so that moving a
+    task between lists doesn't mean scanning them.
+    """
+
+    def __init__(self, tasks=[]):
+        self._tasks = collections.OrderedDict(
+            (task.task_id, task) for task in tasks
+        )
+
+    def append(self, task):
+        self._tasks[task.task_id] = task
+
+    def remove(self, task):
+        self.remove_by_id(task.task_id)
 
     def remove_by_id(self, task_id):
-        for i, t in enumerate(self):
-            if t.task_id == task_id:
-                del self[i]
+        self._tasks.pop(task_id, None)
+
+    def __contains__(self, task):
+        return self._tasks.get(task.task_id) is task
+
+    def __iter__(self):
+        return iter(list(self._tasks.values()))
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def __repr__(self):
+        return f"<TaskList: {list(self._tasks.values())}>"
 
 FAILED_TO_OPEN_RE=re.compile("Failed to open (.*)\\.")
 
+DOWNLOAD_ERROR_CLASSES = [
+    (SGFileExists, "exists"),
+    (SGStreamNotFound, "not_found"),
+    (SGInvalidFilenameTemplate, "invalid"),
+    (SGClientThrottled, "server"),
+    ((ConnectionError, asyncio.TimeoutError), "network"),
+]
+
+def download_error_class(error=None, returncode=None, program=None):
+    if error is not None:
+        return next(
+            (name for (cls, name) in DOWNLOAD_ERROR_CLASSES
+             if isinstance(error, cls)),
+            "process"
+        )
+    elif returncode is not None and returncode < 0:
+        # killed, most likely because it was stopped
+        return "cancelled"
+    return getattr(program, "RETURNCODE_ERRORS", {}).get(returncode, "process")
+
+
+class DownloadQueue(object):
+    """
+    Keeps each download's place in the queue in its MediaDownload row,
+    committing every change of state before the task moves on, so that failed
+    downloads are retried later and a restart resumes where the last run
+    stopped.
+    """
+
+    def __init__(self, task_manager, policy):
+        self.task_manager = task_manager
+        self.policy = policy
+        self.timers = {}
+
+    @staticmethod
+    def record(task):
+        listing = getattr(task, "listing", None)
+        if not listing:
+            return None
+        listing = model.MediaListing.get(media_listing_id=listing.media_listing_id)
+        return listing.download if listing else None
+
+    @db_session
+    def submitted(self, task):
+        download = self.record(task)
+        if not download:
+            return
+        self.cancel(download.media_download_id)
+        if download.state == "failed":
+            # asked for again, so start over
+            download.set(retries=0, error=None)
+        download.set(state="pending", next_attempt=None)
+        task.partial = task.partial or download.partial
+
+    @db_session
+    def started(self, task):
+        download = self.record(task)
+        if download:
+            download.set(state="active", partial=task.partial)
+
+    @db_session
+    def failed(self, task, error=None, returncode=None, program=None):
+        task.remove_tempdir()
+        download = self.record(task)
+        if not download:
+            return
+        error_class = download_error_class(error, returncode, program)
+        message = str(error) if error is not None else f"exit status {returncode}"
+        delay = self.policy.backoff(error_class, download.retries)
+        if delay is None:
+            logger.warning(f"giving up on {task.title}: {message} ({error_class})")
+            download.set(state="failed", error=message, next_attempt=None)
+            return
+        logger.info(f"retrying {task.title} in {delay:.0f}s: {message} ({error_class})")
+        download.set(
+            state="waiting", error=message, retries=download.retries + 1,
+            next_attempt=datetime.now() + timedelta(seconds=delay)
+        )
+        commit()
+        self.schedule(download.media_download_id, delay)
+
+    def schedule(self, media_download_id, delay):
+        self.cancel(media_download_id)
+        self.timers[media_download_id] = state.event_loop.call_later(
+            delay, self.retry, media_download_id
+        )
+
+    def cancel(self, media_download_id):
+        timer = self.timers.pop(media_download_id, None)
+        if timer:
+            timer.cancel()
+
+    def cancel_all(self):
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+
+    @db_session
+    def retry(self, media_download_id):
+        self.timers.pop(media_download_id, None)
+        download = model.MediaDownload.get(media_download_id=media_download_id)
+        if download and download.state == "waiting":
+            self.requeue(download)
+
+    def requeue(self, download):
+        listing = download.media_listing
+        logger.debug(f"queuing {listing}")
+        for task in listing.provider.create_download_tasks(
+                listing, index=download.source_index
+        ):
+            task.partial = download.partial
+            self.task_manager.download(task)
+
+    @db_session
+    def resume(self):
+        now = datetime.now()
+        for download in model.MediaDownload.select(lambda d: d.state != "failed"):
+            try:
+                if (download.state == "waiting"
+                    and download.next_attempt and download.next_attempt > now):
+                    self.schedule(
+                        download.media_download_id,
+                        (download.next_attempt - now).total_seconds()
+                    )
+                else:
+                    # including any that were running when we last stopped
+                    self.requeue(download)
+            except Exception as e:
+                logger.error(f"can't resume {download.media_listing}: {e}")
+
+
 class TaskManager(Observable):
 
+    # how often the elapsed times of running tasks are refreshed
     QUEUE_INTERVAL = 1
     DEFAULT_MAX_CONCURRENT_TASKS = 20
 
@@ -52,11 +213,51 @@ class TaskManager(Observable):
         self.errors = TaskList()
         self.current_task_id = 0
         self.started = asyncio.Condition()
+        self.play_queue = asyncio.Queue()
+        self.downloads = self.scheduling_policy()
+        self.download_queue = DownloadQueue(
+            self, RetryPolicy(config.settings.profile.downloads.retry or None)
+        )
+        self.downloads_ready = asyncio.Event()
+        self.postprocessors_running = 0
+        # notified whenever a task moves from one list to another
+        self.tasks_changed = asyncio.Condition()
+        self.workers = []
+        self.watchers = set()
 
     @property
     def max_concurrent_tasks(self):
         return config.settings.tasks.max or self.DEFAULT_MAX_CONCURRENT_TASKS
 
+    @property
+    def max_postprocessors(self):
+        return config.settings.tasks.postprocess or os.cpu_count() or 1
+
+    def scheduling_policy(self):
+        return SchedulingPolicy(
+            self.max_concurrent_tasks,
+            per_host=config.settings.tasks.per_host or None,
+            per_program=dict(config.settings.tasks.programs or {}),
+            # provider names are matched case-insensitively
+            weights={
+                k.lower(): v
+                for k, v in (config.settings.tasks.weights or {}).items()
+            }
+        )
+
+    def download_program(self, task, locator):
+        spec = task.args[0] if task.args else None
+        if isinstance(spec, str):
+            return spec
+        elif not self.downloads.per_program:
+            # only needed to apply the per-program limits
+            return None
+        try:
+            return programs.Downloader.get(spec, locator).cmd
+        except Exception as e:
+            logger.debug(f"can't tell downloader for {locator}: {e}")
+            return None
+
     @property
     def preview_player(self):
         if self._preview_player.done():
@@ -233,6 +434,7 @@ class TaskManager(Observable):
         # task.proc = state.event_loop.create_future()
         # task.result = state.event_loop.create_future()
         self.to_play.append(task)
+        self.play_queue.put_nowait(task)
         return task
 
     def download(self, task, **kwargs):
@@ -241,23 +443,40 @@ class TaskManager(Observable):
         logger.info(f"download listing: {task.listing}")
         self.current_task_id += 1
         task.task_id = self.current_task_id
+        self.download_queue.submitted(task)
         # task.args = (downloader_spec, *task.args)
         # task.kwargs = kwargs
         # task.program = state.event_loop.create_future()
         # task.proc = state.event_loop.create_future()
         # task.result = state.event_loop.create_future()
         self.to_download.append(task)
+        try:
+            locator = task.sources[0].locator
+        except (IndexError, AttributeError, TypeError):
+            locator = None
+        self.downloads.push(
+            task,
+            provider=task.provider.lower() if task.provider else None,
+            host=locator_host(locator),
+            program=self.download_program(task, locator)
+        )
+        self.downloads_ready.set()
         return task
 
     async def run(self):
         while True:
-            self.worker_task = state.event_loop.create_task(self.worker())
-            self.poller_task = state.event_loop.create_task(self.poller())
-            for result in await asyncio.gather(
-                    self.worker_task, self.poller_task, return_exceptions=True
-            ):
-                if isinstance(result, Exception):
-                    logger.error("Exception: ", exc_info=result)
+            self.workers = [
+                state.event_loop.create_task(worker())
+                for worker in (self.play_worker, self.download_worker, self.ticker)
+            ]
+            (done, pending) = await asyncio.wait(
+                self.workers, return_when=asyncio.FIRST_COMPLETED
+            )
+            for worker in pending:
+                worker.cancel()
+            for worker in done:
+                if worker.exception():
+                    logger.error("Exception: ", exc_info=worker.exception())
 
             logger.trace("sleeping")
             await asyncio.sleep(self.QUEUE_INTERVAL)
@@ -266,19 +485,20 @@ class TaskManager(Observable):
     async def start(self):
         logger.debug("task_manager starting")
         self.run_task = state.event_loop.create_task(self.run())
-        self.started.notify_all()
+        async with self.started:
+            self.started.notify_all()
 
     async def stop(self):
         logger.debug("task_manager stopping")
         self.run_task.cancel()
+        for task in self.workers + list(self.watchers):
+            task.cancel()
+        self.download_queue.cancel_all()
 
     async def join(self):
         async with self.started:
             await self.started.wait()
-            asyncio.run(
-                self.worker_task,
-                self.poller_task
-            )
+        await self.run_task
 
     async def start_task(self, task):
         logger.debug(f"task: {task}")
@@ -292,6 +512,7 @@ class TaskManager(Observable):
                 task.stage_results.append(outfile)
             except SGFileExists as e:
                 logger.warn(e)
+                task.result.set_result(e)
                 return
         else:
             logger.error(f"not implemented: {task}")
@@ -312,129 +533,317 @@ class TaskManager(Observable):
         task.elapsed = timedelta(0)
         task.last_progress = None
 
-    async def worker(self):
+    @property
+    def running(self):
+        return len(self.playing) + len(self.active) + len(self.postprocessing)
+
+    async def move(self, task, source, dest):
+        async with self.tasks_changed:
+            if source is not None:
+                source.remove(task)
+            if dest is not None:
+                dest.append(task)
+            self.tasks_changed.notify_all()
+        if source is self.active:
+            self.downloads.finished(task)
+            self.downloads_ready.set()
+        self.refresh_view()
+
+    def refresh_view(self):
+        if state.get("tasks_view"):
+            state.tasks_view.refresh()
 
-        logger.trace("worker")
-        async def get_tasks():
-            while True:
-                if len(self.to_play):
-                    yield self.to_play.pop(0)
-                elif len(self.active) < self.max_concurrent_tasks and len(self.to_download):
-                    yield self.to_download.pop(0)
-                else:
-                    return
-        async for task in get_tasks():
+    def watch(self, coro):
+        watcher = state.event_loop.create_task(coro)
+        self.watchers.add(watcher)
+        watcher.add_done_callback(self.watchers.discard)
+
+    async def launch(self, task, source, dest, watcher):
+        try:
             await self.start_task(task)
-            if isinstance(task, model.PlayMediaTask.attr_class):
-                self.playing.append(task)
-            elif isinstance(task, model.DownloadMediaTask.attr_class):
-                self.active.append(task)
-            else:
-                logger.error(type(task))
-                raise NotImplementedError
+            started = task.proc.done()
+        except Exception as e:
+            logger.error("Exception: ", exc_info=e)
+            if not task.result.done():
+                task.result.set_result(e)
+            started = False
+        if not started:
+            await self.move(task, source, self.errors)
+            return
+        await self.move(task, source, dest)
+        self.watch(watcher(task))
 
+    async def play_worker(self):
 
-    async def poller(self):
+        while True:
+            task = await self.play_queue.get()
+            await self.launch(task, self.to_play, self.playing, self.watch_play)
 
-        (playing_done, playing) = utils.partition(
-            lambda t: not t.program.done() or not t.program.result().is_complete,
-            self.playing)
+    async def download_worker(self):
 
-        playing_done = TaskList(playing_done)
+        while True:
+            await self.downloads_ready.wait()
+            self.downloads_ready.clear()
+            self.downloads.limit = self.max_concurrent_tasks
+            while True:
+                task = self.downloads.pop()
+                if not task:
+                    break
+                await self.launch(
+                    task, self.to_download, self.active, self.watch_download
+                )
+                if task in self.active:
+                    self.download_queue.started(task)
+                else:
+                    self.downloads.finished(task)
+                    self.download_queue.failed(
+                        task,
+                        error=task.result.result() if task.result.done() else None
+                    )
 
-        for task in playing_done:
-            task.finalize()
+    async def ticker(self):
 
-        self.playing = TaskList(playing)
+        while True:
+            async with self.tasks_changed:
+                await self.tasks_changed.wait_for(lambda: self.running)
+            now = datetime.now()
+            for task in itertools.chain(self.playing, self.active, self.postprocessing):
+                try:
+                    task.elapsed = now - task.started
+                except TypeError:
+                    task.elapsed = timedelta(0)
+            self.refresh_view()
+            await asyncio.sleep(self.QUEUE_INTERVAL)
 
-        (complete, active) = utils.partition(
-            lambda t: not t.program.done() or not t.program.result().is_complete,
-            self.active)
+    async def wait_for_program(self, task):
+        """
+        Wait for the task's program to finish.  Most are done when their
+        process exits, but some (e.g. torrent clients) keep downloading after
+        that and have to be polled with update_progress.
+        """
+
+        program = await task.program
+        update_progress = (
+            getattr(program, "update_progress", None)
+            or getattr(program.source, "update_progress", None)
+        )
+        while not program.is_complete:
+            if update_progress:
+                await asyncio.sleep(program.progress_interval)
+                task.last_progress = datetime.now()
+                await update_progress()
+            else:
+                await program.proc.wait()
+        return program
 
-        (done, to_postprocess) = utils.partition(
-            lambda t: len(t.postprocessors) > 0,
-            complete)
+    async def watch_play(self, task):
 
-        to_postprocess = list(to_postprocess)
-        for task in to_postprocess:
-            task.reset()
+        try:
+            await self.wait_for_program(task)
+            task.finalize()
+        except Exception as e:
+            logger.error("Exception: ", exc_info=e)
+        await self.move(task, self.playing, None)
 
-        (postprocessing_done, postprocessing) = utils.partition(
-            lambda t: len(t.postprocessors) > 0,
-            itertools.chain(self.postprocessing, to_postprocess))
+    async def watch_download(self, task):
 
-        postprocessing_list = TaskList(postprocessing)
+        try:
+            await self.wait_for_program(task)
+            if len(task.postprocessors):
+                await self.move(task, self.active, self.postprocessing)
+                await self.postprocess(task)
+                source = self.postprocessing
+            else:
+                source = self.active
 
-        active_list = TaskList(active)
-        all_done_list = TaskList(itertools.chain(done, postprocessing_done))
+            proc = task.proc.result()
+            if proc.returncode == 0:
+                task.finalize()
+            else:
+                logger.warning(f"{task} returned non-zero rc: {proc.returncode}")
+                self.download_queue.failed(
+                    task, returncode=proc.returncode,
+                    program=task.program.result()
+                )
+        except Exception as e:
+            logger.error("Exception: ", exc_info=e)
+            self.download_queue.failed(task, error=e)
+            source = self.postprocessing if task in self.postprocessing else self.active
+            await self.move(task, source, self.errors)
+            return
 
-        for task in all_done_list:
-            logger.debug(f"finalizing {task} {type(task)} {task.__class__.mro()}")
-            if task.program.done() and task.proc.done():
-                proc = task.proc.result()
-                if proc.returncode == 0:
-                    task.finalize()
-                else:
-                    logger.warning(f"{task} returned non-zero rc: {proc.returncode}")
+        await self.move(
+            task, source,
+            self.errors if proc.returncode else self.done
+        )
 
-        self.active = active_list
-        self.postprocessing = postprocessing_list
+    async def postprocess(self, task):
 
-        (done, errors) = utils.partition(
-            lambda t: t.proc.result().returncode,
-            all_done_list
-        )
-        self.done += TaskList(done)
-        self.errors += TaskList(errors)
+        while len(task.postprocessors):
+            task.reset()
+            pp = task.postprocessors[0]
 
-        for task in self.playing + self.active:
-            prog = await task.program
-            now = datetime.now()
+            logger.info(task.listing)
+            # postprocessors are CPU bound, so they get their own pool
+            async with self.tasks_changed:
+                await self.tasks_changed.wait_for(
+                    lambda: self.postprocessors_running < self.max_postprocessors
+                )
+                self.postprocessors_running += 1
             try:
-                task.elapsed = now - task.started
-            except TypeError:
-                task.elapsed = 0
-            if hasattr(prog, "update_progress"):
-                if (task.last_progress is None) or (now - task.last_progress).total_seconds() > prog.progress_interval:
-                    task.last_progress = now
-                    await prog.update_progress()
-            if hasattr(prog.source, "update_progress"):
-                # FIXME: is this still used anywhere?
-                if (task.last_progress is None) or (now - task.last_progress).total_seconds() > prog.progress_interval:
-                    task.last_progress = now
-                    await prog.source.update_progress()
-
-        for task in self.postprocessing:
-            task.elapsed = datetime.now() - task.started
-            if task.program.done():
-                program = task.program.result()
-                proc = task.proc.result()
-                if proc.returncode is not None:
-                    logger.debug("postprocessor done: {task.stage_outfile}")
-                    if not os.path.isfile(task.stage_outfile):
-                        logger.warn(f"processing stage {task.stage} failed")
-                        task.postprocessors = []
-                    task.stage_results.append(task.stage_outfile)
-                    task.postprocessors.pop(0)
-                    if len(task.postprocessors):
-                        task.reset()
-                else:
-                    logger.debug(f"postprocessor still running: {task.program}")
-            elif len(task.postprocessors) > 0:
-                pp = task.postprocessors[0]
-
-                logger.info(task.listing)
                 proc = await programs.Postprocessor.process(
                     task, pp,
                     task.stage_infile,
                     task.stage_outfile,
                 )
-
                 task.proc.set_result(proc)
                 task.pid = proc.pid
+                await proc.wait()
+            finally:
+                async with self.tasks_changed:
+                    self.postprocessors_running -= 1
+                    self.tasks_changed.notify_all()
+
+            logger.debug(f"postprocessor done: {task.stage_outfile}")
+            if not os.path.isfile(task.stage_outfile):
+                logger.warn(f"processing stage {task.stage} failed")
+                task.postprocessors = []
+                break
+            task.stage_results.append(task.stage_outfile)
+            task.postprocessors.pop(0)
+
+
+def scheduler_benchmark(count=5000, concurrency=20, duration=0.01, plays=100,
+                        per_host=8):
+    """
+    Push `count` fake downloads from one host, `count // 20` from a second
+    provider spread over other hosts and `plays` fake players through the
+    TaskManager, with processes that exit after about `duration` seconds.
+    Reports throughput, how long the small batch waited behind the big one
+    with and without fair scheduling, start latency and CPU use once idle.
+    """
+
+    import random
+    import time
+
+    class FakeProcess(object):
+
+        pid = 0
+
+        def __init__(self, delay):
+            self.returncode = None
+            self.exited = state.event_loop.create_future()
+            state.event_loop.call_later(delay, self.exit)
+
+        def exit(self):
+            self.returncode = 0
+            self.exited.set_result(0)
+
+        async def wait(self):
+            return await self.exited
+
+    class FakeProgram(object):
+
+        source = None
+        progress_interval = 1
+
+        def __init__(self, proc):
+            self.proc = proc
+
+        @property
+        def is_complete(self):
+            return self.proc.returncode is not None
+
+    class FakeSource(object):
+
+        def __init__(self, locator):
+            self.locator = locator
+
+    class FakeTask(object):
+
+        title = "fake"
+        listing = None
+        args = ()
+        postprocessors = []
+        started = None
+
+        def __init__(self, provider=None, host=None):
+            self.provider = provider
+            self.sources = [FakeSource(f"https://{host}/")] if host else []
+            self.program = state.event_loop.create_future()
+            self.proc = state.event_loop.create_future()
+            self.result = state.event_loop.create_future()
+            self.queued = time.perf_counter()
+
+        def finalize(self):
+            self.finished = time.perf_counter()
+            self.result.set_result(self.proc.result().returncode)
+
+    class FifoPolicy(SchedulingPolicy):
+
+        def push(self, task, **kwargs):
+            super().push(task)
+
+    class BenchmarkTaskManager(TaskManager):
+
+        max_concurrent_tasks = concurrency
+
+        def scheduling_policy(self):
+            return self.policy(concurrency, per_host=per_host)
+
+        def refresh_view(self):
+            pass
+
+        async def start_task(self, task):
+            task.latency = time.perf_counter() - task.queued
+            proc = FakeProcess(random.uniform(0, 2 * duration))
+            task.program.set_result(FakeProgram(proc))
+            task.proc.set_result(proc)
+            task.started = datetime.now()
+
+    async def run(name, policy):
+        state.event_loop = asyncio.get_running_loop()
+        BenchmarkTaskManager.policy = policy
+        manager = BenchmarkTaskManager()
+        await manager.start()
+
+        start = time.perf_counter()
+        bulk = [
+            manager.download(FakeTask("bulk", "bulk.example.com"))
+            for i in range(count)
+        ]
+        feeds = [
+            manager.download(FakeTask("feeds", f"feed{i % 10}.example.com"))
+            for i in range(count // 20)
+        ]
+        players = []
+        for i in range(plays):
+            players.append(manager.play(FakeTask()))
+            await asyncio.sleep(count * duration / concurrency / plays)
+        async with manager.tasks_changed:
+            await manager.tasks_changed.wait_for(
+                lambda: len(manager.done) == len(bulk) + len(feeds)
+                and not manager.running
+            )
+        elapsed = time.perf_counter() - start
+        feeds_done = max(t.finished for t in feeds) - start
+        print(f"{name}: {len(bulk) + len(feeds)} downloads in {elapsed:.2f}s, "
+              f"small batch done after {feeds_done:.2f}s")
+        latencies = sorted(t.latency for t in players)
+        print(f"{name}: player start latency: median "
+              f"{latencies[len(latencies)//2]*1000:.2f}ms, "
+              f"max {latencies[-1]*1000:.2f}ms")
+
+        cpu = time.process_time()
+        await asyncio.sleep(2)
+        print(f"{name}: cpu while idle: "
+              f"{(time.process_time() - cpu)*1000:.2f}ms over 2s")
+        await manager.stop()
+
+    print(f"ideal: {count * duration / concurrency:.2f}s at {concurrency} at once")
+    asyncio.run(run("fifo", FifoPolicy))
+    asyncio.run(run("fair", SchedulingPolicy))
 
-        if state.get("tasks_view"):
-            state.tasks_view.refresh()
 
 def main():
 
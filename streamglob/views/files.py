@@ -7,6 +7,12 @@ import pipes
 from functools import partial
 import hashlib
 import pathlib
+import fnmatch
+import threading
+import time
+import collections
+import json
+import tempfile
 
 import urwid
 from panwid.keymap import *
@@ -14,16 +20,16 @@ from panwid.dialog import ConfirmDialog
 import thefuzz.fuzz, thefuzz.process
 from unidecode import unidecode
 import ffmpeg
-from pymediainfo import MediaInfo
-import wand.image
-import wand.drawing
+from aiolimiter import AsyncLimiter
 
-from watchdog.observers.polling import PollingObserver
+from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
 from .. import model
 from .. import utils
 from .. import programs
+from .. import previews
+from ..probe import media_probe
 from ..utils import strip_emoji, classproperty
 from .. import config
 # from ..widgets import *
@@ -33,11 +39,92 @@ from ..widgets.browser import FileBrowser, DirectoryNode, FileNode
 from ..providers.base import SynchronizedPlayerProviderMixin
 
 DEFAULT_FUZZ_RATIO = 0.9
+DEFAULT_FUZZY_CANDIDATES = 100
+
+
+class FuzzyNameIndex(object):
+    """
+    Trigram and token index over a set of names, used to pick a small set of
+    candidates for `find_fuzzy_matches` to score instead of all of them.
+
+    `partial_token_set_ratio` scores 100 for any name sharing a whole token
+    with the target, so names are indexed by token as well as by trigram;
+    the rest are ranked by the fraction of their trigrams found in the
+    target.
+    """
+
+    def __init__(self, names=None, fuzzy_unicode=False):
+        self.fuzzy_unicode = fuzzy_unicode
+        self.names = dict()
+        self.seq = 0
+        self.grams = collections.defaultdict(set)
+        self.tokens = collections.defaultdict(set)
+        for name in names or []:
+            self.add(name)
+
+    def normalize(self, name):
+        if self.fuzzy_unicode:
+            name = unidecode(name)
+        return thefuzz.utils.full_process(name)
+
+    @staticmethod
+    def trigrams(s):
+        s = f" {s} "
+        return {s[i:i+3] for i in range(len(s)-2)}
+
+    def add(self, name):
+        if name in self.names:
+            return
+        key = self.normalize(name)
+        grams = self.trigrams(key)
+        self.names[name] = (key, len(grams), self.seq)
+        self.seq += 1
+        for gram in grams:
+            self.grams[gram].add(name)
+        for token in key.split():
+            self.tokens[token].add(name)
+
+    def remove(self, name):
+        try:
+            (key, _, _) = self.names.pop(name)
+        except KeyError:
+            return
+        for gram in self.trigrams(key):
+            self.grams[gram].discard(name)
+            if not self.grams[gram]:
+                del self.grams[gram]
+        for token in key.split():
+            self.tokens[token].discard(name)
+            if not self.tokens[token]:
+                del self.tokens[token]
+
+    def candidates(self, target, limit=DEFAULT_FUZZY_CANDIDATES):
+
+        key = self.normalize(target)
+        matches = set()
+        for token in key.split():
+            matches |= self.tokens.get(token, set())
+
+        counts = collections.Counter()
+        for gram in self.trigrams(key):
+            counts.update(self.grams.get(gram, ()))
+        ranked = sorted(
+            counts.items(),
+            key=lambda item: item[1] / self.names[item[0]][1],
+            reverse=True
+        )
+        matches.update(name for (name, _) in ranked[:limit])
+        # keep the original order so ties are broken the same way
+        return sorted(matches, key=lambda name: self.names[name][2])
+
 
 def find_fuzzy_matches(
     target, candidates, fuzz_ratio=DEFAULT_FUZZ_RATIO, fuzzy_unicode=False
 ):
 
+    if isinstance(candidates, FuzzyNameIndex):
+        candidates = candidates.candidates(target)
+
     if fuzzy_unicode:
         target = unidecode(target)
         candidates = dict(zip([unidecode(c) for c in candidates], candidates))
@@ -57,6 +144,43 @@ def find_fuzzy_matches(
     ]
 
 
+def fuzzy_match_benchmark(count=50000, queries=200):
+
+    import random
+    import timeit
+
+    random.seed(0)
+    words = [
+        "".join(random.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(random.randint(3, 9)))
+        for _ in range(5000)
+    ]
+    names = list({
+        " ".join(random.sample(words, random.randint(1, 3)))
+        for _ in range(count)
+    })
+    targets = [
+        f"{random.choice(names)} {random.choice(words)} 2021-01-01.mp4"
+        for _ in range(queries)
+    ]
+
+    index = FuzzyNameIndex(names, fuzzy_unicode=True)
+
+    results = dict()
+    for (label, candidates) in [("scan", names), ("index", index)]:
+        start = timeit.default_timer()
+        results[label] = [
+            find_fuzzy_matches(t, candidates, fuzzy_unicode=True)
+            for t in targets
+        ]
+        elapsed = timeit.default_timer() - start
+        print(f"{label}: {elapsed/queries*1000:.2f} ms/query")
+
+    agree = sum(
+        a == b for (a, b) in zip(results["scan"], results["index"])
+    )
+    print(f"identical results for {agree}/{queries} queries")
+
+
 class CreateDirectoryDialog(TextEditDialog):
 
     @property
@@ -72,16 +196,93 @@ class FilesPlayMediaTask(model.PlayMediaTask):
     pass
 
 class FilesViewEventHandler(FileSystemEventHandler):
+    """
+    Collects filesystem events from the observer thread and passes them to
+    the view in batches, coalesced by directory, once there's been a quiet
+    period of `DEBOUNCE` seconds (or `MAX_DELAY` after the first event).
+    Partial downloads and other temporary files are ignored until they're
+    removed or renamed.
+    """
+
+    DEBOUNCE = 0.5
+    MAX_DELAY = 2
+
+    IGNORE_PATTERNS = [
+        ".*", "*~", "*.part", "*.part-Frag*", "*.ytdl", "*.tmp", "*.temp",
+    ]
 
     def __init__(self, view, root):
         self.view = view
         self.root = root
-        self.refresh_task = None
+        self.lock = threading.Lock()
+        self.pending = collections.defaultdict(set)
+        self.first_event = None
+        self.last_event = None
+        self.scheduled = False
+        self.ignore_patterns = (
+            (self.view.config.get("watch") or {}).get("ignore")
+            or self.IGNORE_PATTERNS
+        )
         super().__init__()
 
+    def ignored(self, path):
+        name = os.path.basename(path)
+        return any(
+            fnmatch.fnmatchcase(name, pattern)
+            for pattern in self.ignore_patterns
+        )
+
+    def queue(self, path, removed=False):
+        # a temporary file can still have been picked up by a directory
+        # scan, so its removal (or renaming) always has to get through
+        if not removed and self.ignored(path):
+            return
+        (dirname, name) = os.path.split(path)
+        now = time.monotonic()
+        with self.lock:
+            self.pending[dirname].add(name)
+            if self.first_event is None:
+                self.first_event = now
+            self.last_event = now
+            if self.scheduled:
+                return
+            self.scheduled = True
+        state.event_loop.call_soon_threadsafe(self.schedule, self.DEBOUNCE)
+
+    def schedule(self, delay):
+        state.event_loop.call_later(delay, self.flush)
+
+    def flush(self):
+        now = time.monotonic()
+        with self.lock:
+            wait = min(
+                self.last_event + self.DEBOUNCE,
+                self.first_event + self.MAX_DELAY
+            ) - now
+            if wait > 0:
+                self.schedule(wait)
+                return
+            (changes, self.pending) = (self.pending, collections.defaultdict(set))
+            self.first_event = None
+            self.scheduled = False
+        logger.debug(f"applying changes: {dict(changes)}")
+        self.view.apply_changes(changes)
+
+    def on_created(self, event):
+        self.queue(event.src_path)
+
+    def on_deleted(self, event):
+        self.queue(event.src_path, removed=True)
+
+    def on_moved(self, event):
+        self.queue(event.src_path, removed=True)
+        self.queue(event.dest_path)
+
     def on_modified(self, event):
-        self.view.browser.refresh_path(event.src_path)
-        self.view.updated = True
+        # directory modifications are covered by the events for their
+        # contents
+        if not event.is_directory:
+            self.queue(event.src_path)
 
 
 
@@ -115,11 +316,14 @@ class FilesMediaSourceMixin(object):
                 audio_track=0,
             )
 
+    @property
+    def probe(self):
+        # only what's already been probed -- use `media_probe.probe` to fetch
+        return media_probe.get(self.locator) or AttrDict(streams=[], duration=None)
+
     @property
     def streams(self):
-        if not getattr(self, "_streams", None):
-            object.__setattr__(self, "_streams", ffmpeg.probe(self.locator)["streams"])
-        return self._streams
+        return self.probe.streams
 
     @property
     def video_streams(self):
@@ -153,6 +357,240 @@ class FilesMediaSource(FilesMediaSourceMixin, model.InflatableMediaSource):
     pass
 
 
+class LibraryIndexer(object):
+    """
+    Walks the library directories in the background, probing the media
+    files in them and rendering their thumbnails and storyboards into the
+    preview cache, so that previews of those files are ready by the time
+    they're focused.
+
+    Indexing runs a few files at a time under a rate limit, and gives way to
+    the view's own preview work: it only starts a file while no foreground
+    preview is running, and a file that's interrupted is retried later.
+    Indexed files are recorded along with their size and mtime, so a
+    restart picks up where the last session left off and files that haven't
+    changed are skipped.
+    """
+
+    STATE_FILE = "library.json"
+    FLUSH_INTERVAL = 30
+
+    DEFAULT_WORKERS = 1
+    DEFAULT_RATE = 30 # files per minute
+    DEFAULT_EXTENSIONS = [
+        "mp4", "mkv", "webm", "avi", "mov", "m4v", "flv", "wmv", "ts"
+    ]
+
+    def __init__(self, view):
+        self.view = view
+        self.task = None
+        self._done = None
+        self._dirty = False
+        self._last_flush = 0
+        self.stats = collections.Counter()
+
+    @property
+    def cfg(self):
+        return config.settings.profile.get_path("preview.library") or AttrDict()
+
+    @property
+    def roots(self):
+        return [
+            os.path.abspath(os.path.expanduser(root))
+            for root in self.cfg.get("roots") or []
+        ]
+
+    @property
+    def extensions(self):
+        return {
+            "." + ext.lstrip(".").lower()
+            for ext in self.cfg.get("extensions", self.DEFAULT_EXTENSIONS)
+        }
+
+    @property
+    def storyboard_stages(self):
+        if not self.cfg.get("storyboards", True):
+            return []
+        return [
+            stage for stage in self.view.preview_stages
+            if stage.mode == "storyboard"
+        ]
+
+    @property
+    def path(self):
+        return os.path.join(media_probe.path, self.STATE_FILE)
+
+    @property
+    def done(self):
+        if self._done is None:
+            try:
+                with open(self.path) as f:
+                    self._done = json.load(f)
+            except (OSError, ValueError):
+                self._done = dict()
+        return self._done
+
+    def flush(self, force=False):
+        if not (self._dirty or force):
+            return
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".tmp.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.done, f)
+            os.replace(tmp, self.path)
+        except:
+            os.remove(tmp)
+            raise
+        self._dirty = False
+        self._last_flush = time.time()
+
+    def mark_done(self, path, fingerprint):
+        self.done[path] = fingerprint
+        self._dirty = True
+        if time.time() - self._last_flush > self.FLUSH_INTERVAL:
+            self.flush()
+
+    @staticmethod
+    def scan_directory(path, extensions):
+        dirs = []
+        files = []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in extensions:
+                        st = entry.stat()
+                        files.append((entry.path, [st.st_size, st.st_mtime_ns]))
+                except OSError:
+                    continue
+        return (sorted(dirs), sorted(files))
+
+    def start(self):
+        if self.task or not self.roots:
+            return
+        self.task = state.event_loop.create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        self.flush()
+
+    async def walk(self, queue):
+
+        extensions = self.extensions
+        for root in self.roots:
+            pending = [root]
+            while pending:
+                path = pending.pop()
+                try:
+                    (dirs, files) = await state.event_loop.run_in_executor(
+                        None, self.scan_directory, path, extensions
+                    )
+                except OSError as e:
+                    logger.debug(f"can't scan {path}: {e}")
+                    continue
+                pending.extend(reversed(dirs))
+                for (file, fingerprint) in files:
+                    if self.done.get(file) == fingerprint:
+                        self.stats["skipped"] += 1
+                        continue
+                    await queue.put((file, fingerprint))
+
+    async def index_file(self, path):
+        """
+        Render the previews for `path`.  Returns whether the file is finished
+        with, either indexed or not a video; otherwise it's tried again the
+        next time the library is walked.
+        """
+
+        info = await media_probe.probe(path)
+        if not info:
+            # gone since the directory was scanned
+            return False
+        if not any(
+                s.get("codec_type") == "video"
+                and not s.get("disposition", {}).get("attached_pic")
+                for s in info.streams
+        ):
+            return True
+        listing = self.view.listing_for_path(path)
+        thumbnail = await self.view.cached_thumbnail(listing, AttrDict())
+        if not (thumbnail.thumbnail_file and thumbnail.video_duration):
+            return False
+        for cfg in self.storyboard_stages:
+            await self.view.cached_storyboard(listing, cfg, thumbnail=thumbnail)
+        return True
+
+    async def run_when_idle(self, path):
+        """
+        Index `path` while the view isn't busy with previews of its own,
+        starting over if it gets interrupted.
+        """
+
+        previews = self.view.previews
+        while True:
+            await previews.idle.wait()
+            task = state.event_loop.create_task(self.index_file(path))
+            busy = state.event_loop.create_task(previews.busy.wait())
+            try:
+                await asyncio.wait(
+                    [task, busy], return_when=asyncio.FIRST_COMPLETED
+                )
+            finally:
+                busy.cancel()
+                if not task.done():
+                    task.cancel()
+            await asyncio.wait([task])
+            if not task.cancelled():
+                return task.result()
+            self.stats["interrupted"] += 1
+
+    async def worker(self, queue, limiter):
+
+        while True:
+            (path, fingerprint) = await queue.get()
+            try:
+                async with limiter:
+                    indexed = await self.run_when_idle(path)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # e.g. ffprobe isn't installed, which says nothing about the
+                # file, so it's tried again next time
+                logger.warning(f"couldn't index {path}: {e}")
+                indexed = False
+            finally:
+                queue.task_done()
+            if indexed:
+                self.stats["indexed"] += 1
+                self.mark_done(path, fingerprint)
+            else:
+                self.stats["failed"] += 1
+
+    async def run(self):
+
+        workers = self.cfg.get("workers", self.DEFAULT_WORKERS)
+        limiter = AsyncLimiter(self.cfg.get("rate", self.DEFAULT_RATE), 60)
+        queue = asyncio.Queue(maxsize=workers*2)
+        tasks = [
+            state.event_loop.create_task(self.worker(queue, limiter))
+            for i in range(workers)
+        ]
+        logger.info(f"indexing library: {self.roots}")
+        try:
+            await self.walk(queue)
+            await queue.join()
+            logger.info(f"library indexed: {dict(self.stats)}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.flush()
+
+
 @keymapped()
 class FilesView(
         SynchronizedPlayerProviderMixin,
@@ -197,13 +635,10 @@ class FilesView(
         ])
         super().__init__(self.browser_placeholder)
         self.pile.focus_position = 0
-        self.updated = False
         self.storyboard_lock = asyncio.Lock()
         self.prefix_re = None
         self.prefix_scope = 0
 
-        state.event_loop.create_task(self.check_updated())
-
     def update(self):
         pass
 
@@ -227,17 +662,19 @@ class FilesView(
 
         source = listing.sources[0]
         input_file = source.locator
+        await media_probe.probe(input_file)
         track_id = source.thumbnail_stream_id
         if not track_id:
             return None
 
-        await (
+        proc = await (
             ffmpeg
             .input(input_file)[f"v:{track_id}"]
             .output(output_file)
             .overwrite_output()
             .run_asyncio(quiet=True)
         )
+        await previews.wait_process(proc)
         return output_file
 
     async def make_preview_tile(
@@ -257,165 +694,153 @@ class FilesView(
             # .run_asyncio()
             .run_asyncio(quiet=True)
         )
-        await proc.wait()
+        await previews.wait_process(proc)
         # import ipdb; ipdb.set_trace()
         return output_file
 
-    async def make_preview_thumbnail(self, listing, output_file, cfg):
+    async def make_preview_thumbnail(self, listing, output_file, duration):
 
         thumbnail_file = await self.make_preview_tile(
             listing, output_file,
-            position=0.25*cfg.video_duration
+            position=0.25*(duration or 0)
         )
         return thumbnail_file
 
-    async def thumbnail_for(self, listing, cfg):
+    def preview_cache_params(self, cfg, source):
+        try:
+            st = os.stat(source.locator)
+        except OSError:
+            return dict(cfg)
+        # regenerate previews if the file changes
+        return dict(cfg, file_size=st.st_size, file_mtime=st.st_mtime)
+
+    async def cached_thumbnail(self, listing, cfg):
+        """
+        Return the thumbnail for `listing` from the preview cache, generating
+        and caching it if necessary.
+        """
 
-        if listing.key not in self.thumbnails:
-            # doesn't work for MKV...
-            # duration = float(next(
-            #     stream for stream in ffmpeg.probe(listing.locator)["streams"]
-            #     if stream.get("codec_type") == "video" and not stream.get("disposition", []).get("attached_pic")
-            # )["duration"])
+        source = listing.sources[0]
+        params = self.preview_cache_params({}, source)
+        cached = previews.cache.get(source.key, "thumbnail_file", params)
+        if cached:
+            return AttrDict(
+                thumbnail_file=cached.path,
+                video_duration=cached.video_duration
+            )
 
-            media_info = MediaInfo.parse(listing.locators[0])
-            try:
-                duration = next(
-                    t for t in media_info.tracks
-                    if t.track_type == "General"
-                ).duration/1000
-            except TypeError:
-                duration = None
-
-            cfg.video_duration = duration
-            thumbnail_file = os.path.join(self.tmp_dir, f"thumbnail.{listing.key}.jpg")
-            thumbnail = await self.make_preview_embedded(
-                listing, thumbnail_file, cfg
+        info = await media_probe.probe(listing.locators[0])
+        duration = info.duration if info else None
+
+        thumbnail_file = os.path.join(self.tmp_dir, f"thumbnail.{listing.key}.jpg")
+        thumbnail = await self.make_preview_embedded(
+            listing, thumbnail_file, cfg
+        )
+        if not thumbnail:
+            thumbnail = await self.make_preview_thumbnail(
+                listing, thumbnail_file, duration
             )
-            if not thumbnail:
-                thumbnail = await self.make_preview_thumbnail(
-                    listing, thumbnail_file, cfg
-                )
-            self.thumbnails[listing.key] = AttrDict(
-                thumbnail_file=thumbnail,
+        if thumbnail:
+            thumbnail = previews.cache.put(
+                source.key, "thumbnail_file", thumbnail, params,
                 video_duration=duration
             )
+        return AttrDict(
+            thumbnail_file=thumbnail,
+            video_duration=duration
+        )
+
+    async def thumbnail_for(self, listing, cfg):
 
+        if listing.key not in self.thumbnails:
+            self.thumbnails[listing.key] = await self.cached_thumbnail(
+                listing, cfg
+            )
         return self.thumbnails[listing.key]
 
 
     async def preview_content_thumbnail(self, cfg, listing, source):
 
+        await media_probe.probe(source.locator)
         return source.locator_thumbnail_embedded or (
             await self.thumbnail_for(listing, cfg)
         ).thumbnail_file
 
 
-    async def make_preview_storyboard(self, listing, cfg):
-
-        # FIXME: refactor with YouTube version
-        PREVIEW_WIDTH = 1280
-        PREVIEW_HEIGHT = 720
-        PREVIEW_DURATION_RATIO = 0.95
-
-        inset_scale = cfg.scale or 0.25
-        inset_offset = cfg.offset or 0
-        border_color = cfg.border.color or "black"
-        border_width = cfg.border.width or 1
-        num_tiles = cfg.num_tiles or 10
+    async def make_preview_storyboard(self, listing, cfg, thumbnail=None):
 
-        thumbnail = await self.thumbnail_for(listing, cfg)
-        thumbnail_file = thumbnail.thumbnail_file
-        video_duration = thumbnail.video_duration
-
-        (done, pending) = await asyncio.wait([
-            self.make_preview_tile(
-                listing,
-                os.path.join(self.tmp_dir, f"board.{listing.key}.{n:04d}.jpg"),
-                position=(video_duration*PREVIEW_DURATION_RATIO)*(n+1)*(1/num_tiles),
-                width=480
-            )
-            for n in range(num_tiles)
-        ])
-        # import ipdb; ipdb.set_trace()
-        # assert not pending
-        # import ipdb; ipdb.set_trace()
-
-        exceptions = [e for e in [f.exception() for f in done] if e]
-        if len(exceptions):
-            import ipdb; ipdb.set_trace()
-        board_files = sorted([f.result() for f in done])
-        logger.info(board_files)
-        thumbnail = wand.image.Image(filename=thumbnail_file)
-        thumbnail.trim(fuzz=5)
-        if thumbnail.width != PREVIEW_WIDTH:
-            thumbnail.transform(resize=f"{PREVIEW_WIDTH}x-2")
-
-        i = 0
-        tile_width = 0
-        tile_height = 0
-        for n, board_file in enumerate(board_files):
-            # logger.debug(board_file)
-            with wand.image.Image(filename=board_file) as tile:
-                clone = thumbnail.clone()
-                tile.resize(int(thumbnail.width * inset_scale),
-                             int(thumbnail.height * inset_scale))
-                tile.border(border_color, border_width, border_width)
-                thumbnail.composite(
-                    tile,
-                    left=thumbnail.width-tile.width-inset_offset,
-                    top=thumbnail.height-tile.height-inset_offset
-                )
-                tile_file = os.path.join(self.tmp_dir, f"tile.{listing.key}.{n:04d}.jpg")
-                thumbnail.save(filename=tile_file)
-
-        if cfg.frame_rate:
-            frame_rate = cfg.frame_rate
-            duration = n/frame_rate
-        elif "duration" in cfg:
-            duration = cfg.duration
-            frame_rate = n/duration
-        else:
-            duration = n
-            frame_rate = 1
+        if not thumbnail:
+            thumbnail = await self.thumbnail_for(listing, cfg)
+        if not (thumbnail.thumbnail_file and thumbnail.video_duration):
+            return None
 
-        inputs = ffmpeg.concat(
-            ffmpeg.input(
-                os.path.join(self.tmp_dir, f"tile.{listing.key}.*.jpg"),
-                pattern_type="glob", framerate=frame_rate,
-            )
+        result = await previews.renderer.run(
+            previews.render_video_storyboard,
+            listing.locators[0],
+            thumbnail.thumbnail_file,
+            thumbnail.video_duration,
+            dict(
+                scale=cfg.scale,
+                offset=cfg.offset,
+                border_color=cfg.border.color,
+                border_width=cfg.border.width,
+                num_tiles=cfg.num_tiles,
+                keyframes=cfg.get("keyframes", True),
+                frame_rate=cfg.frame_rate,
+                duration=cfg.get("duration"),
+                trim_fuzz=5,
+                resize=f"{previews.PREVIEW_WIDTH}x",
+                output=os.path.join(self.tmp_dir, f"storyboard.{listing.key}.mp4")
+            ),
+            cancellable=True
         )
-        storyboard_file = os.path.join(self.tmp_dir, f"storyboard.{listing.key}.mp4")
-        proc = await inputs.output(
-            storyboard_file,
-                report=None
-        ).run_asyncio(overwrite_output=True, quiet=True)
-        await proc.wait()
-
-        # for p in itertools.chain(
-        #     pathlib.Path(self.tmp_dir).glob(f"board.{listing.key}.*"),
-        #     pathlib.Path(self.tmp_dir).glob(f"tile.{listing.key}.*")
-        # ):
-        #     p.unlink()
-
-        # return storyboard_file
+        if not result:
+            return None
+
+        storyboard_file, duration = result
         return AttrDict(
             img_file=storyboard_file,
             duration=duration
         )
 
+    async def cached_storyboard(self, listing, cfg, thumbnail=None):
+        """
+        Return the storyboard for `listing` from the preview cache,
+        generating and caching it if necessary.
+        """
+
+        source = listing.sources[0]
+        params = self.preview_cache_params(cfg, source)
+        cached = previews.cache.get(source.key, cfg.mode, params)
+        if cached:
+            return AttrDict(
+                img_file=cached.path,
+                duration=cached.duration
+            )
+        storyboard = await self.make_preview_storyboard(
+            listing, cfg, thumbnail=thumbnail
+        )
+        if storyboard:
+            storyboard.img_file = previews.cache.put(
+                source.key, cfg.mode, storyboard.img_file, params,
+                duration=storyboard.duration
+            )
+        return storyboard
+
     async def storyboard_for(self, listing, cfg):
 
         async with self.storyboard_lock:
             if listing.key not in self.storyboards:
-                self.storyboards[listing.key] = await self.make_preview_storyboard(listing, cfg)
+                self.storyboards[listing.key] = await self.cached_storyboard(
+                    listing, cfg
+                )
         return self.storyboards[listing.key]
 
     async def preview_content_storyboard(self, cfg, listing, source):
 
         storyboard = await self.storyboard_for(listing, cfg)
         if not storyboard:
-            import ipdb; ipdb.set_trace()
+            return None
         logger.info(storyboard)
         return storyboard.img_file
 
@@ -442,6 +867,13 @@ class FilesView(
         self.monitor_path(top_dir)
         urwid.connect_signal(self.browser, "focus", self.on_focus)
         self.browser_placeholder.original_widget = self.browser
+        self.library_indexer.start()
+
+    @property
+    def library_indexer(self):
+        if not hasattr(self, "_library_indexer"):
+            self._library_indexer = LibraryIndexer(self)
+        return self._library_indexer
 
     def set_file_sort(self, order, reverse=False):
         self.browser.file_sort = (order, reverse)
@@ -449,17 +881,40 @@ class FilesView(
     def keypress(self, size, key):
         return super().keypress(size, key)
 
-    async def check_updated(self):
-        while True:
-            if self.updated:
-                self.refresh()
-                self.updated = False
-            await asyncio.sleep(1)
+    @property
+    def dir_index(self):
+        root = self.browser.tree_root
+        if getattr(self, "_dir_index_root", None) is not root:
+            self._dir_index = FuzzyNameIndex(
+                [d.name for d in root.child_dirs],
+                fuzzy_unicode=True
+            )
+            self._dir_index_root = root
+        return self._dir_index
+
+    def apply_changes(self, changes):
+        self.browser.apply_changes(changes)
+
+        if getattr(self, "_dir_index_root", None) is not self.browser.tree_root:
+            return
+        top_dir = self.browser.top_dir
+        for (dirname, names) in changes.items():
+            if os.path.normpath(dirname) != top_dir:
+                continue
+            for name in names:
+                if os.path.isdir(os.path.join(top_dir, name)):
+                    self._dir_index.add(name)
+                else:
+                    self._dir_index.remove(name)
 
     @property
     def playlist_position(self):
         return self.selection_index
 
+    @property
+    def prefetch_position(self):
+        return self.selection_index
+
     @property
     def playlist_title(self):
         return f"[{self.browser.root}/{self.selection.full_path}]"
@@ -487,14 +942,27 @@ class FilesView(
         logger.info(f"monitor_path: {path}")
         if getattr(self, "observer", None):
             self.observer.stop()
-        self.observer = PollingObserver(5)
+        self.observer = Observer()
         self.observer.schedule(
             FilesViewEventHandler(self, self.browser.cwd), path, recursive=recursive
         )
         self.observer.start()
 
+    def probe_directory(self):
+
+        if getattr(self, "probe_task", None):
+            self.probe_task.cancel()
+        paths = [
+            node.full_path
+            for node in self.browser.cwd_node.child_files
+        ]
+        self.probe_task = state.event_loop.create_task(
+            media_probe.probe_all(paths)
+        )
+
     def load_play_items(self):
 
+        self.probe_directory()
         self._play_items = [
             AttrDict(
                 title=listing.title,
@@ -515,16 +983,18 @@ class FilesView(
     @property
     def selection_index(self):
         try:
-            return self.browser.cwd_node.child_files.index(
-                self.selection
-            )
+            return self.browser.cwd_node.child_file_index(self.selection)
         except ValueError:
             return 0
 
     def get_listing(self, index=None):
         if index is None:
             index = self.selection_index
-        path = self.browser.cwd_node.child_files[index].full_path
+        return self.listing_for_path(
+            self.browser.cwd_node.child_files[index].full_path
+        )
+
+    def listing_for_path(self, path):
 
         return self.provider.new_listing(
             # path=path,
@@ -650,8 +1120,6 @@ class FilesView(
                 for src in self.files:
                     self.parent.browser.move_path(src, destdir)
 
-        dirs = [d.name for d in self.browser.tree_root.child_dirs]
-
         files = [
             f.full_path
             for f in self.browser.selected_items
@@ -662,7 +1130,7 @@ class FilesView(
         matches = [
             m[0] for m in find_fuzzy_matches(
                 os.path.basename(src),
-                dirs,
+                self.dir_index,
                 fuzzy_unicode=True
             )
         ]
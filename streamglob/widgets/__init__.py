@@ -67,6 +67,7 @@ class StreamglobView(panwid.BaseView):
     def quit_app(self):
 
         state.listings_view.provider.deactivate()
+        state.files_view.library_indexer.stop()
         state.event_loop.create_task(state.task_manager.stop())
         state.task_manager_task.cancel()
         raise urwid.ExitMainLoop()
@@ -5,6 +5,8 @@ import time
 import itertools
 import re
 import os
+import stat
+import collections
 from functools import partial
 
 import urwid
@@ -17,8 +19,6 @@ class FileTreeWidget(MarkedTreeWidget):
     """Widget for individual files."""
     def __init__(self, node, marked=False):
         super().__init__(node, marked=marked)
-        path = node.get_value()
-        add_widget(path, self)
 
     def get_display_text(self):
         return ("tree normal", self.get_node().get_key())
@@ -50,8 +50,10 @@ class DirectoryWidget(ExpandableMarkedTreeWidget):
 
     def __init__(self, node):
         super().__init__(node)
-        path = node.get_value()
-        add_widget(path, self)
+        parent = node.get_parent()
+        if parent is not None and parent.marked:
+            self.marked = True
+            self.update_w()
 
     def update_expanded_icon(self):
         if self.get_node().get_key() == "..":
@@ -94,6 +96,68 @@ class FileBrowserTreeNodeMixin(object):
     def locators(self):
         return [self.locator]
 
+    @property
+    def marked(self):
+        # widgets are only created for rows that are displayed, and inherit
+        # their parent's mark when they are
+        if self._widget is None:
+            parent = self.get_parent()
+            return parent.marked if parent is not None else False
+        return self._widget.marked
+
+
+class DirectorySnapshot(object):
+    """
+    Cached `os.scandir` listing of a directory.
+
+    The `DirEntry` objects are kept so their stat results can be reused for
+    sorting.  A snapshot is considered current as long as the directory's
+    mtime hasn't changed; changes to files within it are picked up through
+    `FileBrowser.invalidate`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # stat before listing so a change during the scan looks stale
+        self.mtime = os.stat(path).st_mtime_ns
+        with os.scandir(path) as it:
+            self.entries = {entry.name: entry for entry in it}
+
+    def is_current(self):
+        try:
+            return os.stat(self.path).st_mtime_ns == self.mtime
+        except OSError:
+            return False
+
+    def update(self, names):
+        """
+        Re-stat `names` only, adding, replacing or removing their entries.
+        """
+        for name in names:
+            try:
+                self.entries[name] = PathEntry(os.path.join(self.path, name))
+            except OSError:
+                self.entries.pop(name, None)
+        try:
+            self.mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            pass
+
+
+class PathEntry(object):
+    """Stand-in for an `os.DirEntry` when a single path is re-stat'ed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self._stat = os.stat(path)
+
+    def is_dir(self):
+        return stat.S_ISDIR(self._stat.st_mode)
+
+    def stat(self):
+        return self._stat
+
 
 class FileNode(FileBrowserTreeNodeMixin, TreeNode):
     """Metadata storage for individual files"""
@@ -152,6 +216,9 @@ class DirectoryNode(FileBrowserTreeNodeMixin, TreeParentNode):
             key = os.path.basename(path)
         urwid.ParentNode.__init__(self, path, key=key, parent=parent,
                                   depth=depth)
+        self.dir_count = 0
+        self._child_index = {}
+        self._child_files = None
 
     def __repr__(self):
         return f"<DirectoryNode: {self.get_key()}>"
@@ -166,32 +233,58 @@ class DirectoryNode(FileBrowserTreeNodeMixin, TreeParentNode):
         parent.set_child_node(self.get_key(), self)
         return parent
 
+    def get_child_keys(self, reload=False):
+        if self._child_keys is None or reload:
+            self._child_keys = self.load_child_keys()
+            self._child_index = {
+                key: i for i, key in enumerate(self._child_keys)
+            }
+            self._child_files = None
+        return self._child_keys
+
+    def get_child_index(self, key):
+        self.get_child_keys()
+        try:
+            return self._child_index[key]
+        except KeyError:
+            raise urwid.TreeWidgetError(
+                f"Can't find key {key} in ParentNode {self.get_key()}"
+            )
+
     def load_child_keys(self):
         dirs = []
         files = []
+        self.dir_count = 0
         try:
             path = self.get_value()
-            # separate dirs and files
-            for entry in os.scandir(path):
-                if entry.name.startswith('.'):
-                    continue
-                if not self.tree.ignore_directories and entry.is_dir():
-                    dirs.append(entry.name)
-                elif not self.tree.ignore_files:
-                    files.append(entry.name)
+            snapshot = self.tree.snapshot(path)
         except OSError as e:
             depth = self.get_depth() + 1
             self._children[None] = ErrorNode(
                 self, parent=self, key=None, depth=depth)
             return [None]
 
+        # separate dirs and files
+        for name, entry in snapshot.entries.items():
+            if name.startswith('.'):
+                continue
+            if not self.tree.ignore_directories and entry.is_dir():
+                dirs.append(name)
+            elif not self.tree.ignore_files:
+                files.append(name)
+
         # sort dirs and files
+        path = self.full_path
         dirs.sort(
-            key=partial(self.tree.dir_sort_key, self.full_path),
+            key=lambda name: self.tree.dir_sort_key(
+                path, name, snapshot.entries[name]
+            ),
             reverse=self.tree.dir_sort_reverse
         )
         files.sort(
-            key=partial(self.tree.file_sort_key, self.full_path),
+            key=lambda name: self.tree.file_sort_key(
+                path, name, snapshot.entries[name]
+            ),
             reverse=self.tree.file_sort_reverse
         )
 
@@ -237,36 +330,70 @@ class DirectoryNode(FileBrowserTreeNodeMixin, TreeParentNode):
     def expanded(self):
         return self.get_widget().expanded
 
-    def find_path(self, path):
-
+    def find_path(self, path, load=True):
+
+        node = self
+        for key in path.split(os.path.sep):
+            if key in ("", "."):
+                continue
+            if node.is_leaf:
+                return None
+            if load:
+                node.get_child_keys()
+            elif key not in node._children:
+                return None
+            if key not in node._child_index:
+                return None
+            node = node.get_child_node(key)
+
+        return node
+
+    def update_children(self, names):
+        """
+        Re-sort the children after `names` have been added, removed or
+        changed, keeping the nodes (and widgets) of the others.
+        """
         try:
-            (d, p) = path.split(os.path.sep, 1)
-        except ValueError:
-            (d, p) = (None, path)
-
-        for key in self.get_child_keys():
-            node = self.get_child_node(key)
-            if d == key and not node.is_leaf:
-                return node.find_path(p)
-            elif p == key:
-                return node
-
-        return None
-            
+            entries = self.tree.snapshot(self.get_value()).entries
+        except OSError:
+            entries = {}
+        for name in names:
+            entry = entries.get(name)
+            node = self._children.get(name)
+            if node is not None and (
+                    entry is None
+                    or entry.is_dir() != isinstance(node, DirectoryNode)
+            ):
+                del self._children[name]
+        self.get_child_keys(reload=True)
 
     @property
     def child_dirs(self):
         return [
-            self._children[k] for k in self.get_child_keys()
-            if isinstance(self._children[k], DirectoryNode)
+            self.get_child_node(k)
+            for k in self.get_child_keys()[:self.dir_count]
         ]
 
     @property
     def child_files(self):
-        return [
-            self.get_child_node(k) for k in self.get_child_keys()
-            if isinstance(self.get_child_node(k), FileNode)
-        ]
+        if self._child_files is None:
+            self._child_files = [
+                node for node in (
+                    self.get_child_node(k)
+                    for k in self.get_child_keys()[self.dir_count:]
+                )
+                if isinstance(node, FileNode)
+            ]
+        return self._child_files
+
+    def child_file_index(self, node):
+        """Return the position of `node` within `child_files`."""
+        self.get_child_keys()
+        index = self._child_index.get(node.get_key())
+        if (index is None or index < self.dir_count
+            or node.get_parent() is not self):
+            raise ValueError(f"{node} is not a file in {self}")
+        return index - self.dir_count
 
     @property
     def full_path(self):
@@ -289,7 +416,7 @@ class DirectoryNode(FileBrowserTreeNodeMixin, TreeParentNode):
 
 
 SPLIT_RE = re.compile(r'[a-zA-Z]+|\d+')
-def sort_basename(root, s):
+def sort_basename(root, s, entry=None):
     L = []
     for isdigit, group in itertools.groupby(SPLIT_RE.findall(s), key=lambda x: x.isdigit()):
         if isdigit:
@@ -299,8 +426,11 @@ def sort_basename(root, s):
             L.append((''.join(group).lower(), 0))
     return L
 
-def sort_mtime(root, s):
+def sort_mtime(root, s, entry=None):
     # logger.info(f"{root}, {s}")
+    if entry is not None:
+        # DirEntry caches its stat result
+        return entry.stat().st_mtime
     return os.stat(os.path.join(root, s)).st_mtime
 
 @keymapped()
@@ -320,6 +450,8 @@ class FileBrowser(AutoCompleteMixin, urwid.WidgetWrap):
         "mtime": sort_mtime,
     }
 
+    SNAPSHOT_CACHE_SIZE = 256
+
     palette = [
         ('body', 'black', 'light gray'),
         ('marked', 'black', 'dark green', ('bold','underline')),
@@ -376,6 +508,7 @@ class FileBrowser(AutoCompleteMixin, urwid.WidgetWrap):
         # self.no_parent_dir = no_parent_dir
         self.expand_empty = expand_empty
         self.last_selection = None
+        self.snapshots = collections.OrderedDict()
 
         self.placeholder = urwid.WidgetPlaceholder(urwid.Filler(urwid.Text("")))
         self.pile = urwid.Pile([
@@ -406,6 +539,24 @@ class FileBrowser(AutoCompleteMixin, urwid.WidgetWrap):
     def cwd(self):
         return self.cwd_node.full_path
 
+    def snapshot(self, path):
+        """
+        Return a `DirectorySnapshot` for `path`, rescanning only if the
+        directory has changed or been invalidated since the last scan.
+        """
+        snapshot = self.snapshots.pop(path, None)
+        if not snapshot or not snapshot.is_current():
+            snapshot = DirectorySnapshot(path)
+        self.snapshots[path] = snapshot
+        while len(self.snapshots) > self.SNAPSHOT_CACHE_SIZE:
+            self.snapshots.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, path):
+        path = os.path.normpath(path)
+        self.snapshots.pop(path, None)
+        self.snapshots.pop(os.path.dirname(path), None)
+
     def create_directory(self, directory):
         if not os.path.isabs(directory):
             directory = os.path.join(self.top_dir, directory)
@@ -428,6 +579,8 @@ class FileBrowser(AutoCompleteMixin, urwid.WidgetWrap):
         focus = node.next_sibling() or node.prev_sibling() or node.get_parent()
         self.body.set_focus(focus)
         shutil.move(src, dst)
+        self.invalidate(node.full_path)
+        self.invalidate(dst)
         node.refresh()
 
     def delete_path(self, path):
@@ -475,6 +628,7 @@ class FileBrowser(AutoCompleteMixin, urwid.WidgetWrap):
         else:
             raise NotImplementedError(node)
 
+        self.invalidate(node.full_path)
         node.get_parent().get_child_keys(reload=True)
         if next_focused:
             self.body.set_focus(next_focused)
@@ -531,8 +685,52 @@ class FileBrowser(AutoCompleteMixin, urwid.WidgetWrap):
         self.selection.refresh()
         self.listbox.body._modified()
 
+    def apply_changes(self, changes):
+        """
+        Patch the tree for a batch of filesystem changes, given as a dict
+        of directory -> names changed within it.  Only the changed entries
+        are re-stat'ed, and only directories already loaded are re-sorted.
+        """
+
+        selection = self.selection
+        parent = selection.get_parent() if selection else None
+        removed = None
+
+        for (dirname, names) in changes.items():
+            dirname = os.path.normpath(dirname)
+            snapshot = self.snapshots.get(dirname)
+            if snapshot:
+                snapshot.update(names)
+            if dirname == self.top_dir:
+                node = self.tree_root
+            else:
+                relpath = os.path.relpath(dirname, self.top_dir)
+                if relpath.startswith(os.pardir):
+                    continue
+                node = self.tree_root.find_path(relpath, load=False)
+            if not isinstance(node, DirectoryNode) or node._child_keys is None:
+                continue
+            if node is parent and selection.get_key() in names:
+                # siblings to move the focus to if the selection goes away
+                keys = parent.get_child_keys()
+                index = parent.get_child_index(selection.get_key())
+                removed = keys[index+1:] + keys[:index][::-1]
+            node.update_children(names)
+
+        if (removed is not None
+            and parent._children.get(selection.get_key()) is not selection):
+            focus = next(
+                (parent.get_child_node(key) for key in removed
+                 if key is not None and key in parent._child_index),
+                parent
+            )
+            self.body.set_focus(focus)
+
+        self.listbox.body._modified()
+
     def refresh_path(self, path):
         logger.debug(f"refresh_path: {path}")
+        self.invalidate(path)
         if path == self.top_dir:
             node = self.tree_root
         else:
@@ -687,26 +885,6 @@ class FileBrowser(AutoCompleteMixin, urwid.WidgetWrap):
     #         return None
 
 
-#######
-# global cache of widgets
-_widget_cache = {}
-
-def add_widget(path, widget):
-    """Add the widget for a given path"""
-
-    _widget_cache[path] = widget
-
-def get_marked_names():
-    """Return a list of all filenames marked as marked."""
-
-    l = []
-    for w in _widget_cache.values():
-        if w.marked:
-            l.append(w.get_node().get_value())
-    return l
-
-
-
 ######
 # store path components of initial current working directory
 _initial_cwd = []
@@ -997,10 +997,18 @@ class ChannelTreeBrowser(AutoCompleteMixin, urwid.WidgetWrap):
         return self.tree.find_key(key)
 
     def cycle_unread(self, step=1):
-        self.cycle(
-            step,
-            lambda n: n.get_widget().unread_count > 0 and not isinstance(n, ChannelGroupNode)
-        )
+        unread = self.provider.unread_locators()
+
+        def has_unread(node):
+            if isinstance(node, ChannelGroupNode):
+                return False
+            elif isinstance(node, ChannelUnionNode):
+                return any(
+                    n.get_key() in unread for n in node.get_leaf_nodes()
+                )
+            return node.get_key() in unread
+
+        self.cycle(step, has_unread)
 
     def cycle(self, step=1, pred=None):
         cur = self.listbox.body.get_focus()[1]
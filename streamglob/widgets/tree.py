@@ -159,8 +159,11 @@ class MarkableMixin(object):
         self.marked = False
         self.update_w()
         if not self.is_leaf:
-            for node in self.get_node().get_marked_nodes(shallow=True):
-                node.get_widget().unmark()
+            # only children whose widgets have been built need unmarking; the
+            # rest pick up their parent's mark if and when they're displayed
+            for node in self.get_node()._children.values():
+                if node._widget is not None and node._widget.marked:
+                    node._widget.unmark()
 
     def toggle_mark(self):
         if self.marked:
@@ -0,0 +1,222 @@
+import unittest
+import os
+import asyncio
+import tempfile
+import hashlib
+import base64
+
+from streamglob.programs import *
+from streamglob.exceptions import SGException
+
+DATA = bytes(range(256)) * 40
+
+# long enough for anything that isn't stuck
+TIMEOUT = 10
+
+URL = "http://example.com/file"
+
+class Response(object):
+
+    def __init__(self, data, start=None, end=None, etag='"v1"', headers=None):
+        if start is None:
+            self.status = 200
+            self.body = data
+            self.headers = {}
+        else:
+            end = min(end or len(data), len(data))
+            self.status = 206
+            self.body = data[start:end]
+            self.headers = {"Content-Range": f"bytes {start}-{end-1}/{len(data)}"}
+        if etag:
+            self.headers["ETag"] = etag
+        self.headers.update(headers or {})
+        self.content_length = len(self.body)
+        self.content = self
+
+    async def iter_any(self):
+        yield self.body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+
+class Server(object):
+    """
+    Answers the downloader's requests without a network, keeping track of
+    which offsets were asked for.
+    """
+
+    def __init__(self, data=DATA, etag='"v1"'):
+        self.data = data
+        self.etag = etag
+        self.offsets = []
+        self.requested = asyncio.Event()
+        self.stall = None
+
+    async def request(self, session, url, offset=None, end=None):
+        self.offsets.append(offset)
+        self.requested.set()
+        if self.stall:
+            await self.stall.wait()
+        return Response(self.data, offset, end, etag=self.etag)
+
+
+class TestHTTPDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        state.event_loop = self.loop
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.outfile = os.path.join(self.tempdir.name, "file")
+
+    def tearDown(self):
+        self.loop.close()
+        self.tempdir.cleanup()
+
+    def downloader(self, server=None, **kwargs):
+        downloader = HTTPDownloader("http", segment_size=1000, **kwargs)
+        downloader.outfile = self.outfile
+        downloader.source = URL
+        if server:
+            downloader.request = server.request
+        return downloader
+
+    def interrupt(self, done, data=DATA, validator='"v1"'):
+        # what an interrupted download leaves behind
+        downloader = self.downloader()
+        downloader.plan(len(data), validator)
+        downloader.done = done
+        with open(self.outfile, "wb") as f:
+            f.write(b"\0" * len(data))
+            for index, count in enumerate(done):
+                (start, end) = downloader.segment(index)
+                f.seek(start)
+                f.write(b"x" * count)
+        downloader.save_segments()
+
+    def contents(self):
+        with open(self.outfile, "rb") as f:
+            return f.read()
+
+    def test_plan(self):
+        d = self.downloader()
+        d.plan(2500, '"v1"')
+        self.assertTrue(d.ranges)
+        self.assertEqual(d.done, [0, 0, 0])
+        self.assertEqual(
+            [d.segment(i) for i in range(3)],
+            [(0, 1000), (1000, 2000), (2000, 2500)]
+        )
+        d.done = [1000, 400, 500]
+        self.assertEqual(d.pending(), [1])
+
+    def test_plan_without_ranges(self):
+        d = self.downloader()
+        d.plan(2500, None, ranges=False)
+        self.assertEqual(d.done, [0])
+        self.assertEqual(d.segment(0), (0, 2500))
+        # no length means no way to tell when it's done
+        d.plan(None, None, ranges=False)
+        d.done = [2500]
+        self.assertEqual(d.segment(0), (0, None))
+        self.assertEqual(d.pending(), [0])
+
+    def test_content_range(self):
+        d = self.downloader()
+        self.assertEqual(
+            d.content_range(Response(DATA, 1000, 2000)), (1000, len(DATA))
+        )
+        self.assertEqual(
+            d.content_range(Response(
+                DATA, 0, headers={"Content-Range": "bytes 0-99/*"}
+            )),
+            (0, None)
+        )
+        self.assertEqual(d.content_range(Response(DATA)), (None, None))
+
+    def test_expected_digest(self):
+        d = self.downloader()
+        sha256 = hashlib.sha256(DATA).digest()
+        encoded = base64.b64encode(sha256).decode()
+        self.assertEqual(
+            d.expected_digest(Response(
+                DATA, headers={"Repr-Digest": f"unknown=:abc:, sha-256=:{encoded}:"}
+            )),
+            ("sha256", sha256)
+        )
+        self.assertEqual(
+            d.expected_digest(Response(DATA, headers={"Digest": f"SHA-256={encoded}"})),
+            ("sha256", sha256)
+        )
+        self.assertIsNone(
+            d.expected_digest(Response(DATA, headers={"Digest": "sha-256=!!"}))
+        )
+        self.assertIsNone(d.expected_digest(Response(DATA)))
+        # one given by the task wins over the server's
+        d = self.downloader(checksum="md5:" + hashlib.md5(DATA).hexdigest())
+        self.assertEqual(
+            d.expected_digest(Response(DATA, headers={"Digest": f"SHA-256={encoded}"})),
+            ("md5", hashlib.md5(DATA).digest())
+        )
+
+    def test_parse_checksum(self):
+        self.assertEqual(
+            HTTPDownloader.parse_checksum("SHA-256:00ff"), ("sha256", b"\x00\xff")
+        )
+        for checksum in ["sha256:xyz", "nonexistent:00ff"]:
+            with self.assertRaises(SGException):
+                HTTPDownloader.parse_checksum(checksum)
+
+    def test_resume(self):
+        self.interrupt([1000, 300, 0] + [0] * 8)
+        server = Server()
+        self.loop.run_until_complete(
+            self.downloader(server).fetch_segments(None, URL)
+        )
+        # what was already there is kept, and only the rest is asked for
+        self.assertEqual(server.offsets[0], 1300)
+        self.assertNotIn(0, server.offsets)
+        self.assertEqual(self.contents()[:1300], b"x" * 1300)
+        self.assertEqual(self.contents()[1300:], DATA[1300:])
+
+    def test_resume_changed(self):
+        for (data, etag) in [(DATA, '"v2"'), (DATA[:-1], '"v1"')]:
+            self.interrupt([1000, 300, 0] + [0] * 8)
+            server = Server(data, etag)
+            d = self.downloader(server)
+            self.loop.run_until_complete(d.fetch_segments(None, URL))
+            # nothing from the last attempt can be trusted
+            self.assertIn(0, server.offsets)
+            self.assertEqual(self.contents(), data)
+            self.assertFalse(os.path.exists(d.segments_file))
+
+    def test_stop(self):
+        for removed in [False, True]:
+            self.interrupt([1000, 300, 0] + [0] * 8)
+            server = Server()
+            server.stall = asyncio.Event()
+            d = self.downloader(server)
+
+            async def stop():
+                proc = await d.run()
+                await asyncio.wait_for(server.requested.wait(), TIMEOUT)
+                proc.terminate()
+                if removed:
+                    # as DownloadMediaTask.stop() does
+                    os.remove(self.outfile)
+                return await asyncio.wait_for(proc.wait(), TIMEOUT)
+
+            self.assertEqual(self.loop.run_until_complete(stop()), -signal.SIGTERM)
+            # only worth keeping if there's a file to resume
+            self.assertEqual(os.path.exists(d.segments_file), not removed)
+
+
+if __name__ == "__main__":
+    unittest.main()
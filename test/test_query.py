@@ -0,0 +1,242 @@
+import unittest
+import re
+import sqlite3
+from datetime import datetime
+
+from streamglob.query import *
+from streamglob.exceptions import SGInvalidFilterExpression
+
+COLUMNS = (
+    ("media_listing_id", "number"),
+    ("provider_id", "text"),
+    ("channel", "number"),
+    ("guid", "text"),
+    ("title", "text"),
+    ("content", "text"),
+    ("created", "date"),
+    ("read", "date"),
+)
+
+SCHEMA = """
+CREATE TABLE medialisting (
+    media_listing_id INTEGER PRIMARY KEY,
+    provider_id TEXT NOT NULL,
+    channel INTEGER,
+    guid TEXT,
+    title TEXT,
+    content TEXT,
+    created DATETIME,
+    read DATETIME
+);
+CREATE INDEX idx_medialisting__provider_id ON medialisting (provider_id);
+CREATE INDEX idx_medialisting__channel ON medialisting (channel);
+CREATE INDEX idx_medialisting__guid ON medialisting (guid);
+"""
+
+class TestFilterQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.db = sqlite3.connect(":memory:")
+        self.db.create_function(
+            "REGEXP", 2,
+            lambda expr, item: item is not None and re.search(expr, item) is not None
+        )
+        self.db.executescript(SCHEMA)
+        self.db.executemany(
+            "INSERT INTO medialisting "
+            "(provider_id, channel, guid, title, created, read) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                ("rss", i % 50, f"guid-{i}", f"Item {i}{' Live' if i % 7 == 0 else ''}",
+                 datetime(2020, 1, 1 + i % 28).isoformat(" "),
+                 None if i % 3 else datetime(2020, 2, 1).isoformat(" "))
+                for i in range(1000)
+            ]
+        )
+        self.db.execute("ANALYZE")
+
+    def select(self, fragment, columns="media_listing_id"):
+        return self.db.execute(
+            f"SELECT {columns} FROM medialisting WHERE {fragment.sql}",
+            fragment.params
+        ).fetchall()
+
+    def plan(self, fragment):
+        return " ".join(
+            row[-1] for row in self.db.execute(
+                f"EXPLAIN QUERY PLAN SELECT * FROM medialisting WHERE {fragment.sql}",
+                fragment.params
+            )
+        )
+
+    def test_parameterized(self):
+        q = compile_filter("title = \"it's\" | guid = x' OR 1=1 --", COLUMNS)
+        self.assertNotIn("it's", q.sql)
+        self.assertEqual(q.sql.count("?"), 2)
+        self.assertEqual(self.select(q), [])
+
+    def test_plan_cache(self):
+        a = compile_filter("channel = 1 & title =~ live", COLUMNS)
+        info = filter_plan.cache_info()
+        b = compile_filter("channel = 2 & title =~ replay", COLUMNS)
+        self.assertEqual(a.sql, b.sql)
+        self.assertEqual(filter_plan.cache_info().hits, info.hits + 1)
+        self.assertEqual(b.params, [2, "(?i)replay"])
+
+    def test_results(self):
+        q = compile_filter(
+            "channel in [0, 7] & !(read != null) & title =~ live", COLUMNS
+        )
+        rows = self.select(q, "channel, title, read")
+        self.assertTrue(rows)
+        for (channel, title, read) in rows:
+            self.assertIn(channel, (0, 7))
+            self.assertIn("Live", title)
+            self.assertIsNone(read)
+
+    def test_date_range(self):
+        q = compile_filter("created in 2020-01-03..2020-01-04", COLUMNS)
+        # both ends are inclusive
+        self.assertEqual(
+            len(self.select(q)),
+            len([i for i in range(1000) if i % 28 in (2, 3)])
+        )
+
+    def test_fields(self):
+        self.assertEqual(
+            filter_fields(parse_filter(
+                "title =~ a & !(created in 1 week ago.. | channel = 3)"
+            )),
+            {"title", "created", "channel"}
+        )
+
+    def test_labels(self):
+        q = compile_filter(
+            "label = music", COLUMNS, labels={"music": "item 7\\b"}.get
+        )
+        self.assertEqual(len(self.select(q)), 1)
+        q = compile_filter("label = missing", COLUMNS, labels=lambda l: None)
+        self.assertEqual(self.select(q), [])
+
+    def test_combine(self):
+        q = FilterQuery("channel = ?", [3]) & compile_filter("guid = guid-3", COLUMNS)
+        self.assertEqual(self.select(q), [(4,)])
+        self.assertEqual(q.pony_sql, "(channel = $(p[0]) AND guid = $(p[1]))")
+
+    def test_member(self):
+        channels = list(range(0, 300, 7))
+        q = FilterQuery.member("channel", channels)
+        self.assertEqual(q.sql, FilterQuery.member("channel", [1]).sql)
+        self.assertEqual(
+            len(self.select(q)),
+            len([i for i in range(1000) if i % 50 in channels])
+        )
+        self.assertRegex(self.plan(q), r"USING (COVERING )?INDEX")
+
+    def test_invalid(self):
+        for expr in ["nonexistent = 1", "title = 'a' &", "(title = a", "created =~ x"]:
+            with self.assertRaises(SGInvalidFilterExpression):
+                compile_filter(expr, COLUMNS)
+
+    def test_index_use(self):
+        for expr in [
+                "channel = 3",
+                "channel in [1, 2, 3] & title =~ live",
+                "guid = guid-10 | guid = guid-20",
+                "provider_id = rss & channel = 4 & read = null",
+        ]:
+            q = compile_filter(expr, COLUMNS)
+            self.assertRegex(self.plan(q), r"USING (COVERING )?INDEX", expr)
+
+        q = compile_filter("title =~ live", COLUMNS)
+        self.assertNotRegex(self.plan(q), r"USING (COVERING )?INDEX")
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def test_generation(self):
+        generation = [0]
+        calls = []
+        cache = QueryCache(lambda: generation[0], size=2)
+
+        def count():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(cache.get(("count", 1), count), 1)
+        self.assertEqual(cache.get(("count", 1), count), 1)
+        self.assertEqual(cache.get(None, count), 2)
+        generation[0] += 1
+        self.assertEqual(cache.get(("count", 1), count), 3)
+
+    def test_eviction(self):
+        cache = QueryCache(lambda: 0, size=2)
+        for key in "abc":
+            cache.get(key, lambda: key)
+        self.assertEqual(cache.get("a", lambda: "new"), "new")
+        self.assertEqual(cache.get("c", lambda: "new"), "c")
+
+
+class TestSavedSearch(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # the data model pulls in most of the application, so only load it
+        # for the tests that need it
+        from streamglob import model
+        if model.db.provider is None:
+            model.init(":memory:")
+        cls.model = model
+
+    def members(self, search):
+        # members are written with raw SQL, so read them back the same way
+        # rather than through the entity's cached collection
+        table = self.model.SavedSearchMember._table_
+        return set(self.model.db.select(
+            f'SELECT media_listing_id FROM "{table}" '
+            "WHERE saved_search = $(search.saved_search_id)"
+        ))
+
+    def test_triggers(self):
+        model = self.model
+        q = compile_filter(
+            "viewed = null & locator =~ live",
+            listing_columns(model.MediaListing)
+        )
+        with model.db_session:
+            listings = [
+                model.MediaListing(
+                    provider_id=provider_id,
+                    locator=f"item {i}{' live' if i % 3 == 0 else ''}"
+                )
+                for provider_id in ["test", "other"]
+                for i in range(30)
+            ]
+            search = model.SavedSearch(
+                provider_id="test", expression="live", plan=[q.sql, q.params]
+            )
+            model.flush()
+            search.rebuild()
+            self.assertEqual(len(self.members(search)), 10)
+
+            # insert
+            for i in range(30, 40):
+                model.MediaListing(provider_id="test", locator=f"item {i} live")
+            # update: mark two members read, make a non-member match
+            listings[0].viewed = datetime.now()
+            listings[3].viewed = datetime.now()
+            listings[1].locator = "item 1 live"
+            # delete a member and a non-member
+            listings[6].delete()
+            listings[7].delete()
+
+            model.SavedSearch.apply_changes()
+            members = self.members(search)
+            self.assertEqual(len(members), 10 + 10 - 2 + 1 - 1)
+            self.assertFalse(model.SavedSearchChange.select().exists())
+            search.rebuild()
+            self.assertEqual(members, self.members(search))
+
+
+if __name__ == "__main__":
+    unittest.main()
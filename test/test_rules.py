@@ -0,0 +1,58 @@
+import unittest
+import random
+
+from streamglob.rules import *
+
+def matches(matcher, text):
+    return [
+        (start, end, label, rule.subject)
+        for (start, end, label, rule) in matcher.finditer(text)
+    ]
+
+class TestHighlightRuleMatcher(unittest.TestCase):
+
+    def test_add_to_empty_label(self):
+        rules = {"high": [], "low": [HighlightRule("foo bar")]}
+        matcher = HighlightRuleMatcher(rules)
+        rule = HighlightRule("foo")
+        matcher.add("high", rule)
+        rules["high"].append(rule)
+        # "high" comes first in the config, so it wins the overlap
+        self.assertEqual(matches(matcher, "a foo bar"), [(2, 5, "high", "foo")])
+        self.assertEqual(
+            matches(matcher, "a foo bar"),
+            matches(HighlightRuleMatcher(rules), "a foo bar")
+        )
+
+    def test_incremental(self):
+        rng = random.Random(1)
+        words = ["foo", "bar", "baz", "qux", "foo bar", "ba.", "qu+x"]
+        for trial in range(50):
+            labels = [f"label{i}" for i in range(5)]
+            rules = {
+                label: [
+                    HighlightRule(rng.choice(words) + str(rng.randrange(3)))
+                    for i in range(rng.choice([0, 0, 1, 2]))
+                ]
+                for label in labels
+            }
+            matcher = HighlightRuleMatcher(rules)
+            for i in range(5):
+                label = rng.choice(labels)
+                if rules[label] and rng.random() < 0.3:
+                    rule = rules[label].pop(rng.randrange(len(rules[label])))
+                    matcher.remove(rule)
+                else:
+                    rule = HighlightRule(rng.choice(words) + str(rng.randrange(3)))
+                    rules[label].append(rule)
+                    matcher.add(label, rule)
+            text = " ".join(
+                rng.choice(words) + str(rng.randrange(3)) for i in range(20)
+            )
+            self.assertEqual(
+                matches(matcher, text),
+                matches(HighlightRuleMatcher(rules), text)
+            )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+import collections
+
+from streamglob.scheduling import *
+
+class Task(object):
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+
+    def __repr__(self):
+        return f"<Task {self.task_id}>"
+
+
+class TestSchedulingPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.task_ids = iter(range(1, 100000))
+
+    def push(self, policy, count, **kwargs):
+        tasks = [Task(next(self.task_ids)) for i in range(count)]
+        for task in tasks:
+            policy.push(task, **kwargs)
+        return tasks
+
+    def drain(self, policy):
+        tasks = []
+        while True:
+            task = policy.pop()
+            if not task:
+                return tasks
+            tasks.append(task)
+
+    def test_limit(self):
+        policy = SchedulingPolicy(3)
+        tasks = self.push(policy, 5)
+        self.assertEqual(self.drain(policy), tasks[:3])
+        policy.finished(tasks[1])
+        self.assertEqual(self.drain(policy), [tasks[3]])
+        self.assertEqual(len(policy), 1)
+
+    def test_per_host(self):
+        policy = SchedulingPolicy(10, per_host=2)
+        a = self.push(policy, 5, host="a.example.com")
+        b = self.push(policy, 5, host="b.example.com")
+        local = self.push(policy, 3)
+        started = self.drain(policy)
+        self.assertEqual(sorted(started, key=lambda t: t.task_id), a[:2] + b[:2] + local)
+        policy.finished(a[0])
+        self.assertEqual(self.drain(policy), [a[2]])
+
+    def test_per_program(self):
+        policy = SchedulingPolicy(10, per_program={"youtube-dl": 1})
+        ytdl = self.push(policy, 3, program="youtube-dl")
+        other = self.push(policy, 3, program="wget")
+        self.assertEqual(
+            sorted(self.drain(policy), key=lambda t: t.task_id),
+            ytdl[:1] + other
+        )
+
+    def test_fair(self):
+        policy = SchedulingPolicy(1000)
+        self.push(policy, 500, provider="bulk")
+        small = self.push(policy, 10, provider="feeds")
+        order = self.drain(policy)
+        # the late small batch is interleaved rather than left till last
+        self.assertLess(max(order.index(t) for t in small), 25)
+
+    def test_weights(self):
+        policy = SchedulingPolicy(1000, weights={"a": 3, "b": 1})
+        a = set(self.push(policy, 300, provider="a"))
+        self.push(policy, 300, provider="b")
+        first = self.drain(policy)[:200]
+        share = len([t for t in first if t in a]) / len(first)
+        self.assertAlmostEqual(share, 0.75, places=1)
+
+    def test_order_within_flow(self):
+        policy = SchedulingPolicy(100)
+        tasks = self.push(policy, 20, provider="a", host="h")
+        self.assertEqual(self.drain(policy), tasks)
+
+    def test_host(self):
+        self.assertEqual(locator_host("https://Example.com:8080/a?b"), "example.com")
+        self.assertIsNone(locator_host("/home/user/file.mp4"))
+        self.assertIsNone(locator_host(None))
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def test_backoff(self):
+        policy = RetryPolicy(random=lambda: 1)
+        delays = [policy.backoff("network", n) for n in range(10)]
+        self.assertEqual(delays[:3], [30, 60, 120])
+        self.assertEqual(delays[-1], 3600)
+        self.assertIsNone(policy.backoff("network", 10))
+
+    def test_jitter(self):
+        self.assertEqual(RetryPolicy(random=lambda: 0).backoff("network", 1), 30)
+        delays = {RetryPolicy().backoff("network", 3) for i in range(20)}
+        self.assertGreater(len(delays), 1)
+        for delay in delays:
+            self.assertTrue(120 <= delay <= 240)
+
+    def test_classes(self):
+        policy = RetryPolicy()
+        for error_class in ["not_found", "invalid", "exists", "cancelled"]:
+            self.assertIsNone(policy.backoff(error_class, 0))
+        # anything unknown is treated like a failed process
+        self.assertEqual(policy.rule("unknown"), policy.rule("process"))
+
+    def test_overrides(self):
+        policy = RetryPolicy({"network": {"retries": 1}, "not_found": {"retries": 2}},
+                             random=lambda: 1)
+        self.assertEqual(policy.backoff("network", 0), 30)
+        self.assertIsNone(policy.backoff("network", 1))
+        self.assertEqual(policy.backoff("not_found", 1), 120)
+
+if __name__ == "__main__":
+    unittest.main()
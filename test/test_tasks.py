@@ -0,0 +1,162 @@
+import unittest
+import asyncio
+import types
+from datetime import datetime, timedelta
+
+from streamglob import model
+from streamglob import providers
+from streamglob.tasks import *
+
+PROVIDER_ID = "test"
+
+
+class Provider(object):
+
+    def __init__(self):
+        self.created = []
+
+    def create_download_tasks(self, listing, index=0):
+        task = Task(listing)
+        self.created.append((listing.locator, index))
+        return [task]
+
+
+class Task(object):
+
+    def __init__(self, listing):
+        self.listing = types.SimpleNamespace(
+            media_listing_id=listing.media_listing_id
+        )
+        self.title = listing.locator
+        self.partial = None
+        self.tempdir_removed = False
+
+    def remove_tempdir(self):
+        self.tempdir_removed = True
+
+
+class TaskManager(object):
+
+    def __init__(self):
+        self.queued = []
+
+    def download(self, task):
+        self.queued.append(task)
+
+
+class TestDownloadQueue(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        if model.db.provider is None:
+            model.init(":memory:")
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        state.event_loop = self.loop
+        self.provider = Provider()
+        providers.PROVIDERS[PROVIDER_ID] = self.provider
+        self.task_manager = TaskManager()
+        self.queue = DownloadQueue(
+            self.task_manager,
+            RetryPolicy({"process": dict(retries=1, delay=10)}, random=lambda: 0)
+        )
+
+    def tearDown(self):
+        self.queue.cancel_all()
+        providers.PROVIDERS.pop(PROVIDER_ID, None)
+        self.loop.close()
+        with model.db_session:
+            model.MediaDownload.select().delete(bulk=True)
+            model.MediaListing.select(
+                lambda l: l.provider_id == PROVIDER_ID
+            ).delete(bulk=True)
+
+    @model.db_session
+    def download(self, name, **kwargs):
+        listing = model.MediaListing(provider_id=PROVIDER_ID, locator=name)
+        download = model.MediaDownload(media_listing=listing, **kwargs)
+        model.flush()
+        return download.media_download_id
+
+    @model.db_session
+    def get(self, media_download_id):
+        return model.MediaDownload[media_download_id].to_dict()
+
+    @model.db_session
+    def task(self, media_download_id):
+        return Task(model.MediaDownload[media_download_id].media_listing)
+
+    def test_retry(self):
+        download_id = self.download("retried")
+        task = self.task(download_id)
+        self.queue.submitted(task)
+        self.queue.started(task)
+        self.assertEqual(self.get(download_id)["state"], "active")
+
+        self.queue.failed(task, returncode=1)
+        download = self.get(download_id)
+        self.assertTrue(task.tempdir_removed)
+        self.assertEqual(download["state"], "waiting")
+        self.assertEqual(download["retries"], 1)
+        self.assertEqual(download["error"], "exit status 1")
+        self.assertAlmostEqual(
+            (download["next_attempt"] - datetime.now()).total_seconds(), 5,
+            delta=1
+        )
+        self.assertIn(download_id, self.queue.timers)
+
+        # as the timer does when it fires
+        self.queue.retry(download_id)
+        self.assertNotIn(download_id, self.queue.timers)
+        self.assertEqual(len(self.task_manager.queued), 1)
+        self.queue.submitted(self.task_manager.queued[0])
+        download = self.get(download_id)
+        self.assertEqual(download["state"], "pending")
+        self.assertIsNone(download["next_attempt"])
+
+    def test_give_up(self):
+        download_id = self.download("failed", retries=1)
+        task = self.task(download_id)
+        self.queue.submitted(task)
+        self.queue.failed(task, returncode=1)
+        download = self.get(download_id)
+        self.assertEqual(download["state"], "failed")
+        self.assertEqual(download["error"], "exit status 1")
+        self.assertNotIn(download_id, self.queue.timers)
+        # a retry that was already scheduled doesn't bring it back
+        self.queue.retry(download_id)
+        self.assertEqual(self.task_manager.queued, [])
+
+        # asked for again, it starts over
+        self.queue.submitted(task)
+        download = self.get(download_id)
+        self.assertEqual(download["state"], "pending")
+        self.assertEqual(download["retries"], 0)
+        self.assertIsNone(download["error"])
+
+    def test_resume(self):
+        now = datetime.now()
+        self.download("active", state="active", source_index=1)
+        waiting = self.download(
+            "waiting", state="waiting", next_attempt=now + timedelta(hours=1)
+        )
+        self.download(
+            "overdue", state="waiting", next_attempt=now - timedelta(hours=1)
+        )
+        self.download("failed", state="failed")
+
+        self.queue.resume()
+        self.assertEqual(
+            sorted(self.provider.created), [("active", 1), ("overdue", 0)]
+        )
+        self.assertEqual(list(self.queue.timers), [waiting])
+        self.assertAlmostEqual(
+            self.queue.timers[waiting].when() - self.loop.time(), 3600,
+            delta=5
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()